@@ -10,3 +10,14 @@ python-can-sontheim
 from .version import __version__
 from ._canlib import SontheimBus
 from .constants import IS_PYTHON_64BIT
+from .batch import BatchListener
+from .snapshot import LatestFrameTable, LatestFrame
+from .statistics import PeriodStatistics, IdStatistics
+from .generator import TrafficGenerator
+from .prepared import PreparedFrame
+from .capture import TriggeredCapture, CaptureEvent, IdTrigger, ErrorFrameTrigger, LostFrameTrigger
+from .clocksync import ClockSync, get_clock_sync
+from .monitor import LevelMonitor, LevelSample, LevelWarning
+from .echo import TxTracker, TxConfirmation
+from .indexed import IndexedCaptureWriter, IndexedCaptureReader
+from .devicecache import DeviceCache, DeviceInfo, get_device_cache
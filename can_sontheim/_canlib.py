@@ -4,9 +4,12 @@ Ctypes wrapper module for the SIE / IFM CANfox interface
 Copyright (C) 2022 Matt Woodhead
 """
 # standard library imports
-from ctypes import c_int, c_long, c_ubyte, c_ulonglong, byref
+from ctypes import c_bool, c_double, c_int, c_long, c_longlong, c_ubyte, c_ulong, c_ulonglong, byref
+from collections import deque
 import logging
+import math
 import time
+from time import perf_counter_ns
 import platform
 import sys
 
@@ -28,7 +31,27 @@ from .constants import (
     NTCAN_TX_TIMEOUT,
 )
 from .devices import CANfox, CANUSB, CANUSB_Legacy
-from .structures import CANMsgStruct, CANMsgBuffer, CANInstalledDevicesStruct, read_struct_as_dict
+from .structures import (
+    CANMsgStruct,
+    CANMsgBuffer,
+    CANInstalledDevicesStruct,
+    CANBusLoadStruct,
+    CANStatusStruct,
+    CANCounterStruct2,
+    CANLevelHistStruct,
+    struct_decoder,
+)
+from .batch import BatchListener, HAS_NUMPY, as_array
+from .snapshot import LatestFrameTable
+from .broker import SharedMemoryBroker
+from .tuning import AdaptiveBatchTuner
+from .profiling import Profiler, profiling_enabled
+from .prepared import PreparedFrame
+from .monitor import LevelMonitor
+from .echo import TxTracker, ECHO_FLAG
+from .clocksync import ClockSync, TICK_SECONDS, get_clock_sync
+from .recovery import BusRecovery, RECOVERABLE_ERRORS
+from .devicecache import DeviceCache, DeviceInfo, get_device_cache, revisions_from_status
 
 
 try:
@@ -78,9 +101,11 @@ else:
     )
 
 
-def canGetSystemTime() -> int:
+def canGetSystemTime(library=None) -> int:
     """
 
+    :param library: The MT_API library to call, defaults to the loaded SIECA132 DLL
+
     :raises SontheimCanOperationError:
         Raised if the Sontheim MT_API reports an error when querying the HW timestamp
     :return:
@@ -92,7 +117,7 @@ def canGetSystemTime() -> int:
     pui64StartSysTime = c_ulonglong()
     pui64CurrSysTime = c_ulonglong()
 
-    error_code = _CANLIB.canGetSystemTime(byref(pui64CurrSysTime), byref(pui64StartSysTime))
+    error_code = (library or _CANLIB).canGetSystemTime(byref(pui64CurrSysTime), byref(pui64StartSysTime))
 
     if error_code != NTCAN_SUCCESS:
         raise CanOperationError("Error encountered in canGetSystemTime function call")
@@ -114,15 +139,68 @@ class SontheimBus(BusABC):
         **kwargs,
     ):
 
+        started = time.perf_counter()
+        self.startup_timing = {}
         self.channel = channel
         self.channel_info = str(channel)
         self._canfox_bitrate = CANFOX_BITRATES.get(
             int(bitrate),
             CANFOX_BITRATES[500000],  # default to 500 kbit/s
         )
+        self._bitrate = int(bitrate)
+
+        self.profiler = None
+        self._lib = _CANLIB
+        if profiling_enabled(kwargs.get("profile")):
+            self.profiler = Profiler()
+            self._lib = self.profiler.wrap_library(_CANLIB)
+
         self._Handle = HANDLE()
+        self._dual_handle = bool(kwargs.get("dual_handle", False))
+        self._tx_handle = HANDLE() if self._dual_handle else self._Handle
         self._bus_pc_start_time_s = None
         self._bus_hw_start_timestamp = None
+        self._time_offset = None
+        self._open_args = None
+        self._fast_attach = bool(kwargs.get("fast_attach", False))
+        device_cache = kwargs.get("device_cache", False)
+        if isinstance(device_cache, str):
+            device_cache = DeviceCache(device_cache)
+        elif device_cache is True:
+            device_cache = get_device_cache()
+        self._device_cache = device_cache or None
+        self._device_info = None
+        self._attach_status = None
+        self.net_owner = None
+        self.clock = None
+        self.broker = None
+        self.level_monitor = None
+        self._rx_buffer_length = max(int(kwargs.get("rx_buffer_length", 20)), 2)
+        self._rx_buffer = CANMsgBuffer(self._rx_buffer_length)
+        self._rx_pending = deque()
+        self._batch_listeners = []
+
+        self.rx_tuner = None
+        self._busload_interval = kwargs.get("busload_interval", 1.0)
+        self._next_busload_time = 0.0
+        if kwargs.get("adaptive_batching", False):
+            self.rx_tuner = AdaptiveBatchTuner(
+                initial_size=self._rx_buffer_length,
+                max_size=int(kwargs.get("max_rx_batch_size", 4096)),
+                max_latency=kwargs.get("max_rx_latency", 0.01),
+            )
+
+        # with consume_echo the echoes of transmitted frames are only seen by batch listeners, never returned by recv
+        self._consume_echo = bool(kwargs.get("consume_echo", False))
+        self.tx_tracker = None
+        if kwargs.get("track_tx", False):
+            self.tx_tracker = TxTracker(timeout=kwargs.get("tx_confirm_timeout", 1.0))
+            self.add_batch_listener(self.tx_tracker)
+
+        self.snapshot_table = None
+        if kwargs.get("snapshot_table", False):
+            self.snapshot_table = LatestFrameTable()
+            self.add_batch_listener(self.snapshot_table)
 
         if state is BusState.ACTIVE or state is BusState.PASSIVE:
             self.state = state
@@ -135,27 +213,80 @@ class SontheimBus(BusABC):
 
         super().__init__(channel=channel, state=state, bitrate=bitrate, *args, **kwargs)
 
+        echo = kwargs.get("echo", kwargs.get("receive_own_messages", True))
+        if self.tx_tracker is not None and not (echo and not self._dual_handle):
+            log.warning("Transmitted frames cannot be confirmed without echo, which is disabled in dual handle mode")
         self._can_init(
-            errors=kwargs.get(bool("errors"), True),
-            echo=kwargs.get(bool("echo"), True),
+            errors=kwargs.get("errors", True),
+            echo=echo,
             tx_timeout=kwargs.get("tx_timeout", -1),
             rx_timeout=kwargs.get("rx_timeout", -1),
         )
 
-    def _can_init(self, errors=True, echo=False, tx_timeout=-1, rx_timeout=-1):
+        self.recovery = None
+        if kwargs.get("auto_recover", False):
+            self.recovery = BusRecovery(
+                self._restart_controller,
+                self._reopen,
+                self._send_record,
+                on_recovered=self._restart_periodic_tasks,
+                timeout=kwargs.get("recovery_timeout", 30.0),
+                retry_interval=kwargs.get("recovery_retry_interval", 0.5),
+                backlog_size=kwargs.get("tx_backlog", 1000),
+            )
 
-        # TODO: Check DLL status for DLL version - if it shows a value of zero, you need to unplug the adapter and plug it back in again to reset the driver
+        clock_sync = kwargs.get("clock_sync", False)
+        if clock_sync:
+            stage_start = time.perf_counter()
+            self._start_clock_sync(clock_sync if isinstance(clock_sync, ClockSync) else get_clock_sync())
+            self._time_stage("clock_sync", stage_start)
+
+        if kwargs.get("shared_memory_name"):
+            # broker mode, every received frame is published for SontheimSharedMemoryBus clients in other processes
+            try:
+                self.broker = SharedMemoryBroker(
+                    kwargs["shared_memory_name"],
+                    capacity=kwargs.get("shared_memory_capacity", 65536),
+                    channel=int(self.channel),
+                    time_offset=self._time_offset,
+                )
+            except Exception:
+                self.shutdown()  # releases the handles and the clock sync registration
+                raise
+            self.add_batch_listener(self.broker)
+
+        if kwargs.get("level_monitor", False):
+            try:
+                self.start_level_monitor(interval=kwargs.get("level_monitor_interval", 5.0))
+            except CanOperationError as COE:
+                # only some adapters are fitted with CAN level measurement, which should not stop the bus opening
+                log.warning("CAN level monitoring is not available on this device: %s", COE)
+            except Exception:
+                self.shutdown()
+                raise
+
+        self._time_stage("total", started)
+        log.debug("Sontheim bus started in %s", self.startup_timing)
+
+    def _open_handle(self, handle, errors, echo, tx_timeout, rx_timeout, receive_event, error_event):
+        """
+        Opens a driver handle on the bus channel.
 
-        error_code = _CANLIB.canOpen(
+        :param handle: The HANDLE object that the driver handle is written into
+        :param receive_event: The name of the event the driver signals when a message is received
+        :param error_event: The name of the event the driver signals when an error occurs
+        :raises CanInitializationError: If the MT_API returns an error whilst opening the handle
+        """
+        error_code = self._lib.canOpen(
             c_long(int(self.channel)),
             c_long(errors),
             c_long(echo),
             c_long(tx_timeout),
             c_long(rx_timeout),
             "python-can",
-            "R1",
-            "E1",
-            byref(self._Handle),
+            receive_event,
+            error_event,
+            byref(handle),
         )
         if error_code != NTCAN_SUCCESS:
             # raise CanInitializationError(
@@ -165,19 +296,236 @@ class SontheimBus(BusABC):
                 f"Error encountered whilst trying to open Sontheim bus interface, [Error Code: {error_code}]",
             )
 
-        error_code = _CANLIB.canSetBaudrate(self._Handle, c_int(self._canfox_bitrate))
+    def _can_init(self, errors=True, echo=False, tx_timeout=-1, rx_timeout=-1):
+
+        # TODO: Check DLL status for DLL version - if it shows a value of zero, you need to unplug the adapter and plug it back in again to reset the driver
+
+        self._open_args = (errors, echo, tx_timeout, rx_timeout)
+        self._open_channel(errors, echo, tx_timeout, rx_timeout)
+
+        stage_start = time.perf_counter()
+        self._bus_pc_start_time_s = round(time.time(), 4)
+        self._bus_hw_start_timestamp = canGetSystemTime(self._lib) / 10000
+        self._time_offset = self._bus_pc_start_time_s - self._bus_hw_start_timestamp
+        self._time_stage("time_base", stage_start)
+
+    def _time_stage(self, stage: str, start: float) -> float:
+        """Records the time taken by a startup stage in :attr:`startup_timing`, returning the end time of the stage"""
+        now = time.perf_counter()
+        self.startup_timing[stage] = now - start
+        return now
+
+    def _open_channel(self, errors, echo, tx_timeout, rx_timeout):
+        """
+        Opens the driver handle(s) and configures the bitrate and filters of the channel.
+
+        :raises CanInitializationError: If the MT_API returns an error whilst opening or configuring the channel
+        """
+        stage_start = time.perf_counter()
+        # In dual handle mode the receive handle never sees its own transmissions, as all frames are sent
+        # from the dedicated transmit handle and echo is disabled on both.
+        self._open_handle(self._Handle, errors, echo and not self._dual_handle, tx_timeout, rx_timeout, "R1", "E1")
+        self._time_stage("open", stage_start)
+
+        if not (self._fast_attach and self._attach_to_running_net()):
+            stage_start = time.perf_counter()
+            error_code = self._lib.canSetBaudrate(self._Handle, c_int(self._canfox_bitrate))
+            if error_code != NTCAN_SUCCESS:
+                self._close_handles()
+                raise CanInitializationError(
+                    f"Error encountered whilst trying to set bus bitrate, [Error Code: {error_code}]",
+                )
+            self._time_stage("baudrate", stage_start)
+        stage_start = time.perf_counter()
+        error_code = self._lib.canSetFilterMode(self._Handle, c_int(4))
         if error_code != NTCAN_SUCCESS:
+            self._close_handles()
             raise CanInitializationError(
-                f"Error encountered whilst trying to set bus bitrate, [Error Code: {error_code}]",
+                f"Error encountered whilst trying to set bus filters, [Error Code: {error_code}]",
             )
-        error_code = _CANLIB.canSetFilterMode(self._Handle, c_int(4))
-        if error_code != NTCAN_SUCCESS:
+        stage_start = self._time_stage("filter", stage_start)
+
+        if self._dual_handle:
+            # the transmit handle never receives, so it shares the events of the receive handle
+            try:
+                self._open_handle(self._tx_handle, errors, False, tx_timeout, rx_timeout, "R1", "E1")
+            except CanInitializationError:
+                self._close_handles()
+                raise
+            # standard filter mode with no identifiers enabled, so the receive queue of the transmit handle stays empty
+            error_code = self._lib.canSetFilterMode(self._tx_handle, c_int(0))
+            if error_code != NTCAN_SUCCESS:
+                self._close_handles()
+                raise CanInitializationError(
+                    f"Error encountered whilst trying to set transmit handle filters, [Error Code: {error_code}]",
+                )
+            self._time_stage("tx_handle", stage_start)
+
+    def _attach_to_running_net(self) -> bool:
+        """
+        Checks whether another application already owns the net at the requested bitrate, in which case it has been
+        initialised and setting the bitrate again is redundant. The status is only read when another application
+        owns the net, and is kept to provide the revisions for :attr:`device_info`.
+
+        :raises CanInitializationError: If another application owns the net at a different bitrate
+        :return: Whether the bitrate can be left as it is
+        """
+        stage_start = time.perf_counter()
+        self.net_owner = self._lib.canIsNetOwner(self._Handle) == NTCAN_SUCCESS
+        if self.net_owner:
+            # the first handle opened on a net owns it, so the net has not been initialised yet
+            self._time_stage("status", stage_start)
+            return False
+        try:
+            status = self.get_status()
+        except CanOperationError as COE:
+            log.debug("Device status not available, setting the bitrate: %s", COE)
+            return False
+        self._attach_status = status
+        self._time_stage("status", stage_start)
+
+        if status.w_baud != self._canfox_bitrate:
+            self._close_handles()
             raise CanInitializationError(
-                f"Error encountered whilst trying to set bus filters, [Error Code: {error_code}]",
+                f"Net {int(self.channel)} is owned by another application with bitrate index {status.w_baud}, "
+                f"which differs from the requested bitrate index {self._canfox_bitrate}",
             )
+        log.info("Attached to net %s, which is already running at the requested bitrate", int(self.channel))
+        return True
 
-        self._bus_pc_start_time_s = round(time.time(), 4)
-        self._bus_hw_start_timestamp = canGetSystemTime() / 10000
+    def _read_device_info(self) -> DeviceInfo:
+        """
+        Reads the serial number of the device, and its revisions unless the device cache holds them for this adapter
+        or the status was already read by fast attach. Revisions that are read are recorded in the device cache.
+
+        :raises CanOperationError: If the MT_API returns an error whilst reading the device status
+        """
+        net = int(self.channel)
+        serial_high = c_ulong()
+        serial_low = c_ulong()
+        error_code = self._lib.canGetHWSerialNumber(self._Handle, byref(serial_high), byref(serial_low))
+        serial_number = (serial_high.value << 32) | serial_low.value if error_code == NTCAN_SUCCESS else None
+        caching = self._device_cache is not None and serial_number is not None
+
+        status = self._attach_status
+        if status is None:
+            cached = self._device_cache.lookup(net, serial_number) if caching else None
+            if cached is not None:
+                return cached
+            status = self.get_status()
+        info = DeviceInfo(net, serial_number, **revisions_from_status(status))
+
+        if caching:
+            previous = self._device_cache.store(info)
+            if previous is not None and previous.serial_number == serial_number and previous != info:
+                log.info("The revisions of adapter %X have changed from %s to %s", serial_number, previous, info)
+        return info
+
+    @property
+    def device_info(self) -> DeviceInfo:
+        """
+        The serial number (None if the device cannot report it) and the hardware, firmware, driver and DLL revisions
+        of the device, read when first requested.
+
+        :raises CanOperationError: If the MT_API returns an error whilst reading the device status
+        :rtype: DeviceInfo
+        """
+        if self._device_info is None:
+            self._device_info = self._read_device_info()
+        return self._device_info
+
+    def _restart_controller(self):
+        """
+        Restarts the CAN controller after a bus-off, by setting the cached bitrate again on the open handle.
+
+        :raises CanOperationError: If the MT_API returns an error whilst setting the bitrate
+        """
+        error_code = self._lib.canSetBaudrate(self._Handle, c_int(self._canfox_bitrate))
+        if error_code != NTCAN_SUCCESS:
+            raise CanOperationError(
+                f"Error encountered whilst trying to restart the controller, [Error Code: {error_code}]",
+            )
+
+    def _reopen(self):
+        """
+        Closes the channel and opens it again with the cached configuration. The time base, the clock sync
+        registration, batch listeners and periodic tasks of the bus are kept, as are frames already read from the
+        driver that :meth:`recv` has not returned yet.
+
+        :raises CanInitializationError: If the channel cannot be opened, e.g. the adapter is still unplugged
+        """
+        self._close_handles()
+        self._device_info = None  # the adapter may have been replaced
+        self._attach_status = None
+        self._open_channel(*self._open_args)
+        if self.clock is not None:
+            # the CAN timer restarts when the adapter is plugged back in
+            self.clock.restart()
+
+    def _restart_periodic_tasks(self):
+        """Restarts periodic tasks that stopped because a send failed before the recovery started"""
+        for task in self._periodic_tasks:
+            if getattr(task, "stopped", False):
+                task.start()
+
+    def _send_record(self, msg_struct):
+        entries = self.tx_tracker.sent(msg_struct) if self.tx_tracker is not None else None
+        error_code = self._lib.canSend(self._tx_handle, byref(msg_struct), byref(c_long(1)))
+        if error_code != NTCAN_SUCCESS:
+            if entries:
+                self.tx_tracker.discard(entries)
+            raise CanOperationError(
+                f"Error encountered whilst trying to write to bus, [Error Code: {error_code}]",
+            )
+
+    @property
+    def recovery_metrics(self) -> dict:
+        """
+        The recovery counts, times and buffered frames when ``auto_recover`` is enabled, otherwise an empty dict.
+
+        :rtype: dict
+        """
+        return {} if self.recovery is None else self.recovery.metrics()
+
+    def _start_clock_sync(self, clock_sync: ClockSync) -> None:
+        """
+        Registers the CAN timer of the device with a clock sync service, so that frames are timestamped on the
+        timeline shared by every bus registered with it. If the device cannot report its CAN timer, the bus keeps its
+        own time base.
+        """
+        base_ns = c_ulong()
+        error_code = self._lib.canGetDeviceTimestampBase(c_long(int(self.channel)), byref(base_ns))
+        tick_seconds = base_ns.value / 1e9 if error_code == NTCAN_SUCCESS else None
+        if tick_seconds is not None and not math.isclose(tick_seconds, TICK_SECONDS):
+            # every frame of a batch is placed on the timeline as time_offset + ul_tstamp / 10000, which only holds
+            # for the 100 us CAN timer
+            log.warning(
+                "Clock sync is not available for a CAN timer of %s s ticks, using the time base of this bus",
+                tick_seconds,
+            )
+            return
+        try:
+            self.clock = clock_sync.register(f"net {int(self.channel)}", self._read_sync_timer, tick_seconds)
+        except CanOperationError as COE:
+            log.warning("Clock sync is not available, using the time base of this bus: %s", COE)
+            return
+        self._clock_sync = clock_sync
+        self._time_offset = self.clock.time_offset(self.clock.latest_tick)
+
+    def _read_sync_timer(self):
+        """
+        :raises CanOperationError: If the MT_API returns an error whilst reading the CAN timer
+        :return: The CAN timer of the device, and the host performance counter value latched with it
+        :rtype: tuple
+        """
+        timer = c_ulong()
+        perf_counter = c_longlong()
+        error_code = self._lib.canGetSyncTimer(self._Handle, byref(timer), byref(perf_counter))
+        if error_code != NTCAN_SUCCESS:
+            raise CanOperationError(
+                f"Error encountered whilst trying to read the CAN timer, [Error Code: {error_code}]",
+            )
+        return timer.value, perf_counter.value
 
     @property
     def state(self):
@@ -206,10 +554,49 @@ class SontheimBus(BusABC):
 
     def shutdown(self):
         super().shutdown()
-        _CANLIB.canClose(self._Handle)
+        if self.level_monitor is not None:
+            self.level_monitor.stop()
+        if self.clock is not None:
+            self._clock_sync.unregister(self.clock)
+            self.clock = None
+        for listener in self._batch_listeners:
+            listener.stop()
+        self._close_handles()
+
+    def _close_handles(self) -> None:
+        """
+        Closes the driver handles that are open. A closed handle is cleared, so it is never closed twice, e.g. when
+        a bus that failed to open is shut down again by the garbage collector.
+        """
+        for handle in (self._tx_handle, self._Handle) if self._dual_handle else (self._Handle,):
+            if handle.value:
+                self._lib.canClose(handle)
+                handle.value = None
 
-    def _recv_internal(self, timeout):
+    def add_batch_listener(self, listener: BatchListener) -> None:
+        """
+        Registers a listener that is called with every raw batch of frames read from the driver.
+
+        :param listener: The batch listener to add
+        :type listener: BatchListener
+        """
+        self._batch_listeners.append(listener)
+
+    def remove_batch_listener(self, listener: BatchListener) -> None:
+        """
+        Removes a batch listener previously added with :meth:`add_batch_listener`.
+
+        :raises ValueError: If the listener is not registered with the bus
+        """
+        self._batch_listeners.remove(listener)
+
+    def _read_batch(self, msg_buffer, msg_buffer_length: int, timeout) -> int:
+        """
+        Reads up to ``msg_buffer_length`` frames from the driver into ``msg_buffer``, waiting up to ``timeout``
+        seconds for the first frame to arrive, and passes the batch to any registered batch listeners.
 
+        :return: The number of frames read, which is zero if the timeout expired
+        """
         if HAS_EVENTS:
             # We will utilize events for the timeout handling
             timeout_ms = int(timeout * 1000) if timeout is not None else INFINITE
@@ -217,44 +604,84 @@ class SontheimBus(BusABC):
             # Calculate max time
             end_time = time.perf_counter() + timeout
 
-        log.debug("Trying to read a msg")
+        tuner = self.rx_tuner
+        poll_interval = 0.001 if tuner is None else tuner.poll_interval
 
-        msg_struct = CANMsgStruct()
+        msg_return_count = c_long(msg_buffer_length)
         error_code = None
         while error_code is None:
-            error_code = _CANLIB.canReadNoWait(self._Handle, byref(msg_struct), byref(c_long(1)))
+            msg_return_count.value = msg_buffer_length
+            error_code = self._lib.canReadNoWait(self._Handle, byref(msg_buffer), byref(msg_return_count))
             if error_code == NTCAN_RX_TIMEOUT:
+                if tuner is not None:
+                    tuner.update(0)
+                if timeout == 0:
+                    return 0
                 if HAS_EVENTS:
                     error_code = None
                     val = WaitForSingleObject(self._receive_event, timeout_ms)
                     if val != WAIT_OBJECT_0:
-                        return None, False
+                        return 0
+                    if tuner is not None and tuner.coalescing:
+                        # let more frames arrive so they are read as one batch
+                        time.sleep(tuner.poll_interval)
                 elif timeout is not None and time.perf_counter() >= end_time:
-                    return None, False
+                    return 0
                 else:
                     error_code = None
-                    time.sleep(0.001)
+                    time.sleep(poll_interval)
+            elif error_code in RECOVERABLE_ERRORS and self.recovery is not None:
+                self.recovery.trigger(error_code)
+                if not self.recovery.wait(timeout):
+                    self.recovery.check()  # still recovering when the timeout expired, unless the recovery failed
+                return 0
             elif error_code != NTCAN_SUCCESS:
                 raise CanOperationError(
-                    "Error encountered whilst trying to read bus, [Error Code: {error_code}]",
+                    f"Error encountered whilst trying to read bus, [Error Code: {error_code}]",
                 )
 
-        log.debug("Received a message")
+        count = msg_return_count.value
+        log.debug("Received %s message(s)", count)
+
+        if self.clock is not None and count:
+            # follow the skew of the CAN timer, using the newest frame of the batch
+            self._time_offset = self.clock.time_offset(msg_buffer.msgs[count - 1].ul_tstamp)
+
+        if tuner is not None:
+            msgs = msg_buffer.msgs
+            if HAS_NUMPY:
+                lost = bool(count) and bool(as_array(msgs, count)["by_msg_lost"].any())
+            else:
+                lost = any(msgs[i].by_msg_lost for i in range(count))
+            tuner.update(count, lost=lost)
+
+        if count and self._batch_listeners:
+            if self.profiler is not None:
+                start = perf_counter_ns()
+            time_offset = self._time_offset
+            for listener in self._batch_listeners:
+                listener.on_batch(msg_buffer.msgs, count, time_offset)
+            if self.profiler is not None:
+                self.profiler.record_stage("batch_listeners", perf_counter_ns() - start)
+        return count
+
+    def _decode_msg_struct(self, msg_struct) -> dict:
 
         # remove bits 4 to 7 as these are reserved for other functionality
         dlc = int(msg_struct.by_len & 0x0F)
 
         # Use the starting timestamp
-        timestamp = self._bus_pc_start_time_s + (int(msg_struct.ul_tstamp) / 10000) - self._bus_hw_start_timestamp
+        timestamp = self._time_offset + int(msg_struct.ul_tstamp) / 10000
 
         frame_info = msg_struct.by_extended
 
-        rx_msg = Message(
+        return dict(
             timestamp=timestamp,
             arbitration_id=msg_struct.l_id,
             is_extended_id=frame_info & 2,
             is_remote_frame=msg_struct.by_remote & 1,
             is_error_frame=frame_info & 64,
+            is_rx=not frame_info & ECHO_FLAG,
             dlc=dlc,
             data=msg_struct.aby_data,
             is_fd=False,
@@ -262,54 +689,340 @@ class SontheimBus(BusABC):
             # error_state_indicator=error_state_indicator,
         )
 
-        return rx_msg, False
+    def _msg_struct_to_message(self, msg_struct) -> Message:
+        return Message(**self._decode_msg_struct(msg_struct))
 
-    def _recv_multiple(self, msg_buffer_length=20) -> list:
+    def _msg_structs_to_messages(self, msgs, start: int, count: int) -> list:
+        """
+        Converts the frames ``start`` to ``count`` of a raw batch to messages, timing the decode and Message
+        construction stages when profiling is enabled.
+        """
+        if self._consume_echo:
+            indices = [i for i in range(start, count) if not msgs[i].by_extended & ECHO_FLAG]
+        else:
+            indices = range(start, count)
+        if self.profiler is None:
+            return [self._msg_struct_to_message(msgs[i]) for i in indices]
+
+        record_stage = self.profiler.record_stage
+        messages = []
+        for i in indices:
+            t0 = perf_counter_ns()
+            fields = self._decode_msg_struct(msgs[i])
+            t1 = perf_counter_ns()
+            messages.append(Message(**fields))
+            t2 = perf_counter_ns()
+            record_stage("decode", t1 - t0)
+            record_stage("message_construction", t2 - t1)
+        return messages
 
-        log.debug("Trying to read multiple messages")
+    def _recv_internal(self, timeout):
 
-        msg_return_count = c_long(msg_buffer_length)
-        msg_buffer = CANMsgBuffer(msg_buffer_length)
-        error_code = None
-        while error_code is None:
-            error_code = _CANLIB.canReadNoWait(self._Handle, byref(msg_buffer), byref(msg_return_count))
-            if error_code != NTCAN_SUCCESS:
-                raise CanOperationError(
-                    "Error encountered whilst trying to read bus, [Error Code: {error_code}]",
-                )
+        # Frames left over from the last batch are returned before reading from the driver again
+        if self._rx_pending:
+            return self._rx_pending.popleft(), False
+
+        log.debug("Trying to read a msg")
+
+        if self.rx_tuner is not None:
+            self._apply_tuning()
+
+        count = self._read_batch(self._rx_buffer, self._rx_buffer_length, timeout)
+        if not count:
+            return None, False
 
-        log.debug("Received %s message(s)", msg_return_count)
-
-        message_list = []
-        for i in range(msg_return_count.value):
-            msg_struct = msg_buffer.msgs[i]
-            # remove bits 4 to 7 as these are reserved for other functionality
-            dlc = int(msg_struct.by_len & 0x0F)
-
-            # Use the starting timestamp
-            timestamp = self._bus_pc_start_time_s + (int(msg_struct.ul_tstamp) / 10000) - self._bus_hw_start_timestamp
-
-            frame_info = msg_struct.by_extended
-
-            rx_msg = Message(
-                timestamp=timestamp,
-                arbitration_id=msg_struct.l_id,
-                is_extended_id=frame_info & 2,
-                is_remote_frame=msg_struct.by_remote & 1,
-                is_error_frame=frame_info & 64,
-                dlc=dlc,
-                data=msg_struct.aby_data,
-                is_fd=False,
-                # bitrate_switch=bitrate_switch,
-                # error_state_indicator=error_state_indicator,
+        messages = self._msg_structs_to_messages(self._rx_buffer.msgs, 0, count)
+        if not messages:
+            # the batch only held echoes, which are consumed
+            return None, False
+        self._rx_pending.extend(messages[1:])
+        return messages[0], False
+
+    def _apply_tuning(self) -> None:
+        """
+        Resizes the receive buffer to the batch size chosen by the adaptive tuner, and feeds it a bus load reading
+        every ``busload_interval`` seconds where the device supports it.
+        """
+        batch_size = self.rx_tuner.batch_size
+        if batch_size > len(self._rx_buffer.msgs):
+            self._rx_buffer = CANMsgBuffer(batch_size)  # the buffer only grows, up to the tuner's maximum size
+        self._rx_buffer_length = batch_size
+
+        if self._busload_interval and time.perf_counter() >= self._next_busload_time:
+            self._next_busload_time = time.perf_counter() + self._busload_interval
+            try:
+                self.rx_tuner.update_busload(self.get_busload(), self._bitrate)
+            except CanOperationError:
+                log.debug("Bus load not available on this device, tuning from frame counts only")
+                self._busload_interval = None
+
+    @property
+    def receive_metrics(self) -> dict:
+        """
+        The receive batch size and poll interval in use, and when adaptive batching is enabled the statistics they
+        were chosen from.
+
+        :rtype: dict
+        """
+        if self.rx_tuner is None:
+            return {"batch_size": self._rx_buffer_length, "poll_interval": 0.001}
+        return self.rx_tuner.metrics()
+
+    def hardware_time(self) -> float:
+        """
+        Reads the CAN timer of the device, on the same time base as the timestamps of received frames, so that it can
+        be compared with them without the drift of the host clock.
+
+        :raises CanOperationError: If the MT_API returns an error whilst reading the CAN timer
+        :return: The current time of the device in seconds
+        :rtype: float
+        """
+        return self._time_offset + canGetSystemTime(self._lib) / 10000
+
+    def get_busload(self) -> float:
+        """
+        Reads the current bus load measured by the device.
+
+        :raises CanOperationError: If the MT_API returns an error whilst reading the bus load
+        :return: The bus load in percent
+        :rtype: float
+        """
+        busload_struct = CANBusLoadStruct()
+        error_code = self._lib.canGetBusloadExtended(self._Handle, byref(busload_struct))
+        if error_code != NTCAN_SUCCESS:
+            raise CanOperationError(
+                f"Error encountered whilst trying to read the bus load, [Error Code: {error_code}]",
+            )
+        return busload_struct.ul_load / 100
+
+    def get_status(self):
+        """
+        Reads the hardware, firmware and driver revisions, the board status and the bitrate index of the device.
+
+        :raises CanOperationError: If the MT_API returns an error whilst reading the status
+        :return: The fields of :class:`~can_sontheim.structures.CANStatusStruct` as a named tuple
+        """
+        status_struct = CANStatusStruct()
+        error_code = self._lib.canStatus(self._Handle, byref(status_struct))
+        if error_code != NTCAN_SUCCESS:
+            raise CanOperationError(
+                f"Error encountered whilst trying to read the device status, [Error Code: {error_code}]",
+            )
+        return struct_decoder(CANStatusStruct)(status_struct)
+
+    def get_counters(self):
+        """
+        Reads the frame and error counters of the device.
+
+        :raises CanOperationError: If the MT_API returns an error whilst reading the counters
+        :return: The fields of :class:`~can_sontheim.structures.CANCounterStruct2` as a named tuple
+        """
+        counter_struct = CANCounterStruct2()
+        error_code = self._lib.canGetCounterExtended(self._Handle, byref(counter_struct))
+        if error_code != NTCAN_SUCCESS:
+            raise CanOperationError(
+                f"Error encountered whilst trying to read the device counters, [Error Code: {error_code}]",
+            )
+        return struct_decoder(CANCounterStruct2)(counter_struct)
+
+    def get_level_histogram(self, reset: bool = False):
+        """
+        Reads the passive CAN level measurement of the device. The first call starts the measurement, which samples
+        the levels roughly every 5 ms while there is traffic on the bus. Only adapters fitted with CAN level
+        measurement support this.
+
+        :param reset: Whether to clear the accumulated measurements
+        :raises CanOperationError: If the MT_API returns an error whilst reading the levels
+        :return: The fields of :class:`~can_sontheim.structures.CANLevelHistStruct` as a named tuple
+        """
+        histogram_struct = CANLevelHistStruct()
+        error_code = self._lib.canGetCanLevelHist(self._Handle, c_bool(reset), byref(histogram_struct))
+        if error_code != NTCAN_SUCCESS:
+            raise CanOperationError(
+                f"Error encountered whilst trying to read the CAN levels, [Error Code: {error_code}]",
+            )
+        return struct_decoder(CANLevelHistStruct)(histogram_struct)
+
+    def measure_can_level(self, dominant: bool = True, arbitration_id: int = 0x7FF) -> tuple:
+        """
+        Actively measures the CAN levels with ``canGetCanLevel``. A dominant measurement transmits
+        ``arbitration_id`` at a different bitrate, which causes error frames on the bus and may put other ECUs into
+        an error state, so prefer :meth:`start_level_monitor` on a live bus.
+
+        :param dominant: Whether to measure the dominant rather than the recessive level
+        :param arbitration_id: The 11 bit identifier sent for a dominant measurement
+        :raises CanOperationError: If the MT_API returns an error whilst measuring the levels
+        :return: The CAN LOW and CAN HIGH levels in V
+        :rtype: tuple
+        """
+        level_low = c_double()
+        level_high = c_double()
+        error_code = self._lib.canGetCanLevel(
+            self._Handle, c_long(0 if dominant else 1), c_long(arbitration_id), byref(level_low), byref(level_high)
+        )
+        if error_code != NTCAN_SUCCESS:
+            raise CanOperationError(
+                f"Error encountered whilst trying to measure the CAN levels, [Error Code: {error_code}]",
             )
+        return level_low.value, level_high.value
+
+    def start_level_monitor(self, interval: float = 5.0, **kwargs) -> LevelMonitor:
+        """
+        Starts monitoring the physical layer in the background with the passive CAN level measurement of the device.
+        The monitor is stopped when the bus is shut down.
+
+        :param interval: The time in seconds between samples
+        :param kwargs: Passed to :class:`~can_sontheim.monitor.LevelMonitor`, e.g. warning limits and a callback
+        :raises CanOperationError: If the device does not support CAN level measurement
+        :raises ImportError: If NumPy is not installed
+        :return: The running monitor, also available as ``bus.level_monitor``
+        :rtype: LevelMonitor
+        """
+        if self.level_monitor is None:
+            monitor = LevelMonitor(self.get_level_histogram, interval=interval, **kwargs)
+            monitor.start()
+            self.level_monitor = monitor
+        return self.level_monitor
 
-            message_list.append(rx_msg)
+    def _recv_multiple(self, msg_buffer_length=None) -> list:
+
+        log.debug("Trying to read multiple messages")
+
+        if msg_buffer_length is None:
+            if self.rx_tuner is not None:
+                self._apply_tuning()
+            msg_buffer_length = self._rx_buffer_length
+
+        message_list = list(self._rx_pending)
+        self._rx_pending.clear()
+
+        if msg_buffer_length <= len(self._rx_buffer.msgs):
+            msg_buffer = self._rx_buffer
+        else:
+            msg_buffer = CANMsgBuffer(msg_buffer_length)
+        count = self._read_batch(msg_buffer, msg_buffer_length, 0)
+        message_list.extend(self._msg_structs_to_messages(msg_buffer.msgs, 0, count))
 
         return message_list, False
 
     def send(self, msg, timeout=None):
 
+        if self.profiler is None:
+            msg_struct = self._encode_message(msg)
+        else:
+            start = perf_counter_ns()
+            msg_struct = self._encode_message(msg)
+            self.profiler.record_stage("encode", perf_counter_ns() - start)
+
+        error_code = self._send_struct(msg_struct)
+        if error_code == NTCAN_TX_TIMEOUT:
+            raise CanTimeoutError("Timeout whilst attempting to send message")
+        if error_code != NTCAN_SUCCESS:
+            raise CanOperationError(
+                f"Error encountered whilst trying to write to bus, [Error Code: {error_code}]",
+            )
+
+    def _send_struct(self, msg_struct, reused: bool = False) -> int:
+        """
+        Sends a CMSG record, tracking it for confirmation and holding it in the recovery backlog whilst the bus is
+        recovering.
+
+        :param reused: Whether the record is changed after the call, as a prepared frame is, so it is copied into
+            the backlog
+        :raises CanOperationError: If the bus could not be recovered
+        :return: The error code of ``canSend``, or NTCAN_SUCCESS if the record was added to the backlog
+        """
+        if self.recovery is not None:
+            self.recovery.check()
+            if self._buffer(msg_struct, reused):
+                return NTCAN_SUCCESS
+
+        # the frame is recorded before it is sent, as its echo can be read before canSend returns
+        entries = self.tx_tracker.sent(msg_struct) if self.tx_tracker is not None else None
+        # error_code = self._lib.canConfirmedTransmit(self._Handle, byref(msg_struct), byref(c_long(1)))
+        error_code = self._lib.canSend(self._tx_handle, byref(msg_struct), byref(c_long(1)))
+
+        if error_code in RECOVERABLE_ERRORS and self.recovery is not None:
+            self.recovery.trigger(error_code)
+            if self._buffer(msg_struct, reused):
+                # sent from the backlog once the bus has recovered
+                if entries:
+                    self.tx_tracker.discard(entries)
+                return NTCAN_SUCCESS
+            self.recovery.check()
+            error_code = self._lib.canSend(self._tx_handle, byref(msg_struct), byref(c_long(1)))
+        if error_code != NTCAN_SUCCESS and entries:
+            self.tx_tracker.discard(entries)
+        return error_code
+
+    def _buffer(self, msg_struct, reused: bool) -> bool:
+        """Adds a record to the recovery backlog if the bus is recovering, returning whether it was added"""
+        if not self.recovery.recovering:
+            return False
+        return self.recovery.buffer(CANMsgStruct.from_buffer_copy(msg_struct) if reused else msg_struct)
+
+    def prepare_frame(self, msg) -> PreparedFrame:
+        """
+        Encodes a message once, for sending repeatedly without the conversion and allocation of :meth:`send`.
+
+        With ``auto_recover`` or ``track_tx`` enabled the frame is sent through the recovery backlog and the transmit
+        tracker, as :meth:`send` does, which costs a little of the time saved.
+
+        :param msg: The message to prepare. Its data bytes are the initial payload of the prepared frame.
+        :return: A :class:`PreparedFrame`, whose payload can be updated in place through its ``data`` memoryview
+        :rtype: PreparedFrame
+        """
+        msg_struct = self._encode_message(msg)
+        if self.recovery is None and self.tx_tracker is None:
+            return PreparedFrame(self._lib.canSend, self._tx_handle, msg_struct)
+
+        def send_function(handle, msg_ref, count_ref):  # pylint: disable=unused-argument
+            return self._send_struct(msg_struct, reused=True)
+
+        return PreparedFrame(send_function, self._tx_handle, msg_struct)
+
+    def send_batch(self, msgs, count: int, start: int = 0) -> int:
+        """
+        Queues a run of prepared CMSG records for transmission with a single ``canSend`` call.
+
+        :param msgs: A ctypes array of :class:`CANMsgStruct`, e.g. the ``msgs`` field of a :func:`CANMsgBuffer`
+        :param count: The number of records to send
+        :param start: The index of the first record to send
+        :raises CanOperationError:
+            If the MT_API returns an error other than a transmit timeout, or the bus could not be recovered
+        :return:
+            The number of records queued, which is less than ``count`` if the transmit buffer filled up before the
+            transmit timeout expired, and zero whilst the bus is recovering
+        :rtype: int
+        """
+        if self.recovery is not None:
+            self.recovery.check()
+            if self.recovery.recovering:
+                return 0
+        sent = c_long(count)
+        entries = self.tx_tracker.sent_batch(msgs, start, count) if self.tx_tracker is not None else None
+        error_code = self._lib.canSend(self._tx_handle, byref(msgs[start]), byref(sent))
+        if entries:
+            accepted = sent.value if error_code in (NTCAN_SUCCESS, NTCAN_TX_TIMEOUT) else 0
+            if accepted < count:
+                self.tx_tracker.discard(entries[accepted:])
+        if error_code in RECOVERABLE_ERRORS and self.recovery is not None:
+            self.recovery.trigger(error_code)
+            return 0
+        if error_code not in (NTCAN_SUCCESS, NTCAN_TX_TIMEOUT):
+            raise CanOperationError(
+                f"Error encountered whilst trying to write to bus, [Error Code: {error_code}]",
+            )
+        return sent.value
+
+    @property
+    def bitrate(self) -> int:
+        """The bitrate of the bus in bit/s"""
+        return self._bitrate
+
+    @staticmethod
+    def _encode_message(msg) -> CANMsgStruct:
+
         assert msg.dlc <= 8
 
         msg_struct = CANMsgStruct()
@@ -330,15 +1043,7 @@ class SontheimBus(BusABC):
         for i in range(msg.dlc):
             msg_struct.aby_data[i] = msg.data[i]
 
-        # error_code = _CANLIB.canConfirmedTransmit(self._Handle, byref(msg_struct), byref(c_long(1)))
-        error_code = _CANLIB.canSend(self._Handle, byref(msg_struct), byref(c_long(1)))
-
-        if error_code == NTCAN_TX_TIMEOUT:
-            raise CanTimeoutError("Timeout whilst attempting to send message")
-        if error_code != NTCAN_SUCCESS:
-            raise CanOperationError(
-                "Error encountered whilst trying to write to bus, [Error Code: {error_code}]",
-            )
+        return msg_struct
 
     def flush_tx_buffer(self):
         """
@@ -368,7 +1073,7 @@ class SontheimBus(BusABC):
                 "The flush_tx_buffer method is only available on the sontheim CANUSB interface"
             ) from AE
 
-        error_code = _CANLIB.canFlush(self._Handle, c_long(10000))  # ten second timeout
+        error_code = self._lib.canFlush(self._tx_handle, c_long(10000))  # ten second timeout
 
         if error_code == NTCAN_TX_TIMEOUT:
             raise CanTimeoutError("Timeout whilst attempting to flush TX buffer")
@@ -386,10 +1091,10 @@ class SontheimBus(BusABC):
         """
 
         for i in range(int(blink_length_s / 0.25) + 1):
-            _CANLIB.canBlinkLED(self._Handle, 1, i % 2, 5)
+            self._lib.canBlinkLED(self._Handle, 1, i % 2, 5)
             time.sleep(0.25)
 
-        error_code = _CANLIB.canBlinkLED(self._Handle, 0, i % 2, 5)
+        error_code = self._lib.canBlinkLED(self._Handle, 0, i % 2, 5)
         if error_code != NTCAN_SUCCESS:
             raise CanOperationError(
                 "Error encountered whilst trying to flash adpter LEDs, [Error Code: {error_code}]",
@@ -400,7 +1105,8 @@ class SontheimBus(BusABC):
         Clears the receive buffer in the attached CAN peripheral
         :raises CanOperationError: If an error was encountered trying to clear the buffer
         """
-        error_code = _CANLIB.canClearBuffer(self._Handle)
+        self._rx_pending.clear()
+        error_code = self._lib.canClearBuffer(self._Handle)
         if error_code != NTCAN_SUCCESS:
             raise CanOperationError(
                 "Error encountered whilst trying to clear the RX buffer, [Error Code: {error_code}]",
@@ -412,9 +1118,8 @@ class SontheimBus(BusABC):
             devices_struct = CANInstalledDevicesStruct()
             error_code = _CANLIB.canGetDeviceList(byref(devices_struct))
             if error_code == NTCAN_SUCCESS:
-                _devices = read_struct_as_dict(devices_struct)
-                if _devices:
-                    return [{"interface": "sontheim", "channel": _devices["Net"]}]
+                _devices = struct_decoder(CANInstalledDevicesStruct)(devices_struct)
+                return [{"interface": "sontheim", "channel": _devices.Net}]
             return []
         except AttributeError:
             # An AttributeError is raised when run on a 64 bit system even though the bus is not avalable
@@ -0,0 +1,81 @@
+"""
+Raw receive batch consumers for the SIE / IFM CANfox interface
+
+Copyright (C) 2022 Matt Woodhead
+"""
+
+from can.message import Message
+
+from .structures import CANMsgStruct
+
+try:
+    import numpy as np
+
+    HAS_NUMPY = True
+    CMSG_DTYPE = np.dtype(CANMsgStruct)  # the NumPy equivalent of the CMSG layout on this platform
+except ImportError:
+    HAS_NUMPY = False
+    CMSG_DTYPE = None
+
+
+class BatchListener:
+    """
+    Base class for objects that consume the raw CMSG batches read from the Sontheim MT_API.
+
+    Batch listeners are registered with :meth:`can_sontheim.SontheimBus.add_batch_listener` and are called from the
+    receive path each time a batch of frames is read from the driver, before any :class:`can.Message` objects are
+    constructed. The ``msgs`` array is reused for the next read, so listeners must copy anything they want to keep.
+    """
+
+    def on_batch(self, msgs, count: int, time_offset: float) -> None:
+        """
+        Called with every batch of frames read from the driver.
+
+        :param msgs: A ctypes array of :class:`~can_sontheim.structures.CANMsgStruct`
+        :param count: The number of valid frames at the start of ``msgs``
+        :param time_offset:
+            The offset in seconds to add to ``ul_tstamp / 10000`` to get a frame timestamp on the bus time base
+        """
+        raise NotImplementedError()
+
+    def stop(self) -> None:
+        """
+        Called when the bus the listener is registered with is shut down.
+        """
+
+
+def as_array(msgs, count: int):
+    """
+    Returns a zero-copy NumPy structured array view of the first ``count`` frames of a raw batch. The fields of the
+    array are those of :class:`~can_sontheim.structures.CANMsgStruct`, with ``aby_data`` as an ``(n, 8)`` uint8 array.
+    The view shares memory with the receive buffer, so it must be copied if it is kept beyond the batch callback.
+
+    :param msgs: A ctypes array of :class:`~can_sontheim.structures.CANMsgStruct`
+    :param count: The number of valid frames at the start of ``msgs``
+    :raises ImportError: If NumPy is not installed
+    """
+    if not HAS_NUMPY:
+        raise ImportError("NumPy is required to view a receive batch as an array")
+    return np.frombuffer(msgs, CMSG_DTYPE, count)
+
+
+def record_to_message(msg_struct, time_offset: float) -> Message:
+    """
+    Converts a raw CMSG record that has been kept beyond its batch callback into a :class:`can.Message`.
+
+    :param msg_struct: A :class:`~can_sontheim.structures.CANMsgStruct`
+    :param time_offset: The time offset of the batch the record was received in
+    :rtype: can.Message
+    """
+    frame_info = msg_struct.by_extended
+    return Message(
+        timestamp=time_offset + msg_struct.ul_tstamp / 10000,
+        arbitration_id=msg_struct.l_id,
+        is_extended_id=bool(frame_info & 2),
+        is_remote_frame=bool(msg_struct.by_remote & 1),
+        is_error_frame=bool(frame_info & 64),
+        is_rx=not frame_info & 128,
+        dlc=msg_struct.by_len & 0x0F,
+        data=bytes(msg_struct.aby_data),
+        is_fd=False,
+    )
@@ -0,0 +1,248 @@
+"""
+Round-trip latency and throughput measurement tool for the SIE / IFM CANfox interface
+
+Qualifies an adapter and host PC by measuring:
+
+- the send to echo round-trip latency, using the echo option of the MT_API, and on a Sontheim bus the time to the
+  hardware timestamp of the echo, measured against the CAN timer of the adapter
+- the maximum sustained transmit and receive frame rates
+- the receive frame rate over a sweep of receive batch sizes
+
+Run ``python -m can_sontheim.bench --help`` for the options. ``--interface virtual`` runs the same measurements
+against the python-can virtual bus, so the tool can be tried without an adapter.
+
+Copyright (C) 2022 Matt Woodhead
+"""
+
+import argparse
+import json
+import math
+import statistics
+import sys
+import threading
+import time
+
+import can
+from can import Message
+
+from .devices import CANfox
+
+
+BENCH_ID = 0x7E5
+
+_TESTS = ("latency", "throughput", "sweep")
+
+
+def summarize(samples: list) -> dict:
+    """
+    :param samples: A list of durations in seconds
+    :return: The count, mean, minimum, maximum and 50th, 90th, 99th and 99.9th percentiles of the samples
+    :rtype: dict
+    """
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def percentile(fraction):
+        return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+    return {
+        "count": len(ordered),
+        "mean": statistics.mean(ordered),
+        "min": ordered[0],
+        "p50": percentile(0.5),
+        "p90": percentile(0.9),
+        "p99": percentile(0.99),
+        "p99.9": percentile(0.999),
+        "max": ordered[-1],
+    }
+
+
+def _is_echo(msg, sequence: int) -> bool:
+    return msg.arbitration_id == BENCH_ID and msg.dlc == 8 and int.from_bytes(msg.data[:4], "little") == sequence
+
+
+def measure_latency(bus, count: int = 1000, timeout: float = 1.0) -> dict:
+    """
+    Sends ``count`` frames one at a time and waits for the echo of each.
+
+    :param bus: A bus with echo enabled, so that transmitted frames are received back
+    :return:
+        ``round_trip``, the host time from calling ``send`` to receiving the echo, and ``send_to_bus``, the time from
+        reading the CAN timer before calling ``send`` to the hardware timestamp of the echo. Both are summaries of
+        the samples in seconds. ``send_to_bus`` is only measured on buses that can read their hardware clock, i.e.
+        :meth:`~can_sontheim.SontheimBus.hardware_time`, as the host clock drifts from it.
+    :rtype: dict
+    """
+    hardware_time = getattr(bus, "hardware_time", None)
+    round_trip = []
+    send_to_bus = []
+    lost = 0
+    for sequence in range(count):
+        msg = Message(arbitration_id=BENCH_ID, is_extended_id=False, data=sequence.to_bytes(4, "little") + bytes(4))
+        sent_hardware = hardware_time() if hardware_time is not None else None
+        sent = time.perf_counter()
+        bus.send(msg)
+        deadline = sent + timeout
+        while True:
+            echo = bus.recv(max(0.0, deadline - time.perf_counter()))
+            if echo is None:
+                lost += 1
+                break
+            if _is_echo(echo, sequence):
+                round_trip.append(time.perf_counter() - sent)
+                if sent_hardware is not None:
+                    send_to_bus.append(echo.timestamp - sent_hardware)
+                break
+    return {"round_trip": summarize(round_trip), "send_to_bus": summarize(send_to_bus), "lost": lost}
+
+
+def measure_throughput(bus, duration: float = 5.0) -> dict:
+    """
+    Sends frames as fast as the bus accepts them from one thread, whilst counting received frames on another.
+
+    :return: The transmit and receive rates in frames per second, and the number of transmit errors
+    :rtype: dict
+    """
+    msg = Message(arbitration_id=BENCH_ID, is_extended_id=False, data=bytes(8))
+    counts = {"tx": 0, "rx": 0, "tx_errors": 0}
+    end_time = time.perf_counter() + duration
+
+    def transmit():
+        while time.perf_counter() < end_time:
+            try:
+                bus.send(msg)
+                counts["tx"] += 1
+            except can.CanError:
+                counts["tx_errors"] += 1
+
+    def receive():
+        while time.perf_counter() < end_time:
+            if bus.recv(0.05) is not None:
+                counts["rx"] += 1
+
+    threads = [threading.Thread(target=transmit), threading.Thread(target=receive)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return {
+        "tx_rate": counts["tx"] / elapsed,
+        "rx_rate": counts["rx"] / elapsed,
+        "tx_errors": counts["tx_errors"],
+    }
+
+
+def sweep_batch_sizes(open_bus, batch_sizes, duration: float = 2.0) -> dict:
+    """
+    Measures the throughput with each receive batch size.
+
+    :param open_bus: Called with a batch size, returns a new bus reading with that batch size
+    :return: A dictionary of batch size to throughput results
+    :rtype: dict
+    """
+    results = {}
+    for batch_size in batch_sizes:
+        with open_bus(batch_size) as bus:
+            results[batch_size] = measure_throughput(bus, duration)
+    return results
+
+
+def _format_seconds(value) -> str:
+    return f"{value * 1e6:10.1f} us"
+
+
+def _print_summary(title: str, summary: dict) -> None:
+    print(f"  {title} ({summary['count']} samples)")
+    for key in ("mean", "min", "p50", "p90", "p99", "p99.9", "max"):
+        if key in summary:
+            print(f"    {key:>6}: {_format_seconds(summary[key])}")
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="can-sontheim-bench",
+        description="Measure round-trip latency and throughput of a Sontheim CAN interface.",
+    )
+    parser.add_argument(
+        "tests",
+        nargs="*",
+        metavar="{latency,throughput,sweep}",
+        help="The measurements to run (default: all of them)",
+    )
+    parser.add_argument(
+        "-i",
+        "--interface",
+        default="sontheim",
+        help="python-can interface, e.g. sontheim or virtual (default: %(default)s)",
+    )
+    parser.add_argument("-c", "--channel", default=None, help="The channel to open (default: CANfox CAN1)")
+    parser.add_argument("-b", "--bitrate", type=int, default=500000, help="Bitrate in bit/s (default: %(default)s)")
+    parser.add_argument("-n", "--count", type=int, default=1000, help="Latency samples (default: %(default)s)")
+    parser.add_argument(
+        "-d", "--duration", type=float, default=5.0, help="Seconds per throughput run (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--batch-sizes",
+        default="2,20,100,500",
+        help="Comma separated receive batch sizes to sweep (default: %(default)s)",
+    )
+    parser.add_argument("--json", metavar="FILE", help="Also write the results to a JSON report")
+    args = parser.parse_args(argv)
+    for test in args.tests:
+        if test not in _TESTS:
+            parser.error(f"invalid test: {test!r} (choose from {', '.join(_TESTS)})")
+    return args
+
+
+def main(argv=None) -> int:
+    args = _parse_args(argv)
+    tests = args.tests or _TESTS
+
+    if args.interface == "virtual":
+        channel = args.channel or "can-sontheim-bench"
+        options = {"receive_own_messages": True}
+    else:
+        channel = int(args.channel) if args.channel is not None else CANfox.CAN1
+        options = {"echo": True}
+
+    def open_bus(batch_size=None):
+        extra = {} if batch_size is None else {"rx_buffer_length": batch_size}
+        return can.Bus(interface=args.interface, channel=channel, bitrate=args.bitrate, **options, **extra)
+
+    report = {"interface": args.interface, "channel": str(channel), "bitrate": args.bitrate}
+    print(f"Benchmarking {args.interface} channel {channel} at {args.bitrate} bit/s")
+
+    if "latency" in tests or "throughput" in tests:
+        with open_bus() as bus:
+            if "latency" in tests:
+                report["latency"] = measure_latency(bus, args.count)
+                print(f"Latency ({report['latency']['lost']} echoes lost)")
+                _print_summary("send -> echo received", report["latency"]["round_trip"])
+                _print_summary("send -> echo hardware timestamp", report["latency"]["send_to_bus"])
+            if "throughput" in tests:
+                report["throughput"] = measure_throughput(bus, args.duration)
+                print(
+                    f"Throughput: TX {report['throughput']['tx_rate']:.0f} frames/s, "
+                    f"RX {report['throughput']['rx_rate']:.0f} frames/s, "
+                    f"{report['throughput']['tx_errors']} TX errors"
+                )
+
+    if "sweep" in tests:
+        batch_sizes = [int(size) for size in args.batch_sizes.split(",")]
+        report["sweep"] = sweep_batch_sizes(open_bus, batch_sizes, args.duration)
+        print("Batch size sweep")
+        for batch_size, result in report["sweep"].items():
+            print(f"  {batch_size:>6}: TX {result['tx_rate']:10.0f} frames/s, RX {result['rx_rate']:10.0f} frames/s")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+        print(f"Report written to {args.json}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,219 @@
+"""
+Shared memory fan-out of received traffic for the SIE / IFM CANfox interface
+
+One process owns the Sontheim bus and publishes every raw CMSG record it receives into a shared memory ring buffer
+with a :class:`SharedMemoryBroker`. Any number of other processes can then read the same traffic through a
+:class:`SontheimSharedMemoryBus`, without opening a handle of their own on the MT_API.
+
+Copyright (C) 2022 Matt Woodhead
+"""
+
+from collections import deque
+from ctypes import sizeof
+import logging
+import os
+import struct
+import time
+
+from can.bus import BusABC
+from can.exceptions import CanInitializationError, CanOperationError
+
+from .batch import BatchListener, record_to_message
+from .structures import CANMsgStruct
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+
+    HAS_SHARED_MEMORY = True
+except ImportError:
+    # multiprocessing.shared_memory was added in python 3.8
+    HAS_SHARED_MEMORY = False
+
+
+log = logging.getLogger("can.sontheim")
+
+# The ring buffer starts with a header, followed by ``capacity`` CMSG records in the layout of the current platform.
+# ``write_sequence`` is the number of records published so far. Before a batch is copied in, ``reserve_sequence`` is
+# advanced past the end of the batch, so a reader that finds records older than ``reserve_sequence - capacity`` after
+# copying them knows they may have been overwritten while it was reading.
+_HEADER = struct.Struct("<4sHHIIQQd")  # magic, version, record size, capacity, channel, write seq, reserve seq, offset
+_HEADER_SIZE = 64
+_MAGIC = b"SIEB"
+_VERSION = 1
+_WRITE_SEQUENCE_OFFSET = 16
+_RESERVE_SEQUENCE_OFFSET = 24
+_TIME_OFFSET_OFFSET = 32
+_SEQUENCE = struct.Struct("<Q")
+_TIME_OFFSET = struct.Struct("<d")
+
+RECORD_SIZE = sizeof(CANMsgStruct)
+
+_BROKER_NAMES = set()  # shared memory blocks created by brokers in this process
+
+
+class SharedMemoryBroker(BatchListener):
+    """
+    Publishes every received raw CMSG record into a named shared memory ring buffer.
+
+    The broker is a batch listener, so it is fed by whatever reads the owning bus (``recv``, a :class:`can.Notifier`
+    etc). Each batch is copied into the ring with at most two memory copies, followed by a single update of the write
+    sequence number.
+    """
+
+    def __init__(self, name: str, capacity: int = 65536, channel: int = 0, time_offset: float = 0.0):
+        """
+        :param name: The name of the shared memory block, used by consumers to attach to it
+        :param capacity: The number of records held in the ring buffer
+        :param channel: The channel of the owning bus, recorded for consumers
+        :param time_offset: The timestamp offset of the owning bus, used by consumers to timestamp frames
+        :raises ImportError: If shared memory is not available on this python version
+        """
+        if not HAS_SHARED_MEMORY:
+            raise ImportError("Shared memory fan-out requires python 3.8 or later")
+        self.name = name
+        self.capacity = capacity
+        self._shm = shared_memory.SharedMemory(name=name, create=True, size=_HEADER_SIZE + capacity * RECORD_SIZE)
+        _BROKER_NAMES.add(name)
+        self._sequence = 0
+        self._time_offset = time_offset
+        _HEADER.pack_into(self._shm.buf, 0, _MAGIC, _VERSION, RECORD_SIZE, capacity, channel, 0, 0, time_offset)
+
+    @property
+    def sequence(self) -> int:
+        """The number of records published so far"""
+        return self._sequence
+
+    def on_batch(self, msgs, count: int, time_offset: float) -> None:
+        buf = self._shm.buf
+        if time_offset != self._time_offset:
+            self._time_offset = time_offset
+            _TIME_OFFSET.pack_into(buf, _TIME_OFFSET_OFFSET, time_offset)
+        records = memoryview(msgs).cast("B")
+        if count > self.capacity:
+            # only the newest records fit in the ring
+            records = records[(count - self.capacity) * RECORD_SIZE : count * RECORD_SIZE]
+            self._sequence += count - self.capacity
+            count = self.capacity
+        start = self._sequence
+        end = start + count
+        _SEQUENCE.pack_into(buf, _RESERVE_SEQUENCE_OFFSET, end)
+
+        slot = start % self.capacity
+        first = min(count, self.capacity - slot)
+        offset = _HEADER_SIZE + slot * RECORD_SIZE
+        buf[offset : offset + first * RECORD_SIZE] = records[: first * RECORD_SIZE]
+        if first < count:
+            buf[_HEADER_SIZE : _HEADER_SIZE + (count - first) * RECORD_SIZE] = records[
+                first * RECORD_SIZE : count * RECORD_SIZE
+            ]
+
+        self._sequence = end
+        _SEQUENCE.pack_into(buf, _WRITE_SEQUENCE_OFFSET, end)
+
+    def stop(self) -> None:
+        """
+        Closes and removes the shared memory block.
+        """
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+            _BROKER_NAMES.discard(self.name)
+
+
+class SontheimSharedMemoryBus(BusABC):
+    """
+    A read only bus that receives the traffic published by a :class:`SharedMemoryBroker` in another process.
+
+    Each instance keeps its own read cursor into the ring buffer, starting at the newest record when it is created.
+    If the reader falls more than the ring capacity behind the broker, the overwritten records are skipped and
+    counted in :attr:`overruns` and :attr:`frames_lost`.
+    """
+
+    def __init__(self, channel: str, poll_interval: float = 0.001, **kwargs):
+        """
+        :param channel: The name of the shared memory block the broker publishes to
+        :param poll_interval: The time in seconds to sleep between checks for new records
+        :raises CanInitializationError: If the shared memory block does not exist or is not a broker ring buffer
+        """
+        if not HAS_SHARED_MEMORY:
+            raise CanInitializationError("Shared memory fan-out requires python 3.8 or later")
+        try:
+            self._shm = shared_memory.SharedMemory(name=channel)
+        except FileNotFoundError as FNFE:
+            raise CanInitializationError(f"No Sontheim broker is publishing to shared memory '{channel}'") from FNFE
+        if os.name == "posix" and channel not in _BROKER_NAMES:
+            # only the broker owns the block, stop the resource tracker removing it when this process exits
+            resource_tracker.unregister(self._shm._name, "shared_memory")  # pylint: disable=protected-access
+
+        magic, version, record_size, capacity, broker_channel, write_sequence, _, time_offset = _HEADER.unpack_from(
+            self._shm.buf, 0
+        )
+        if magic != _MAGIC or version != _VERSION or record_size != RECORD_SIZE:
+            self._shm.close()
+            raise CanInitializationError(f"Shared memory '{channel}' is not a compatible Sontheim broker ring buffer")
+
+        self.channel_info = f"Sontheim shared memory broker '{channel}' (net {broker_channel})"
+        self.poll_interval = poll_interval
+        self.overruns = 0
+        self.frames_lost = 0
+        self._capacity = capacity
+        self._cursor = write_sequence
+        self._pending = deque()
+        super().__init__(channel=channel, **kwargs)
+
+    def _read_records(self) -> list:
+        buf = self._shm.buf
+        write_sequence = _SEQUENCE.unpack_from(buf, _WRITE_SEQUENCE_OFFSET)[0]
+        if write_sequence == self._cursor:
+            return []
+        self._skip_overwritten(write_sequence)
+
+        start = self._cursor
+        slot = start % self._capacity
+        count = min(write_sequence - start, self._capacity - slot)
+        time_offset = _TIME_OFFSET.unpack_from(buf, _TIME_OFFSET_OFFSET)[0]
+        records = (CANMsgStruct * count).from_buffer(buf, _HEADER_SIZE + slot * RECORD_SIZE)
+        messages = [record_to_message(records[i], time_offset) for i in range(count)]
+        del records  # release the export of the shared memory buffer
+
+        # records the broker started overwriting whilst they were being read are dropped
+        reserve_sequence = _SEQUENCE.unpack_from(buf, _RESERVE_SEQUENCE_OFFSET)[0]
+        first_valid = reserve_sequence - self._capacity
+        if first_valid > start:
+            discarded = min(first_valid - start, count)
+            messages = messages[discarded:]
+            self._count_overrun(discarded)
+        self._cursor = start + count
+        return messages
+
+    def _skip_overwritten(self, write_sequence: int) -> None:
+        oldest = write_sequence - self._capacity
+        if self._cursor < oldest:
+            self._count_overrun(oldest - self._cursor)
+            self._cursor = oldest
+
+    def _count_overrun(self, lost: int) -> None:
+        self.overruns += 1
+        self.frames_lost += lost
+        log.warning("Shared memory reader overrun, %s frame(s) lost", lost)
+
+    def _recv_internal(self, timeout):
+        end_time = None if timeout is None else time.perf_counter() + timeout
+        while not self._pending:
+            self._pending.extend(self._read_records())
+            if self._pending:
+                break
+            if end_time is not None and time.perf_counter() >= end_time:
+                return None, False
+            time.sleep(self.poll_interval)
+        return self._pending.popleft(), False
+
+    def send(self, msg, timeout=None):
+        raise CanOperationError("The Sontheim shared memory bus is receive only")
+
+    def shutdown(self):
+        super().shutdown()
+        if self._shm is not None:
+            self._shm.close()
+            self._shm = None
@@ -0,0 +1,439 @@
+"""
+Pre-trigger ring capture with event triggered dumps for the SIE / IFM CANfox interface
+
+A :class:`TriggeredCapture` keeps the most recent raw CMSG records in a preallocated ring buffer and checks every
+receive batch against a set of cheap triggers. When a trigger fires, the frames before it (the pre-trigger window)
+and the frames that follow (the post-trigger window) are written to a log file by a background thread, so that
+capture carries on whilst the file is written.
+
+Copyright (C) 2022 Matt Woodhead
+"""
+
+from collections import namedtuple
+from ctypes import sizeof
+import logging
+import os
+import queue
+import threading
+import time
+
+import can
+
+from .batch import BatchListener, HAS_NUMPY, as_array, record_to_message
+from .structures import CANMsgStruct, CANMsgBuffer
+
+if HAS_NUMPY:
+    import numpy as np
+
+
+log = logging.getLogger("can.sontheim")
+
+RECORD_SIZE = sizeof(CANMsgStruct)
+
+_TICKS_PER_SECOND = 10000  # ul_tstamp counts tenths of a millisecond
+_TICK_WRAP = 2**32
+
+CaptureEvent = namedtuple("CaptureEvent", ["trigger", "timestamp", "filename", "frames"])
+
+
+class Trigger:
+    """
+    Base class of the capture triggers. A trigger matches individual frames, either one record at a time with
+    :meth:`match`, or a whole batch at once with :meth:`match_array` when NumPy is installed.
+    """
+
+    def find(self, msgs, start: int, count: int) -> int:
+        """
+        :param msgs: A ctypes array of :class:`~can_sontheim.structures.CANMsgStruct`
+        :param start: The index of the first frame to check
+        :param count: The number of valid frames at the start of ``msgs``
+        :return: The index of the first matching frame from ``start``, or -1 if no frame matches
+        :rtype: int
+        """
+        if HAS_NUMPY:
+            hits = np.flatnonzero(self.match_array(as_array(msgs, count)[start:]))
+            return start + int(hits[0]) if len(hits) else -1
+        for i in range(start, count):
+            if self.match(msgs[i]):
+                return i
+        return -1
+
+    def match(self, msg_struct) -> bool:
+        """
+        :param msg_struct: A :class:`~can_sontheim.structures.CANMsgStruct`
+        :return: Whether the frame fires the trigger
+        """
+        raise NotImplementedError()
+
+    def match_array(self, frames):
+        """
+        :param frames: A NumPy structured array of frames, as returned by :func:`~can_sontheim.batch.as_array`
+        :return: A boolean array of the frames that fire the trigger
+        """
+        raise NotImplementedError()
+
+
+class IdTrigger(Trigger):
+    """
+    Fires on a frame with the given ID, and optionally with data bytes matching a pattern.
+    """
+
+    def __init__(self, arbitration_id: int, data=None, mask=None):
+        """
+        :param arbitration_id: The CAN ID to match
+        :param data: The leading data bytes to match, or None to match any data
+        :param mask: The bits of each data byte to compare, defaults to all of them
+        """
+        self.arbitration_id = arbitration_id
+        self.data = bytes(data or b"")
+        self.mask = bytes(mask) if mask is not None else b"\xff" * len(self.data)
+        if len(self.mask) != len(self.data) or len(self.data) > 8:
+            raise ValueError("The data pattern and mask must be the same length, of at most 8 bytes")
+        self._pattern = bytes(d & m for d, m in zip(self.data, self.mask))
+
+    def match(self, msg_struct) -> bool:
+        if msg_struct.l_id != self.arbitration_id:
+            return False
+        data = msg_struct.aby_data
+        return all(data[i] & self.mask[i] == self._pattern[i] for i in range(len(self._pattern)))
+
+    def match_array(self, frames):
+        matches = frames["l_id"] == self.arbitration_id
+        if self._pattern:
+            n = len(self._pattern)
+            mask = np.frombuffer(self.mask, np.uint8)
+            pattern = np.frombuffer(self._pattern, np.uint8)
+            matches &= np.all(frames["aby_data"][:, :n] & mask == pattern, axis=1)
+        return matches
+
+    def __repr__(self) -> str:
+        return f"IdTrigger(0x{self.arbitration_id:X}, data={self.data.hex() or None})"
+
+
+class ErrorFrameTrigger(Trigger):
+    """
+    Fires on an error frame. The bus must be opened with error frames enabled.
+    """
+
+    def match(self, msg_struct) -> bool:
+        return bool(msg_struct.by_extended & 64)
+
+    def match_array(self, frames):
+        return (frames["by_extended"] & 64) != 0
+
+    def __repr__(self) -> str:
+        return "ErrorFrameTrigger()"
+
+
+class LostFrameTrigger(Trigger):
+    """
+    Fires when the driver reports that frames were lost before a frame, because its receive buffer overflowed.
+    """
+
+    def match(self, msg_struct) -> bool:
+        return msg_struct.by_msg_lost != 0
+
+    def match_array(self, frames):
+        return frames["by_msg_lost"] != 0
+
+    def __repr__(self) -> str:
+        return "LostFrameTrigger()"
+
+
+class _Dump:
+    """The records of one dump, collected until the post-trigger window is complete"""
+
+    def __init__(
+        self,
+        trigger,
+        filename: str,
+        trigger_tick: int,
+        timestamp: float,
+        time_offset: float,
+        post_ticks,
+        post_frames,
+        deadline,
+    ):
+        self.trigger = trigger
+        self.filename = filename
+        self.trigger_tick = trigger_tick
+        self.timestamp = timestamp
+        self.time_offset = time_offset
+        self.post_ticks = post_ticks
+        self.remaining = post_frames
+        self.deadline = deadline
+        self.chunks = []
+        self.frames = 0
+        self.complete = False
+
+    def add(self, records: bytes) -> None:
+        self.chunks.append(records)
+        self.frames += len(records) // RECORD_SIZE
+
+    def extend(self, msgs, records, start: int, count: int) -> int:
+        """Adds the frames of the batch that fall in the post-trigger window, returning the number added"""
+        end = count if self.remaining is None else min(count, start + self.remaining)
+        if self.post_ticks is not None and end > start:
+
+            def in_window(i):
+                return (msgs[i].ul_tstamp - self.trigger_tick) % _TICK_WRAP <= self.post_ticks
+
+            if not in_window(end - 1):
+                # timestamps rise through a batch, so find the end of the window with a binary search
+                lo, hi = start, end - 1
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    if in_window(mid):
+                        lo = mid + 1
+                    else:
+                        hi = mid
+                end = lo
+                self.complete = True
+        if end > start:
+            self.add(bytes(records[start * RECORD_SIZE : end * RECORD_SIZE]))
+        if self.remaining is not None:
+            self.remaining -= end - start
+            self.complete = self.complete or self.remaining <= 0
+        return end - start
+
+
+class TriggeredCapture(BatchListener):
+    """
+    Keeps the most recent frames in a ring buffer, and writes the frames around each trigger to a log file.
+
+    Every receive batch is copied into the preallocated ring, then checked against the triggers. When one fires, the
+    pre-trigger window is copied out of the ring, and the frames that follow are collected until the post-trigger
+    window is complete. The dump is then queued for a writer thread, which converts the records to messages and
+    writes them with :class:`can.Logger`. Triggers are not checked whilst a post-trigger window is being collected.
+
+    As the windows are measured with the hardware timestamps, a dump is completed by the first frame received after
+    its post-trigger window. If no such frame arrives, e.g. the bus went quiet after a bus-off, the writer thread
+    completes the dump once ``post_trigger`` seconds have passed on the host clock, and any remaining dump is
+    completed when the capture is stopped.
+    """
+
+    def __init__(
+        self,
+        base_filename: str,
+        triggers,
+        capacity: int = 65536,
+        pre_trigger: float = None,
+        post_trigger: float = 1.0,
+        post_trigger_frames: int = None,
+        max_pending_dumps: int = 4,
+        callback=None,
+    ):
+        """
+        :param base_filename:
+            The path the dumps are written to. A dump index is inserted before the extension, which selects the log
+            format, e.g. ``fault.blf`` is written as ``fault_0000.blf``, ``fault_0001.blf`` and so on.
+        :param triggers: The :class:`Trigger` objects to check every frame against
+        :param capacity: The number of frames held in the ring buffer, which bounds the pre-trigger window
+        :param pre_trigger: The length in seconds of the pre-trigger window, or None for the whole ring buffer
+        :param post_trigger: The length in seconds of the post-trigger window, or None to use only the frame count
+        :param post_trigger_frames: The largest number of frames in the post-trigger window, or None for no limit
+        :param max_pending_dumps: The number of dumps that can wait for the writer thread before new ones are dropped
+        :param callback: Called from the writer thread with a :class:`CaptureEvent` once each dump has been written
+        """
+        if post_trigger is None and post_trigger_frames is None:
+            raise ValueError("The post-trigger window needs a length in seconds, in frames or both")
+        root, ext = os.path.splitext(base_filename)
+        self._root = root
+        self._ext = ext or ".asc"
+        self.triggers = list(triggers)
+        self.capacity = max(int(capacity), 2)
+        self.pre_ticks = None if pre_trigger is None else int(pre_trigger * _TICKS_PER_SECOND)
+        self.post_ticks = None if post_trigger is None else int(post_trigger * _TICKS_PER_SECOND)
+        self.post_trigger_frames = post_trigger_frames
+        self.callback = callback
+        self.events = []
+        self.dumps_dropped = 0
+
+        self._ring = CANMsgBuffer(self.capacity).msgs
+        self._ring_bytes = memoryview(self._ring).cast("B")
+        self._written = 0
+        self._dump = None
+        self._dump_count = 0
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._queue = queue.Queue(maxsize=max_pending_dumps)
+        self._writer_thread = threading.Thread(target=self._run_writer, name="sontheim-capture-writer", daemon=True)
+        self._writer_thread.start()
+
+    @property
+    def frames_captured(self) -> int:
+        """The number of frames that have passed through the ring buffer"""
+        return self._written
+
+    def on_batch(self, msgs, count: int, time_offset: float) -> None:
+        records = memoryview(msgs).cast("B")
+        with self._lock:
+            self._check_batch(msgs, records, count, time_offset)
+            self._write_ring(records, count)
+
+    def _check_batch(self, msgs, records, count: int, time_offset: float) -> None:
+        start = 0
+        if self._dump is not None:
+            start = self._dump.extend(msgs, records, 0, count)
+            if not self._dump.complete:
+                return
+            self._submit()
+
+        while start < count:
+            index, trigger = self._find_trigger(msgs, start, count)
+            if trigger is None:
+                return
+            self._open_dump(trigger, msgs, records, index, time_offset)
+            start = index + 1 + self._dump.extend(msgs, records, index + 1, count)
+            if not self._dump.complete:
+                return
+            self._submit()
+
+    def _write_ring(self, records, count: int) -> None:
+        self._written += count
+        if count > self.capacity:
+            # only the newest records fit in the ring
+            records = records[(count - self.capacity) * RECORD_SIZE : count * RECORD_SIZE]
+            count = self.capacity
+        slot = (self._written - count) % self.capacity
+        first = min(count, self.capacity - slot)
+        offset = slot * RECORD_SIZE
+        self._ring_bytes[offset : offset + first * RECORD_SIZE] = records[: first * RECORD_SIZE]
+        if first < count:
+            self._ring_bytes[: (count - first) * RECORD_SIZE] = records[first * RECORD_SIZE : count * RECORD_SIZE]
+
+    def _find_trigger(self, msgs, start: int, count: int):
+        first_index, first_trigger = count, None
+        for trigger in self.triggers:
+            index = trigger.find(msgs, start, first_index)
+            if index != -1:
+                first_index, first_trigger = index, trigger
+        return first_index, first_trigger
+
+    def _read_ring(self, start: int, end: int) -> bytes:
+        """Copies the records with sequence numbers ``start`` to ``end`` out of the ring"""
+        slot = start % self.capacity
+        first = min(end - start, self.capacity - slot)
+        records = bytes(self._ring_bytes[slot * RECORD_SIZE : (slot + first) * RECORD_SIZE])
+        if first < end - start:
+            records += bytes(self._ring_bytes[: (end - start - first) * RECORD_SIZE])
+        return records
+
+    def _pre_trigger_start(self, msgs, index: int) -> int:
+        """
+        The sequence number of the first frame in the pre-trigger window of the frame at ``index`` of the current
+        batch. The window covers at most ``capacity`` frames, made up of the end of the ring and the start of the batch.
+        """
+        trigger_sequence = self._written + index
+        oldest = max(0, self._written - self.capacity, trigger_sequence + 1 - self.capacity)
+        if self.pre_ticks is None:
+            return oldest
+        trigger_tick = msgs[index].ul_tstamp
+
+        def tick(sequence):
+            if sequence >= self._written:
+                return msgs[sequence - self._written].ul_tstamp
+            return self._ring[sequence % self.capacity].ul_tstamp
+
+        # the age of the frames falls as the sequence number rises, so find the oldest frame in the window with a
+        # binary search
+        lo, hi = oldest, trigger_sequence
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if (trigger_tick - tick(mid)) % _TICK_WRAP <= self.pre_ticks:
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    def _open_dump(self, trigger, msgs, records, index: int, time_offset: float) -> None:
+        trigger_tick = msgs[index].ul_tstamp
+        filename = f"{self._root}_{self._dump_count:04d}{self._ext}"
+        self._dump_count += 1
+        timestamp = time_offset + trigger_tick / _TICKS_PER_SECOND
+        log.info("Capture triggered by %r at %.4f, writing %s", trigger, timestamp, filename)
+        deadline = None if self.post_ticks is None else time.monotonic() + self.post_ticks / _TICKS_PER_SECOND
+        self._dump = _Dump(
+            trigger,
+            filename,
+            trigger_tick,
+            timestamp,
+            time_offset,
+            self.post_ticks,
+            self.post_trigger_frames,
+            deadline,
+        )
+        start = self._pre_trigger_start(msgs, index)
+        if start < self._written:
+            self._dump.add(self._read_ring(start, self._written))
+        batch_start = max(0, start - self._written)
+        self._dump.add(bytes(records[batch_start * RECORD_SIZE : (index + 1) * RECORD_SIZE]))
+
+    def _submit(self) -> None:
+        """Queues the current dump for the writer thread. Called with the lock held."""
+        dump = self._dump
+        self._dump = None
+        try:
+            # capture must never wait for the writer, so the dump is dropped if the writer has fallen behind
+            self._queue.put_nowait(dump)
+        except queue.Full:
+            self.dumps_dropped += 1
+            log.warning("Capture writer has fallen behind, dump %s dropped", dump.filename)
+
+    def _take_expired_dump(self):
+        """Takes the dump being collected if its post-trigger window has passed on the host clock"""
+        with self._lock:
+            dump = self._dump
+            if dump is None or dump.deadline is None or time.monotonic() < dump.deadline:
+                return None
+            self._dump = None
+            return dump
+
+    def _next_timeout(self):
+        """The time the writer thread can wait for a dump before the post-trigger window of the current one ends"""
+        if self.post_ticks is None:
+            return None
+        with self._lock:
+            deadline = None if self._dump is None else self._dump.deadline
+        if deadline is None:
+            # whilst no dump is collected, poll often enough that a new dump completes soon after its deadline
+            return self.post_ticks / _TICKS_PER_SECOND / 4
+        return max(deadline - time.monotonic(), 0.0)
+
+    def _run_writer(self) -> None:
+        while True:
+            try:
+                dump = self._queue.get(timeout=self._next_timeout())
+            except queue.Empty:
+                # no frame after the post-trigger window has arrived, e.g. the bus went quiet after the fault
+                dump = self._take_expired_dump()
+                if dump is None:
+                    continue
+            else:
+                if dump is None:
+                    break
+            try:
+                records = b"".join(dump.chunks)
+                frames = (CANMsgStruct * (len(records) // RECORD_SIZE)).from_buffer_copy(records)
+                with can.Logger(dump.filename) as writer:
+                    for msg_struct in frames:
+                        writer.on_message_received(record_to_message(msg_struct, dump.time_offset))
+                event = CaptureEvent(dump.trigger, dump.timestamp, dump.filename, len(frames))
+                self.events.append(event)
+                if self.callback is not None:
+                    self.callback(event)
+            except Exception:  # pylint: disable=broad-except
+                log.exception("Error writing capture dump %s", dump.filename)
+
+    def stop(self) -> None:
+        """
+        Writes any dump still collecting its post-trigger window, and waits for the pending dumps to be written.
+        """
+        if self._stopped:
+            return
+        self._stopped = True
+        with self._lock:
+            if self._dump is not None:
+                self._submit()
+        self._queue.put(None)
+        self._writer_thread.join()
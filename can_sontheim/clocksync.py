@@ -0,0 +1,294 @@
+"""
+Hardware synchronised timestamps across multiple SIE / IFM CANfox interfaces
+
+Each adapter timestamps frames with its own free running CAN timer. ``canGetSyncTimer`` returns the CAN timer of an
+adapter together with the host performance counter value it was latched with. A :class:`ClockSync` service collects
+these pairs for every registered adapter in a background thread, and fits the offset and skew of each CAN timer
+against the host performance counter. As every adapter is mapped onto the same host counter, which is in turn mapped
+once onto :func:`time.time`, frames from all buses are stamped on one common timeline.
+
+Copyright (C) 2022 Matt Woodhead
+"""
+
+from collections import deque
+import ctypes
+import logging
+import math
+import sys
+import threading
+import time
+
+
+log = logging.getLogger("can.sontheim")
+
+_TICK_WRAP = 2**32  # the CAN timer is an unsigned long
+# The CAN timer of the CANfox counts tenths of a millisecond. Frame timestamps are converted with this tick length
+# throughout, as ``ul_tstamp / 10000``.
+TICK_SECONDS = 0.0001
+# The skew is only fitted once the samples span this many seconds. Over a shorter span the quantisation of the CAN
+# timer dominates the slope, so the clock is assumed to run at the nominal rate.
+_MIN_SKEW_SPAN = 1.0
+
+
+def _host_counter():
+    """
+    :return: A function reading the host performance counter that ``canGetSyncTimer`` latches, and its frequency
+    """
+    if sys.platform in ["win32", "cygwin"]:
+        kernel32 = ctypes.windll.kernel32
+        frequency = ctypes.c_longlong()
+        kernel32.QueryPerformanceFrequency(ctypes.byref(frequency))
+        counter = ctypes.c_longlong()
+
+        def read_counter():
+            kernel32.QueryPerformanceCounter(ctypes.byref(counter))
+            return counter.value
+
+        return read_counter, frequency.value
+    return time.perf_counter_ns, 1000000000
+
+
+class DeviceClock:
+    """
+    The estimated relation between the CAN timer of one adapter and the common timeline.
+
+    The model is a straight line through the most recent ``window`` (CAN timer, host time) samples, fitted by least
+    squares. Its slope gives the skew of the adapter's oscillator, and the residuals of the fit show how accurately
+    the CAN timer can be mapped onto the common timeline.
+    """
+
+    def __init__(self, name: str, read_sync_timer, tick_seconds: float, clock_sync, window: int = 32):
+        """
+        :param name: A name for the adapter, used in the statistics
+        :param read_sync_timer: Called to read the CAN timer, returns a (CAN timer, host counter) tuple
+        :param tick_seconds: The length of one CAN timer tick in seconds
+        :param clock_sync: The :class:`ClockSync` service the clock belongs to
+        :param window: The number of samples the model is fitted to
+        """
+        self.name = name
+        self.tick_seconds = tick_seconds
+        self._read_sync_timer = read_sync_timer
+        self._clock_sync = clock_sync
+        self._samples = deque(maxlen=window)
+        self._wraps = 0
+        self._last_tick = None
+        self._last_refresh = None
+        self.failures = 0
+        # host time = reference host time + slope * (CAN time - reference CAN time), replaced as a whole on refresh
+        self._model = None
+        self._residual_rms = None
+        self._residual_max = None
+
+    def refresh(self) -> None:
+        """
+        Reads the CAN timer and refits the model.
+
+        :raises CanOperationError: If the MT_API returns an error whilst reading the CAN timer
+        """
+        tick, counter = self._read_sync_timer()
+        self._add_sample(tick, counter)
+
+    def restart(self) -> None:
+        """
+        Discards the samples and starts the model again from a new reading, for when the CAN timer of the adapter
+        has been reset, e.g. by plugging it back in. The registration and the host clock calibration are kept.
+
+        :raises CanOperationError: If the MT_API returns an error whilst reading the CAN timer
+        """
+        tick, counter = self._read_sync_timer()
+        self._samples.clear()
+        self._wraps = 0
+        self._last_tick = None
+        self._add_sample(tick, counter)
+
+    def _add_sample(self, tick: int, counter: int) -> None:
+        if self._last_tick is not None and tick < self._last_tick and self._last_tick - tick > _TICK_WRAP // 2:
+            self._wraps += 1
+        self._last_tick = tick
+        device_time = (tick + self._wraps * _TICK_WRAP) * self.tick_seconds
+        self._samples.append((device_time, self._clock_sync.host_time(counter)))
+        self._last_refresh = time.monotonic()
+        self._fit()
+
+    @property
+    def latest_tick(self) -> int:
+        """The CAN timer value of the newest sample"""
+        return self._last_tick
+
+    def _fit(self) -> None:
+        samples = list(self._samples)
+        n = len(samples)
+        mean_x = sum(x for x, _ in samples) / n
+        mean_y = sum(y for _, y in samples) / n
+        if samples[-1][0] - samples[0][0] >= _MIN_SKEW_SPAN:
+            sxx = sum((x - mean_x) ** 2 for x, _ in samples)
+            slope = sum((x - mean_x) * (y - mean_y) for x, y in samples) / sxx
+        else:
+            slope = 1.0
+        residuals = [y - (mean_y + slope * (x - mean_x)) for x, y in samples]
+        self._model = (mean_x, mean_y, slope)
+        self._residual_rms = math.sqrt(sum(r * r for r in residuals) / n)
+        self._residual_max = max(abs(r) for r in residuals)
+
+    def _unwrap(self, tick: int) -> float:
+        """The CAN time in seconds of a CAN timer value close to the newest sample"""
+        unwrapped = tick + self._wraps * _TICK_WRAP
+        difference = unwrapped - (self._last_tick + self._wraps * _TICK_WRAP)
+        if difference > _TICK_WRAP // 2:
+            unwrapped -= _TICK_WRAP
+        elif difference < -(_TICK_WRAP // 2):
+            unwrapped += _TICK_WRAP
+        return unwrapped * self.tick_seconds
+
+    def to_time(self, tick: int) -> float:
+        """
+        :param tick: A CAN timer value, e.g. the ``ul_tstamp`` of a received frame
+        :return: The time of the tick on the common timeline, in seconds since the epoch
+        :rtype: float
+        """
+        reference_x, reference_y, slope = self._model
+        return reference_y + slope * (self._unwrap(tick) - reference_x)
+
+    def time_offset(self, tick: int) -> float:
+        """
+        :param tick: A recent CAN timer value
+        :return:
+            The offset to add to ``tick / 10000`` to place the tick on the common timeline. It is exact at ``tick``,
+            and holds for the other frames of a receive batch to within the skew over the batch.
+        :rtype: float
+        """
+        return self.to_time(tick) - tick / 10000
+
+    def statistics(self) -> dict:
+        """
+        :return:
+            The number of samples in the model, how much faster than the host clock the CAN timer runs in parts per
+            million, the RMS and largest residual of the fit in seconds, the number of failed reads and the age of the
+            newest sample in seconds
+        :rtype: dict
+        """
+        _, _, slope = self._model
+        return {
+            "samples": len(self._samples),
+            "skew_ppm": (1.0 / slope - 1.0) * 1e6,
+            "residual_rms": self._residual_rms,
+            "residual_max": self._residual_max,
+            "failures": self.failures,
+            "age": time.monotonic() - self._last_refresh,
+        }
+
+
+class ClockSync:
+    """
+    A service that keeps the CAN timers of all registered adapters mapped onto one common timeline.
+
+    Buses opened with ``clock_sync=True`` register with the shared service returned by :func:`get_clock_sync`. The
+    service refreshes every registered clock every ``interval`` seconds in a background thread, which runs whilst at
+    least one clock is registered.
+    """
+
+    def __init__(self, interval: float = 1.0, window: int = 32):
+        """
+        :param interval: The time in seconds between refreshes of each clock
+        :param window: The number of samples each clock model is fitted to
+        """
+        self.interval = interval
+        self.window = window
+        self._read_counter, self._frequency = _host_counter()
+        self._calibrate()
+        self._clocks = []
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _calibrate(self) -> None:
+        """Maps the host performance counter onto :func:`time.time` once, for all clocks"""
+        best = None
+        for _ in range(10):
+            before = self._read_counter()
+            wall = time.time()
+            after = self._read_counter()
+            if best is None or after - before < best[0]:
+                best = (after - before, wall, (before + after) / 2)
+        _, self._wall_reference, self._counter_reference = best
+
+    def host_time(self, counter: int) -> float:
+        """
+        :param counter: A host performance counter value
+        :return: The time of the counter value in seconds since the epoch
+        :rtype: float
+        """
+        return self._wall_reference + (counter - self._counter_reference) / self._frequency
+
+    def register(self, name: str, read_sync_timer, tick_seconds: float = TICK_SECONDS) -> DeviceClock:
+        """
+        Adds an adapter to the service. Its clock is sampled a few times straight away, so it can be used as soon as
+        it is returned.
+
+        :param name: A name for the adapter, used in the statistics
+        :param read_sync_timer: Called to read the CAN timer, returns a (CAN timer, host counter) tuple
+        :param tick_seconds: The length of one CAN timer tick in seconds
+        :raises CanOperationError: If the CAN timer cannot be read
+        :rtype: DeviceClock
+        """
+        clock = DeviceClock(name, read_sync_timer, tick_seconds or TICK_SECONDS, self, self.window)
+        for _ in range(3):
+            clock.refresh()
+        with self._lock:
+            self._clocks.append(clock)
+            if self._thread is None:
+                self._stop_event = threading.Event()
+                self._thread = threading.Thread(
+                    target=self._run, args=(self._stop_event,), name="sontheim-clock-sync", daemon=True
+                )
+                self._thread.start()
+        return clock
+
+    def unregister(self, clock: DeviceClock) -> None:
+        """
+        Removes an adapter from the service, stopping the background thread when no adapters are left.
+        """
+        with self._lock:
+            if clock in self._clocks:
+                self._clocks.remove(clock)
+            thread = self._thread if not self._clocks else None
+            if thread is not None:
+                self._thread = None
+                self._stop_event.set()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _run(self, stop_event) -> None:
+        while not stop_event.wait(self.interval):
+            with self._lock:
+                clocks = list(self._clocks)
+            for clock in clocks:
+                try:
+                    clock.refresh()
+                except Exception as e:  # pylint: disable=broad-except
+                    clock.failures += 1
+                    log.debug("Clock sync refresh of %s failed: %s", clock.name, e)
+
+    def statistics(self) -> dict:
+        """
+        :return: The :meth:`DeviceClock.statistics` of every registered clock, by name
+        :rtype: dict
+        """
+        with self._lock:
+            return {clock.name: clock.statistics() for clock in self._clocks}
+
+
+_CLOCK_SYNC = None
+_CLOCK_SYNC_LOCK = threading.Lock()
+
+
+def get_clock_sync() -> ClockSync:
+    """
+    :return: The clock sync service shared by every bus in this process
+    :rtype: ClockSync
+    """
+    global _CLOCK_SYNC  # pylint: disable=global-statement
+    with _CLOCK_SYNC_LOCK:
+        if _CLOCK_SYNC is None:
+            _CLOCK_SYNC = ClockSync()
+        return _CLOCK_SYNC
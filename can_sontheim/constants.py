@@ -150,8 +150,8 @@ _DLL_FUNCTIONS = [
     ("canClearBuffer", c_long, (HANDLE,)),
     ("canGetNumberOfConnectedDevices", c_long, (HANDLE,)),
     ("canGetDeviceList", c_long, (POINTER(CANInstalledDevicesStruct),)),
-    ("canGetSyncTimer", c_long, (HANDLE, c_ulong, c_longlong)),
-    ("canGetDeviceTimestampBase", c_long, (c_long, c_ulong)),
+    ("canGetSyncTimer", c_long, (HANDLE, POINTER(c_ulong), POINTER(c_longlong))),
+    ("canGetDeviceTimestampBase", c_long, (c_long, POINTER(c_ulong))),
     ("canEnableHWExtendedId", c_long, (HANDLE, c_bool)),
     (
         "canGetCanLevel",
@@ -0,0 +1,211 @@
+"""
+Vectorized DBC signal decoding of receive batches for the SIE / IFM CANfox interface
+
+Copyright (C) 2022 Matt Woodhead
+"""
+
+from collections import namedtuple
+import logging
+import weakref
+
+from .batch import BatchListener, as_array
+
+try:
+    import numpy as np
+
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+
+log = logging.getLogger("can.sontheim")
+
+SignalPlan = namedtuple(
+    "SignalPlan",
+    [
+        "name",
+        "big_endian",
+        "shift",
+        "mask",
+        "length",
+        "min_dlc",
+        "is_signed",
+        "is_float",
+        "scale",
+        "offset",
+        "multiplexer",
+        "multiplexer_ids",
+    ],
+)
+
+MessagePlan = namedtuple("MessagePlan", ["name", "frame_id", "is_extended_id", "signals"])
+
+_PLAN_CACHE = weakref.WeakKeyDictionary()
+
+
+def compile_signal(signal) -> SignalPlan:
+    """
+    Builds the bit extraction plan of a cantools signal. The eight data bytes of a frame are read as a single 64 bit
+    word (little endian for Intel signals, big endian for Motorola signals) so the raw value is ``(word >> shift) &
+    mask`` for every signal. ``min_dlc`` is the number of data bytes a frame must carry to hold the whole signal.
+    """
+    if signal.byte_order == "little_endian":
+        big_endian = False
+        shift = signal.start
+        min_dlc = (signal.start + signal.length - 1) // 8 + 1
+    else:
+        # cantools numbers the most significant bit of a Motorola signal in the "sawtooth" bit order
+        big_endian = True
+        msb_from_left = 8 * (signal.start // 8) + (7 - signal.start % 8)
+        shift = 64 - msb_from_left - signal.length
+        min_dlc = 8 - shift // 8  # the least significant bit is in the last byte of the signal
+    return SignalPlan(
+        name=signal.name,
+        big_endian=big_endian,
+        shift=shift,
+        mask=(1 << signal.length) - 1,
+        length=signal.length,
+        min_dlc=min_dlc,
+        is_signed=signal.is_signed,
+        is_float=signal.is_float,
+        scale=signal.scale,
+        offset=signal.offset,
+        multiplexer=None,
+        multiplexer_ids=signal.multiplexer_ids,
+    )
+
+
+def compile_database(database) -> dict:
+    """
+    Compiles the bit extraction plans of every message in a cantools database. The plans are cached per database, so
+    calling this again with the same database is free.
+
+    :param database: A :class:`cantools.database.can.Database`
+    :return: A dictionary of ``(frame_id, is_extended_id)`` to :class:`MessagePlan`
+    :rtype: dict
+    """
+    plans = _PLAN_CACHE.get(database)
+    if plans is not None:
+        return plans
+
+    plans = {}
+    for message in database.messages:
+        signals = [compile_signal(signal) for signal in message.signals]
+        multiplexers = {signal.name for signal in message.signals if signal.is_multiplexer}
+        for i, signal in enumerate(message.signals):
+            if signal.multiplexer_ids and signal.multiplexer_signal in multiplexers:
+                signals[i] = signals[i]._replace(multiplexer=signal.multiplexer_signal)
+        # multiplexers are decoded before the signals that depend on them
+        signals.sort(key=lambda plan: plan.multiplexer is not None)
+        plans[(message.frame_id, message.is_extended_frame)] = MessagePlan(
+            name=message.name,
+            frame_id=message.frame_id,
+            is_extended_id=message.is_extended_frame,
+            signals=signals,
+        )
+    _PLAN_CACHE[database] = plans
+    return plans
+
+
+def _extract(plan: SignalPlan, words_le, words_be):
+    raw = ((words_be if plan.big_endian else words_le) >> np.uint64(plan.shift)) & np.uint64(plan.mask)
+    if plan.is_float:
+        if plan.length == 32:
+            value = raw.astype(np.uint32).view(np.float32).astype(np.float64)
+        else:
+            value = raw.view(np.float64)
+    elif plan.is_signed:
+        # the sign is applied to the unsigned raw value, so no intermediate overflows for 64 bit signals
+        if plan.length == 64:
+            value = raw.view(np.int64)
+        else:
+            sign_bit = 1 << (plan.length - 1)
+            value = (raw ^ np.uint64(sign_bit)).astype(np.int64) - np.int64(sign_bit)
+    else:
+        value = raw
+    if plan.scale != 1 or plan.offset != 0:
+        value = value * plan.scale + plan.offset
+    return value
+
+
+def decode_frames(frames, plans: dict, time_offset: float = 0.0) -> dict:
+    """
+    Decodes every signal of every known message in an array of frames.
+
+    The frames are grouped by identifier, and all signals of a message are then extracted at once from a NumPy view of
+    the data bytes of that group. Multiplexed signals are NaN in rows where their multiplexer value does not select
+    them, and every signal is NaN in remote frames and in frames whose data length code is too short to hold it.
+
+    :param frames: A structured array of frames, as returned by :func:`can_sontheim.batch.as_array`
+    :param plans: The message plans from :func:`compile_database`
+    :param time_offset: The offset in seconds added to ``ul_tstamp / 10000`` to give the ``timestamp`` column
+    :return:
+        A dictionary of message name to a dictionary of column arrays, holding a ``timestamp`` column and one column
+        per signal
+    :rtype: dict
+    """
+    frame_info = frames["by_extended"]
+    frames = frames[(frame_info & 64) == 0]  # error frames do not carry an identifier
+    if not len(frames):
+        return {}
+
+    # group the rows by identifier with a stable sort, keeping each group in receive order
+    keys = frames["l_id"].astype(np.int64) | ((frames["by_extended"].astype(np.int64) & 2) << 31)
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    unique_keys, starts = np.unique(sorted_keys, return_index=True)
+    ends = np.append(starts[1:], len(sorted_keys))
+
+    result = {}
+    for key, start, end in zip(unique_keys.tolist(), starts.tolist(), ends.tolist()):
+        plan = plans.get((key & 0x1FFFFFFF, bool(key >> 32)))
+        if plan is None:
+            continue
+        rows = frames[order[start:end]]
+        data = np.ascontiguousarray(rows["aby_data"])
+        words_le = data.view("<u8").ravel()
+        words_be = data.view(">u8").ravel().astype(np.uint64)
+        columns = {"timestamp": rows["ul_tstamp"] / 10000 + time_offset}
+        # the data bytes beyond the data length code, and all of them in a remote frame, are left over from earlier
+        # frames in the buffer
+        dlc = np.where(rows["by_remote"] & 1, 0, rows["by_len"] & 0x0F)
+        for signal in plan.signals:
+            value = _extract(signal, words_le, words_be)
+            present = dlc >= signal.min_dlc
+            if not present.all():
+                value = np.where(present, value, np.nan)
+            if signal.multiplexer is not None:
+                selected = np.isin(columns[signal.multiplexer], signal.multiplexer_ids)
+                value = np.where(selected, value, np.nan)
+            columns[signal.name] = value
+        result[plan.name] = columns
+    return result
+
+
+class BatchSignalDecoder(BatchListener):
+    """
+    Decodes the signals of every received frame that is defined in a DBC database, one receive batch at a time.
+
+    Each batch is decoded with :func:`decode_frames` and the columnar result is passed to ``callback``.
+    """
+
+    def __init__(self, database, callback):
+        """
+        :param database: A :class:`cantools.database.can.Database`
+        :param callback:
+            Called with the dictionary of message name to signal columns for every batch that contains at least one
+            known message
+        :raises ImportError: If NumPy is not installed
+        """
+        if not HAS_NUMPY:
+            raise ImportError("NumPy is required for batch signal decoding")
+        self.plans = compile_database(database)
+        self.callback = callback
+
+    def on_batch(self, msgs, count: int, time_offset: float) -> None:
+        result = decode_frames(as_array(msgs, count), self.plans, time_offset)
+        if result:
+            try:
+                self.callback(result)
+            except Exception:  # pylint: disable=broad-except
+                log.exception("Error in batch signal decoder callback")
@@ -0,0 +1,154 @@
+"""
+Persistent device information cache for the SIE / IFM CANfox interface
+
+A :class:`DeviceCache` keeps the serial number read with ``canGetHWSerialNumber`` and the revisions reported by
+``canStatus`` of the adapter last seen on each net in a small JSON file. An entry is only used when the serial number
+read from the adapter matches it, as another adapter may have been plugged into the net, in which case the device
+information is read without the ``canStatus`` call. The file is only written when an entry changes, so reopening a
+bus does not write to the disk.
+
+Copyright (C) 2022 Matt Woodhead
+"""
+
+from collections import namedtuple
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+
+log = logging.getLogger("can.sontheim")
+
+DeviceInfo = namedtuple("DeviceInfo", ["net", "serial_number", "hw_rev", "fw_rev", "drv_rev", "dll_rev"])
+
+_REVISIONS = ("hw_rev", "fw_rev", "drv_rev", "dll_rev")
+
+
+def default_cache_path() -> str:
+    """
+    :return: The path of the cache file in the user cache directory
+    :rtype: str
+    """
+    if sys.platform in ["win32", "cygwin"]:
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "can_sontheim", "devices.json")
+
+
+def revisions_from_status(status) -> dict:
+    """
+    :param status: The fields of :class:`~can_sontheim.structures.CANStatusStruct`, e.g. from ``bus.get_status()``
+    :return: The hardware, firmware, driver and DLL revisions by name
+    :rtype: dict
+    """
+    return {
+        "hw_rev": status.w_hw_rev,
+        "fw_rev": status.w_fw_rev,
+        "drv_rev": status.w_drv_rev,
+        "dll_rev": status.w_dll_rev,
+    }
+
+
+class DeviceCache:
+    """
+    The last known device information of the adapter on every net, kept in memory and in a JSON file.
+
+    The file is read once, when the cache is first used, and written only when an entry changes. Errors reading or
+    writing the file are logged and otherwise ignored, so a read-only or missing cache never stops a bus opening.
+    """
+
+    def __init__(self, path: str = None):
+        """
+        :param path: The path of the cache file, by default :func:`default_cache_path`
+        """
+        self.path = path or default_cache_path()
+        self._lock = threading.Lock()
+        self._entries = None
+
+    def _load(self) -> dict:
+        if self._entries is None:
+            try:
+                with open(self.path, "r", encoding="utf-8") as file:
+                    self._entries = json.load(file)
+            except FileNotFoundError:
+                self._entries = {}
+            except (OSError, ValueError) as e:
+                log.debug("Ignoring the device cache %s: %s", self.path, e)
+                self._entries = {}
+        return self._entries
+
+    def _save(self) -> None:
+        temporary = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(temporary, "w", encoding="utf-8") as file:
+                json.dump(self._entries, file, indent=1, sort_keys=True)
+            os.replace(temporary, self.path)
+        except OSError as e:
+            log.debug("Could not write the device cache %s: %s", self.path, e)
+
+    def _get(self, net: int):
+        with self._lock:
+            entry = self._load().get(str(net))
+        if entry is None:
+            return None
+        return DeviceInfo(net, entry.get("serial_number"), *(entry.get(name) for name in _REVISIONS))
+
+    def lookup(self, net: int, serial_number: int):
+        """
+        :param net: The net the adapter is connected to
+        :param serial_number: The serial number read from the adapter
+        :return:
+            The device information last recorded for the net, or None if it has not been recorded or was recorded for
+            another adapter
+        :rtype: DeviceInfo
+        """
+        info = self._get(net)
+        if info is None or info.serial_number != serial_number:
+            return None
+        return info
+
+    def store(self, info: DeviceInfo):
+        """
+        Records the device information of an adapter, writing the cache file if it differs from the last record.
+
+        :param info: The device information, which must include the serial number
+        :return: The device information previously recorded for the net, or None if nothing had been recorded
+        :rtype: DeviceInfo
+        """
+        previous = self._get(info.net)
+        if previous != info:
+            entry = dict(info._asdict(), updated=time.time())
+            del entry["net"]
+            with self._lock:
+                self._load()[str(info.net)] = entry
+                self._save()
+        return previous
+
+    def clear(self) -> None:
+        """Removes every entry, and the cache file"""
+        with self._lock:
+            self._entries = {}
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+_DEVICE_CACHE = None
+_DEVICE_CACHE_LOCK = threading.Lock()
+
+
+def get_device_cache() -> DeviceCache:
+    """
+    :return: The device cache shared by every bus in this process, stored at :func:`default_cache_path`
+    :rtype: DeviceCache
+    """
+    global _DEVICE_CACHE  # pylint: disable=global-statement
+    with _DEVICE_CACHE_LOCK:
+        if _DEVICE_CACHE is None:
+            _DEVICE_CACHE = DeviceCache()
+        return _DEVICE_CACHE
@@ -0,0 +1,164 @@
+"""
+Transmit confirmation from the echo frames of the SIE / IFM CANfox interface
+
+With echo enabled, every frame sent on a handle is also returned through its receive queue, with bit 7 of
+``by_extended`` set and the hardware timestamp of the moment it was sent on the bus. A :class:`TxTracker` matches these
+echoes to the frames waiting for confirmation, giving the transmit timestamp and latency of every frame.
+
+Copyright (C) 2022 Matt Woodhead
+"""
+
+from collections import deque, namedtuple
+import logging
+import threading
+import time
+
+from .batch import BatchListener, HAS_NUMPY, as_array
+
+if HAS_NUMPY:
+    import numpy as np
+
+
+log = logging.getLogger("can.sontheim")
+
+ECHO_FLAG = 0x80  # bit 7 of by_extended marks a frame transmitted on the same handle
+
+TxConfirmation = namedtuple("TxConfirmation", ["arbitration_id", "send_time", "tx_timestamp", "latency"])
+
+
+def _frame_key(msg_struct) -> tuple:
+    """The fields a frame and its echo have in common"""
+    dlc = msg_struct.by_len & 0x0F
+    return msg_struct.l_id, msg_struct.by_extended & 3, dlc, bytes(msg_struct.aby_data)[:dlc]
+
+
+class TxTracker(BatchListener):
+    """
+    Matches echo frames to the frames sent on the bus, giving the time each frame was transmitted.
+
+    The bus records every frame passed to ``send`` or ``send_batch`` before handing it to the driver. Echoes return
+    in the order the frames were sent, so each echo is compared with the oldest frames waiting for confirmation. Frames
+    skipped over by a later echo, and frames not confirmed within ``timeout`` seconds, are counted as lost. Echoes of
+    frames the bus did not record, e.g. those of prepared frames, are counted as untracked.
+    """
+
+    def __init__(self, timeout: float = 1.0, history: int = 10000, search_depth: int = 64, callback=None):
+        """
+        :param timeout: The time in seconds after which a frame that has not been confirmed is counted as lost
+        :param history: The number of latencies kept for the statistics
+        :param search_depth: The number of waiting frames an echo is compared with
+        :param callback: Called from the receive path with a :class:`TxConfirmation` for every confirmed frame
+        """
+        self.timeout = timeout
+        self.search_depth = search_depth
+        self.callback = callback
+        self._lock = threading.Lock()
+        self._pending = deque()
+        self.latencies = deque(maxlen=history)
+        self.confirmed = 0
+        self.lost = 0
+        self.untracked = 0
+        self.last_tx_timestamp = None
+
+    def sent(self, msg_struct) -> list:
+        """
+        Records a frame that is about to be sent.
+
+        :param msg_struct: The CMSG record handed to the driver
+        :return: The entry waiting for confirmation, for :meth:`discard` if the driver does not accept the frame
+        """
+        entry = (_frame_key(msg_struct), time.time())
+        with self._lock:
+            self._pending.append(entry)
+        return [entry]
+
+    def sent_batch(self, msgs, start: int, count: int) -> list:
+        """
+        Records a run of frames that is about to be sent with one ``canSend`` call.
+
+        :return: The entries waiting for confirmation, in the order of the frames
+        """
+        send_time = time.time()
+        entries = [(_frame_key(msgs[i]), send_time) for i in range(start, start + count)]
+        with self._lock:
+            self._pending.extend(entries)
+        return entries
+
+    def discard(self, entries) -> None:
+        """Stops waiting for frames the driver did not accept"""
+        with self._lock:
+            for entry in entries:
+                try:
+                    self._pending.remove(entry)
+                except ValueError:
+                    pass
+
+    def on_batch(self, msgs, count: int, time_offset: float) -> None:
+        if HAS_NUMPY:
+            echoes = np.flatnonzero(as_array(msgs, count)["by_extended"] & ECHO_FLAG).tolist()
+        else:
+            echoes = [i for i in range(count) if msgs[i].by_extended & ECHO_FLAG]
+        with self._lock:
+            self._expire()
+            for i in echoes:
+                self._confirm(msgs[i], time_offset)
+
+    def _expire(self) -> None:
+        pending = self._pending
+        deadline = time.time() - self.timeout
+        while pending and pending[0][1] < deadline:
+            pending.popleft()
+            self.lost += 1
+
+    def _confirm(self, msg_struct, time_offset: float) -> None:
+        key = _frame_key(msg_struct)
+        pending = self._pending
+        for position in range(min(len(pending), self.search_depth)):
+            if pending[position][0] == key:
+                break
+        else:
+            self.untracked += 1
+            return
+        for _ in range(position):
+            pending.popleft()
+        self.lost += position
+        _, send_time = pending.popleft()
+
+        tx_timestamp = time_offset + msg_struct.ul_tstamp / 10000
+        latency = tx_timestamp - send_time
+        self.latencies.append(latency)
+        self.confirmed += 1
+        self.last_tx_timestamp = tx_timestamp
+        if self.callback is not None:
+            try:
+                self.callback(TxConfirmation(key[0], send_time, tx_timestamp, latency))
+            except Exception as e:  # pylint: disable=broad-except
+                log.error("Transmit confirmation callback raised an exception: %s", e)
+
+    def statistics(self) -> dict:
+        """
+        :return:
+            The number of frames confirmed, lost and still waiting, the number of untracked echoes, and the minimum,
+            mean, median, 99th percentile and maximum latency in seconds from ``send`` to the hardware timestamp of the
+            echo, over the most recent frames
+        :rtype: dict
+        """
+        with self._lock:
+            latencies = sorted(self.latencies)
+            result = {
+                "confirmed": self.confirmed,
+                "lost": self.lost,
+                "pending": len(self._pending),
+                "untracked": self.untracked,
+            }
+        if latencies:
+            result["latency"] = {
+                "min": latencies[0],
+                "mean": sum(latencies) / len(latencies),
+                "p50": latencies[len(latencies) // 2],
+                "p99": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+                "max": latencies[-1],
+            }
+        else:
+            result["latency"] = None
+        return result
@@ -0,0 +1,238 @@
+"""
+Streaming columnar (Arrow / Parquet) export of captured traffic for the SIE / IFM CANfox interface
+
+Copyright (C) 2022 Matt Woodhead
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+
+from .batch import BatchListener, as_array
+
+try:
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+
+log = logging.getLogger("can.sontheim")
+
+# Bits of the flags column. Bits 1, 6 and 7 are those of the by_extended byte of the CMSG structure, and the reserved
+# bit 2 carries the remote frame flag from by_remote.
+FLAG_STANDARD = 1
+FLAG_EXTENDED = 2
+FLAG_REMOTE = 4
+FLAG_ERROR = 64
+FLAG_ECHO = 128
+
+
+def capture_schema():
+    """
+    :return: The Arrow schema of the exported frames
+    :rtype: pyarrow.Schema
+    """
+    return pa.schema(
+        [
+            ("timestamp", pa.float64()),
+            ("arbitration_id", pa.uint32()),
+            ("flags", pa.uint8()),
+            ("dlc", pa.uint8()),
+            ("data", pa.binary(8)),
+        ]
+    )
+
+
+class _ColumnBuilder:
+    """Preallocated NumPy columns that frames are copied into until a record batch is full"""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.length = 0
+        self.created = None  # the time the first frame was copied in
+        self.timestamp = np.empty(capacity, np.float64)
+        self.arbitration_id = np.empty(capacity, np.uint32)
+        self.flags = np.empty(capacity, np.uint8)
+        self.dlc = np.empty(capacity, np.uint8)
+        self.data = np.empty((capacity, 8), np.uint8)
+
+    def append(self, frames, time_offset: float) -> int:
+        """Copies as many frames as fit, returning the number copied"""
+        n = min(len(frames), self.capacity - self.length)
+        if n and not self.length:
+            self.created = time.monotonic()
+        frames = frames[:n]
+        rows = slice(self.length, self.length + n)
+        self.timestamp[rows] = frames["ul_tstamp"] / 10000 + time_offset
+        self.arbitration_id[rows] = frames["l_id"]
+        self.flags[rows] = frames["by_extended"] | ((frames["by_remote"] & 1) << 2)
+        self.dlc[rows] = frames["by_len"] & 0x0F
+        self.data[rows] = frames["aby_data"]
+        self.length += n
+        return n
+
+    def to_record_batch(self, schema):
+        n = self.length
+        data = pa.FixedSizeBinaryArray.from_buffers(pa.binary(8), n, [None, pa.py_buffer(self.data[:n])])
+        return pa.RecordBatch.from_arrays(
+            [
+                pa.array(self.timestamp[:n]),
+                pa.array(self.arbitration_id[:n]),
+                pa.array(self.flags[:n]),
+                pa.array(self.dlc[:n]),
+                data,
+            ],
+            schema=schema,
+        )
+
+
+class ParquetCaptureSink(BatchListener):
+    """
+    Streams every received frame to a sequence of Parquet files.
+
+    Frames are copied from each receive batch into preallocated NumPy columns. When ``rows_per_batch`` frames have been
+    collected, or the oldest of them has waited ``flush_interval`` seconds, the columns are handed to a writer thread as
+    an Arrow record batch and written as a Parquet row group. The number of record batches waiting to be written is
+    bounded by ``max_queued_batches``, so memory use is bounded. Files are rotated when they reach ``max_bytes`` or
+    have been open for ``max_seconds``, and each rotated file is complete and can be read straight away. The writer
+    thread applies the time limits itself, so they hold on an idle bus as well.
+    """
+
+    def __init__(
+        self,
+        base_filename: str,
+        rows_per_batch: int = 65536,
+        flush_interval: float = 1.0,
+        max_bytes: int = None,
+        max_seconds: float = None,
+        max_queued_batches: int = 8,
+        compression: str = "snappy",
+    ):
+        """
+        :param base_filename:
+            The path the files are written to. A rotation index is inserted before the extension, e.g.
+            ``capture.parquet`` is written as ``capture_0000.parquet``, ``capture_0001.parquet`` and so on.
+        :param rows_per_batch: The number of frames in each record batch and Parquet row group
+        :param flush_interval: The longest time in seconds a frame is held before its record batch is written
+        :param max_bytes: Rotate to a new file once the current one is at least this many bytes
+        :param max_seconds: Rotate to a new file once the current one has been open this many seconds
+        :param max_queued_batches: The number of record batches that can wait for the writer thread
+        :param compression: The Parquet compression codec
+        :raises ImportError: If pyarrow or NumPy is not installed
+        """
+        if not HAS_PYARROW:
+            raise ImportError("pyarrow and NumPy are required for Parquet capture")
+        root, ext = os.path.splitext(base_filename)
+        self._root = root
+        self._ext = ext or ".parquet"
+        self.rows_per_batch = rows_per_batch
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.compression = compression
+        self.schema = capture_schema()
+        self.files = []
+        self.rows_written = 0
+
+        self._stopped = False
+        self._lock = threading.Lock()  # guards the builder, which is swapped out by both threads
+        self._builder = _ColumnBuilder(rows_per_batch)
+        self._queue = queue.Queue(maxsize=max_queued_batches)
+        self._writer_thread = threading.Thread(target=self._run_writer, name="sontheim-parquet-writer", daemon=True)
+        self._writer_thread.start()
+
+    def on_batch(self, msgs, count: int, time_offset: float) -> None:
+        frames = as_array(msgs, count)
+        while len(frames):
+            with self._lock:
+                n = self._builder.append(frames, time_offset)
+                builder = self._take_builder(full_only=True)
+            frames = frames[n:]
+            if builder is not None:
+                # blocks if the writer has fallen behind, rather than letting memory grow without limit
+                self._queue.put(builder.to_record_batch(self.schema))
+
+    def _take_builder(self, full_only: bool = False, stale_only: bool = False):
+        """
+        Swaps in an empty builder, returning the current one if it holds frames. Called with the lock held.
+
+        :param full_only: Only swap the builder once it is full
+        :param stale_only: Only swap the builder once its oldest frame has waited ``flush_interval`` seconds
+        """
+        builder = self._builder
+        if not builder.length or (full_only and builder.length < builder.capacity):
+            return None
+        if stale_only and time.monotonic() - builder.created < self.flush_interval:
+            return None
+        self._builder = _ColumnBuilder(self.rows_per_batch)
+        return builder
+
+    def _flush(self) -> None:
+        with self._lock:
+            builder = self._take_builder()
+        if builder is not None:
+            self._queue.put(builder.to_record_batch(self.schema))
+
+    def _next_timeout(self, opened) -> float:
+        """The time the writer thread can wait for a record batch before a time limit is reached"""
+        now = time.monotonic()
+        with self._lock:
+            created = self._builder.created if self._builder.length else None
+        # whilst no frames are held, poll often enough that a new frame waits little longer than flush_interval
+        deadlines = [now + self.flush_interval / 4 if created is None else created + self.flush_interval]
+        if opened is not None and self.max_seconds is not None:
+            deadlines.append(opened + self.max_seconds)
+        return max(min(deadlines) - now, 0.0)
+
+    def _open_file(self):
+        filename = f"{self._root}_{len(self.files):04d}{self._ext}"
+        self.files.append(filename)
+        log.debug("Opening capture file %s", filename)
+        return pq.ParquetWriter(filename, self.schema, compression=self.compression), filename, time.monotonic()
+
+    def _run_writer(self) -> None:
+        writer = filename = opened = None
+        while True:
+            try:
+                record_batch = self._queue.get(timeout=self._next_timeout(opened))
+            except queue.Empty:
+                # no full record batch arrived in time, so write the frames held longer than flush_interval
+                with self._lock:
+                    builder = self._take_builder(stale_only=True)
+                record_batch = None if builder is None else builder.to_record_batch(self.schema)
+            else:
+                if record_batch is None:
+                    break
+            try:
+                if record_batch is not None:
+                    if writer is None:
+                        writer, filename, opened = self._open_file()
+                    writer.write_batch(record_batch)
+                    self.rows_written += record_batch.num_rows
+                if writer is not None and (
+                    (self.max_bytes is not None and os.path.getsize(filename) >= self.max_bytes)
+                    or (self.max_seconds is not None and time.monotonic() - opened >= self.max_seconds)
+                ):
+                    writer.close()
+                    writer = opened = None
+            except Exception:  # pylint: disable=broad-except
+                log.exception("Error writing capture file")
+        if writer is not None:
+            writer.close()
+
+    def stop(self) -> None:
+        """
+        Writes any collected frames and closes the current file.
+        """
+        if self._stopped:
+            return
+        self._stopped = True
+        self._flush()
+        self._queue.put(None)
+        self._writer_thread.join()
@@ -0,0 +1,315 @@
+"""
+Bus load traffic generator for the SIE / IFM CANfox interface
+
+A :class:`TrafficGenerator` precomputes a sequence of frames into a contiguous array of CMSG records, along with the
+exact length of every frame on the bus including stuff bits. The sequence is then queued in batches with
+:meth:`SontheimBus.send_batch`, paced so that the bus is held at a target load, without building a
+:class:`can.Message` per frame.
+
+Copyright (C) 2022 Matt Woodhead
+"""
+
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+import logging
+import random
+import statistics
+import threading
+import time
+
+from can.exceptions import CanOperationError
+
+from .structures import CANMsgBuffer
+
+
+log = logging.getLogger("can.sontheim")
+
+PAYLOAD_PATTERNS = ("random", "counter", "zeros", "ones", "alternating")
+
+_CRC15_POLYNOMIAL = 0x4599
+# CRC delimiter, ACK slot, ACK delimiter, end of frame and interframe space, none of which are stuffed
+_UNSTUFFED_TRAILER_BITS = 1 + 1 + 1 + 7 + 3
+
+GeneratorResult = namedtuple(
+    "GeneratorResult",
+    [
+        "frames_sent",
+        "bits_sent",
+        "elapsed",
+        "target_load",
+        "achieved_load",
+        "measured_load",
+        "busload_samples",
+        "tx_buffer_full",
+    ],
+)
+
+
+def _crc15(bits) -> int:
+    crc = 0
+    for bit in bits:
+        feedback = bit ^ ((crc >> 14) & 1)
+        crc = (crc << 1) & 0x7FFF
+        if feedback:
+            crc ^= _CRC15_POLYNOMIAL
+    return crc
+
+
+def _to_bits(value: int, length: int) -> list:
+    return [(value >> i) & 1 for i in range(length - 1, -1, -1)]
+
+
+def frame_bits(arbitration_id: int, data=b"", is_extended_id: bool = False, is_remote_frame: bool = False, dlc=None):
+    """
+    Calculates the number of bit times a classic CAN frame occupies the bus for, including the stuff bits and the
+    interframe space.
+
+    :param arbitration_id: The CAN ID of the frame
+    :param data: The data bytes of the frame
+    :param is_extended_id: Whether the frame has a 29 bit ID
+    :param is_remote_frame: Whether the frame is a remote frame, which carries no data
+    :param dlc: The data length code, defaults to the length of ``data``
+    :return: The length of the frame in bits
+    :rtype: int
+    """
+    if dlc is None:
+        dlc = len(data)
+    rtr = 1 if is_remote_frame else 0
+    if is_extended_id:
+        # SOF, base ID, SRR, IDE, ID extension, RTR, r1, r0
+        bits = [0] + _to_bits(arbitration_id >> 18, 11) + [1, 1] + _to_bits(arbitration_id & 0x3FFFF, 18) + [rtr, 0, 0]
+    else:
+        # SOF, ID, RTR, IDE, r0
+        bits = [0] + _to_bits(arbitration_id, 11) + [rtr, 0, 0]
+    bits += _to_bits(dlc, 4)
+    if not is_remote_frame:
+        for byte in data[: min(dlc, 8)]:
+            bits += _to_bits(byte, 8)
+    bits += _to_bits(_crc15(bits), 15)
+
+    # a bit of the opposite value is inserted after every five consecutive bits of the same value, and the stuff bit
+    # starts the next run
+    stuff_bits = 0
+    previous = None
+    run = 0
+    for bit in bits:
+        if bit == previous:
+            run += 1
+        else:
+            previous = bit
+            run = 1
+        if run == 5:
+            stuff_bits += 1
+            previous = 1 - bit
+            run = 1
+    return len(bits) + stuff_bits + _UNSTUFFED_TRAILER_BITS
+
+
+def _weighted(values):
+    """Splits a sequence (equal weights) or a mapping of value to weight into values and weights"""
+    if isinstance(values, dict):
+        return list(values.keys()), list(values.values())
+    values = list(values)
+    return values, [1] * len(values)
+
+
+class TrafficGenerator:
+    """
+    Holds a precomputed sequence of frames and sends it repeatedly at a target bus load.
+
+    The IDs and data lengths of the frames are drawn from the given distributions, and the payloads are filled with
+    one of :data:`PAYLOAD_PATTERNS` or a fixed byte string. As stuff bits depend on the ID and payload, the load of
+    the sequence is calculated from the exact length of each frame rather than an average.
+    """
+
+    def __init__(
+        self,
+        ids=(0x100,),
+        dlcs=(8,),
+        payload="random",
+        extended: bool = False,
+        length: int = 1024,
+        seed=None,
+    ):
+        """
+        :param ids: The CAN IDs to send, either a sequence used with equal weights or a mapping of ID to weight
+        :param dlcs: The data lengths to send, either a sequence or a mapping of data length to weight
+        :param payload: A name from :data:`PAYLOAD_PATTERNS`, or bytes repeated as the payload of every frame
+        :param extended: Whether to send 29 bit IDs. IDs above 0x7FF are always sent as 29 bit IDs.
+        :param length: The number of frames in the sequence
+        :param seed: The seed of the random number generator, to make the sequence repeatable
+        :raises ValueError: If the payload pattern is not known or a data length is not between 0 and 8
+        """
+        if not isinstance(payload, (bytes, bytearray)) and payload not in PAYLOAD_PATTERNS:
+            raise ValueError(f"Unknown payload pattern {payload!r}, expected bytes or one of {PAYLOAD_PATTERNS}")
+        rng = random.Random(seed)
+        id_values, id_weights = _weighted(ids)
+        dlc_values, dlc_weights = _weighted(dlcs)
+        if any(not 0 <= dlc <= 8 for dlc in dlc_values):
+            raise ValueError("Data lengths must be between 0 and 8")
+
+        self.length = max(int(length), 2)
+        self.frames = CANMsgBuffer(self.length)
+        self.msgs = self.frames.msgs
+        self.frame_bits = array("I")
+        self._cumulative_bits = [0]
+
+        frame_ids = rng.choices(id_values, id_weights, k=self.length)
+        frame_dlcs = rng.choices(dlc_values, dlc_weights, k=self.length)
+        for i in range(self.length):
+            arbitration_id = frame_ids[i]
+            dlc = frame_dlcs[i]
+            is_extended_id = extended or arbitration_id > 0x7FF
+            data = self._payload(payload, dlc, i, rng)
+
+            msg_struct = self.msgs[i]
+            msg_struct.l_id = arbitration_id
+            msg_struct.by_len = dlc
+            msg_struct.by_extended = 2 if is_extended_id else 1
+            msg_struct.by_remote = 0
+            msg_struct.aby_data[:dlc] = list(data)
+
+            bits = frame_bits(arbitration_id, data, is_extended_id)
+            self.frame_bits.append(bits)
+            self._cumulative_bits.append(self._cumulative_bits[-1] + bits)
+
+        self.result = None
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    @staticmethod
+    def _payload(payload, dlc: int, index: int, rng) -> bytes:
+        if isinstance(payload, (bytes, bytearray)):
+            return bytes(payload[i % len(payload)] for i in range(dlc)) if payload else bytes(dlc)
+        if payload == "random":
+            return bytes(rng.getrandbits(8) for _ in range(dlc))
+        if payload == "counter":
+            return (index & 0xFFFFFFFFFFFFFFFF).to_bytes(8, "little")[:dlc]
+        if payload == "ones":
+            return b"\xff" * dlc
+        if payload == "alternating":
+            return b"\x55" * dlc
+        return bytes(dlc)
+
+    @property
+    def total_bits(self) -> int:
+        """The number of bit times the whole sequence occupies the bus for"""
+        return self._cumulative_bits[-1]
+
+    def max_frame_rate(self, bitrate: int) -> float:
+        """
+        :param bitrate: The bitrate of the bus in bit/s
+        :return: The frame rate of the sequence at 100% bus load
+        :rtype: float
+        """
+        return self.length * bitrate / self.total_bits
+
+    def _frames_for_bits(self, index: int, bits: float) -> int:
+        """The number of frames from ``index`` (without wrapping) that make up at least ``bits``"""
+        end = bisect_left(self._cumulative_bits, self._cumulative_bits[index] + bits, index + 1, self.length)
+        return end - index
+
+    def run(
+        self,
+        bus,
+        load_percent: float,
+        duration: float,
+        bitrate=None,
+        interval: float = 0.002,
+        busload_interval: float = 1.0,
+    ) -> GeneratorResult:
+        """
+        Sends the sequence repeatedly at the target bus load until ``duration`` has passed or :meth:`stop` is called.
+
+        Every ``interval`` the frames due since the start are queued with a single batched send, keeping one interval
+        of traffic queued ahead so the bus does not go idle between sends. Every ``busload_interval`` the bus load is
+        read back from the device, to verify the load achieved.
+
+        :param bus: A :class:`SontheimBus`, or any bus with ``send_batch`` and ``get_busload`` methods
+        :param load_percent: The target bus load in percent
+        :param duration: The time to send for in seconds
+        :param bitrate: The bitrate of the bus in bit/s, defaults to the bitrate the bus was opened with
+        :param interval: The time between batched sends in seconds
+        :param busload_interval: The time between bus load readings in seconds
+        :return:
+            The frames and bits sent, the elapsed time, the target load, the load achieved by the frames queued, the
+            mean bus load measured by the device (or None if it could not be read) and the individual readings
+        :rtype: GeneratorResult
+        """
+        bitrate = bitrate or bus.bitrate
+        bits_per_second = load_percent / 100 * bitrate
+        ahead_bits = bits_per_second * interval
+
+        index = 0
+        bits_sent = 0
+        frames_sent = 0
+        tx_buffer_full = 0
+        busload_samples = []
+        read_busload = True
+
+        start = time.perf_counter()
+        end = start + duration
+        next_busload_time = start + busload_interval
+        while not self._stop_event.is_set():
+            now = time.perf_counter()
+            if now >= end:
+                break
+            due_bits = (now - start) * bits_per_second + ahead_bits
+            while bits_sent < due_bits:
+                count = self._frames_for_bits(index, due_bits - bits_sent)
+                sent = bus.send_batch(self.msgs, count, index)
+                bits_sent += self._cumulative_bits[index + sent] - self._cumulative_bits[index]
+                frames_sent += sent
+                index = (index + sent) % self.length
+                if sent < count:
+                    tx_buffer_full += 1
+                    break  # the transmit buffer is full, retry on the next interval
+            if read_busload and now >= next_busload_time:
+                next_busload_time += busload_interval
+                try:
+                    busload_samples.append(bus.get_busload())
+                except CanOperationError as COE:
+                    log.warning("Bus load cannot be read, the achieved load will not be verified: %s", COE)
+                    read_busload = False
+            time.sleep(interval)
+
+        elapsed = time.perf_counter() - start
+        self._stop_event.clear()
+        achieved_load = 100 * bits_sent / (elapsed * bitrate) if elapsed > 0 else 0.0
+        self.result = GeneratorResult(
+            frames_sent=frames_sent,
+            bits_sent=bits_sent,
+            elapsed=elapsed,
+            target_load=load_percent,
+            achieved_load=achieved_load,
+            measured_load=statistics.mean(busload_samples) if busload_samples else None,
+            busload_samples=busload_samples,
+            tx_buffer_full=tx_buffer_full,
+        )
+        return self.result
+
+    def start(self, bus, load_percent: float, duration: float = float("inf"), **kwargs) -> None:
+        """
+        Calls :meth:`run` in a background thread. The result is available from :meth:`stop` or :attr:`result`.
+        """
+        self.result = None
+        self._stop_event.clear()
+        self._thread = threading.Thread(
+            target=self.run, args=(bus, load_percent, duration), kwargs=kwargs, name="SontheimTrafficGenerator"
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops sending and waits for the background thread, if one was started.
+
+        :return: The result of the run, or None if the generator was not running
+        :rtype: GeneratorResult
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        return self.result
@@ -0,0 +1,521 @@
+"""
+Indexed capture files with memory mapped random access for the SIE / IFM CANfox interface
+
+An indexed capture file holds fixed size frame records in blocks, followed by an index that is written when the file
+is closed. The index holds the first record, frame count and time range of every block (a sparse time index), and
+for every identifier the blocks it appears in (a per-ID block index). :class:`IndexedCaptureReader` memory maps the
+file, so a query for an ID and time range only touches the blocks that can hold matching frames, and frames are read
+straight from the page cache as NumPy views without decoding the rest of the file.
+
+File layout, all little endian:
+
+- a header of ``HEADER_SIZE`` bytes, see ``_HEADER``
+- the frame records, ``RECORD_DTYPE``
+- the block table, ``BLOCK_DTYPE``, the ID table, ``ID_DTYPE``, and the block numbers each ID entry points into
+
+Copyright (C) 2022 Matt Woodhead
+"""
+
+import logging
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+
+import can
+
+from .batch import BatchListener, HAS_NUMPY, as_array
+from .export import FLAG_EXTENDED, FLAG_REMOTE, FLAG_ERROR, FLAG_ECHO
+
+if HAS_NUMPY:
+    import numpy as np
+
+    RECORD_DTYPE = np.dtype(
+        [
+            ("timestamp", "<f8"),
+            ("arbitration_id", "<u4"),
+            ("flags", "u1"),  # the flags of the Parquet export, see can_sontheim.export
+            ("dlc", "u1"),
+            ("reserved", "<u2"),
+            ("data", "u1", (8,)),
+        ]
+    )
+    BLOCK_DTYPE = np.dtype(
+        [("first", "<u8"), ("count", "<u4"), ("reserved", "<u4"), ("t_min", "<f8"), ("t_max", "<f8")]
+    )
+    ID_DTYPE = np.dtype([("key", "<u4"), ("blocks", "<u4"), ("first_block", "<u8"), ("frames", "<u8")])
+else:
+    RECORD_DTYPE = BLOCK_DTYPE = ID_DTYPE = None
+
+
+log = logging.getLogger("can.sontheim")
+
+MAGIC = b"SIECAPIX"
+VERSION = 1
+HEADER_SIZE = 128
+# magic, version, record size, flags, block size, frames, index offset, blocks, IDs, block numbers, first and last time
+_HEADER = struct.Struct("<8sIIIIQQQQQdd")
+_MONOTONIC = 1  # header flag, set when the timestamps of the frames never decrease
+_EXTENDED_KEY = 1 << 31  # ID keys are the arbitration ID with bit 31 set for extended IDs
+
+
+def id_key(arbitration_id: int, is_extended_id: bool = True) -> int:
+    """
+    :return: The key of an identifier in the ID index
+    :rtype: int
+    """
+    return arbitration_id | (_EXTENDED_KEY if is_extended_id else 0)
+
+
+def _record_keys(records):
+    return records["arbitration_id"] | ((records["flags"] & FLAG_EXTENDED).astype(np.uint32) << 30)
+
+
+def _index_block(records) -> tuple:
+    """
+    :return: The time range of a block of records, and the keys of the IDs in it with their frame counts
+    """
+    timestamps = records["timestamp"]
+    keys, counts = np.unique(_record_keys(records), return_counts=True)
+    return float(timestamps.min()), float(timestamps.max()), keys, counts
+
+
+class _IndexBuilder:
+    """Accumulates the block table and the per-ID block lists as blocks are written"""
+
+    def __init__(self):
+        self.blocks = []
+        self.id_blocks = {}
+        self.id_frames = {}
+        self.frames = 0
+        self.monotonic = True
+        self.last_timestamp = -np.inf
+
+    def add(self, records) -> None:
+        t_min, t_max, keys, counts = _index_block(records)
+        timestamps = records["timestamp"]
+        if self.monotonic and (timestamps[0] < self.last_timestamp or np.any(np.diff(timestamps) < 0)):
+            self.monotonic = False
+        self.last_timestamp = timestamps[-1]
+        block = len(self.blocks)
+        self.blocks.append((self.frames, len(records), 0, t_min, t_max))
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            self.id_blocks.setdefault(key, []).append(block)
+            self.id_frames[key] = self.id_frames.get(key, 0) + count
+        self.frames += len(records)
+
+    def tables(self) -> tuple:
+        """:return: The block table, the ID table and the block numbers as NumPy arrays"""
+        blocks = np.array(self.blocks, dtype=BLOCK_DTYPE)
+        keys = sorted(self.id_blocks)
+        ids = np.zeros(len(keys), dtype=ID_DTYPE)
+        block_numbers = []
+        for row, key in enumerate(keys):
+            ids[row] = (key, len(self.id_blocks[key]), len(block_numbers), self.id_frames[key])
+            block_numbers.extend(self.id_blocks[key])
+        return blocks, ids, np.array(block_numbers, dtype="<u4")
+
+
+class IndexedCaptureWriter(BatchListener):
+    """
+    Writes every received frame to an indexed capture file.
+
+    Frames are copied from each receive batch into a block of ``block_size`` records. Full blocks, and partial blocks
+    whose oldest frame has waited ``flush_interval`` seconds, are handed to a writer thread, which appends them to the
+    file and adds them to the index. The writer thread takes partial blocks itself, so frames are written on an idle
+    bus as well. The index is written, and the file completed, when the writer is stopped. Files are rotated when
+    they reach ``max_bytes``, which keeps them small enough to memory map from a 32 bit Python interpreter.
+    """
+
+    def __init__(
+        self,
+        base_filename: str,
+        block_size: int = 4096,
+        flush_interval: float = 1.0,
+        max_bytes: int = None,
+        max_queued_blocks: int = 64,
+    ):
+        """
+        :param base_filename:
+            The path the files are written to. A rotation index is inserted before the extension, e.g.
+            ``capture.sidx`` is written as ``capture_0000.sidx``, ``capture_0001.sidx`` and so on.
+        :param block_size: The number of frames in each block of the index
+        :param flush_interval:
+            The longest time in seconds a frame is held before its block is written, or None to only write full blocks
+        :param max_bytes: Rotate to a new file once the current one is at least this many bytes
+        :param max_queued_blocks: The number of blocks that can wait for the writer thread
+        :raises ImportError: If NumPy is not installed
+        """
+        if not HAS_NUMPY:
+            raise ImportError("NumPy is required for indexed capture files")
+        root, ext = os.path.splitext(base_filename)
+        self._root = root
+        self._ext = ext or ".sidx"
+        self.block_size = block_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.files = []
+        self.frames_written = 0
+
+        self._stopped = False
+        self._lock = threading.Lock()  # guards the current block, which is swapped out by both threads
+        self._new_block()
+        self._queue = queue.Queue(maxsize=max_queued_blocks)
+        self._writer_thread = threading.Thread(target=self._run_writer, name="sontheim-indexed-writer", daemon=True)
+        self._writer_thread.start()
+
+    def _new_block(self) -> None:
+        self._block = np.zeros(self.block_size, dtype=RECORD_DTYPE)
+        self._length = 0
+        self._created = None  # the time the first frame was copied in
+
+    def on_batch(self, msgs, count: int, time_offset: float) -> None:
+        frames = as_array(msgs, count)
+        while len(frames):
+            with self._lock:
+                n = min(len(frames), self.block_size - self._length)
+                if not self._length:
+                    self._created = time.monotonic()
+                rows = self._block[self._length : self._length + n]
+                rows["timestamp"] = frames["ul_tstamp"][:n] / 10000 + time_offset
+                rows["arbitration_id"] = frames["l_id"][:n]
+                rows["flags"] = frames["by_extended"][:n] | ((frames["by_remote"][:n] & 1) << 2)
+                rows["dlc"] = frames["by_len"][:n] & 0x0F
+                rows["data"] = frames["aby_data"][:n]
+                self._length += n
+                block = self._take_block(full_only=True)
+            frames = frames[n:]
+            if block is not None:
+                # blocks if the writer has fallen behind, rather than letting memory grow without limit
+                self._queue.put(block)
+
+    def add_message(self, msg: can.Message) -> None:
+        """
+        Adds a :class:`can.Message` to the file, e.g. to index an existing recording.
+        """
+        flags = (FLAG_EXTENDED if msg.is_extended_id else 1) | (FLAG_REMOTE if msg.is_remote_frame else 0)
+        flags |= (FLAG_ERROR if msg.is_error_frame else 0) | (0 if msg.is_rx else FLAG_ECHO)
+        data = bytes(msg.data[:8])
+        with self._lock:
+            if not self._length:
+                self._created = time.monotonic()
+            record = (msg.timestamp, msg.arbitration_id, flags, msg.dlc, 0, tuple(data.ljust(8, b"\0")))
+            self._block[self._length] = record
+            self._length += 1
+            block = self._take_block(full_only=True)
+        if block is not None:
+            self._queue.put(block)
+
+    def _take_block(self, full_only: bool = False, stale_only: bool = False):
+        """
+        Swaps in an empty block, returning the frames of the current one if it holds any. Called with the lock held.
+
+        :param full_only: Only swap the block once it is full
+        :param stale_only: Only swap the block once its oldest frame has waited ``flush_interval`` seconds
+        """
+        if not self._length or (full_only and self._length < self.block_size):
+            return None
+        if stale_only and (self.flush_interval is None or time.monotonic() - self._created < self.flush_interval):
+            return None
+        block = self._block[: self._length]
+        self._new_block()
+        return block
+
+    def _flush(self) -> None:
+        with self._lock:
+            block = self._take_block()
+        if block is not None:
+            self._queue.put(block)
+
+    def _next_timeout(self):
+        """The time the writer thread can wait for a block before the current one has to be written"""
+        if self.flush_interval is None:
+            return None
+        with self._lock:
+            created = self._created if self._length else None
+        if created is None:
+            # poll often enough that a new frame waits little longer than flush_interval
+            return self.flush_interval / 4
+        return max(created + self.flush_interval - time.monotonic(), 0.0)
+
+    def _open_file(self):
+        filename = f"{self._root}_{len(self.files):04d}{self._ext}"
+        self.files.append(filename)
+        log.debug("Opening indexed capture file %s", filename)
+        file = open(filename, "w+b")  # pylint: disable=consider-using-with
+        # without an index offset, so that the file can still be read if the capture is interrupted
+        header = _HEADER.pack(MAGIC, VERSION, RECORD_DTYPE.itemsize, 0, self.block_size, 0, 0, 0, 0, 0, 0.0, 0.0)
+        file.write(header.ljust(HEADER_SIZE, b"\0"))
+        return file, _IndexBuilder()
+
+    def _close_file(self, file, index) -> None:
+        blocks, ids, block_numbers = index.tables()
+        index_offset = file.tell()
+        for table in (blocks, ids, block_numbers):
+            file.write(table.tobytes())
+        t_min = float(blocks["t_min"].min()) if len(blocks) else 0.0
+        t_max = float(blocks["t_max"].max()) if len(blocks) else 0.0
+        header = _HEADER.pack(
+            MAGIC,
+            VERSION,
+            RECORD_DTYPE.itemsize,
+            _MONOTONIC if index.monotonic else 0,
+            self.block_size,
+            index.frames,
+            index_offset,
+            len(blocks),
+            len(ids),
+            len(block_numbers),
+            t_min,
+            t_max,
+        )
+        file.seek(0)
+        file.write(header.ljust(HEADER_SIZE, b"\0"))
+        file.close()
+
+    def _run_writer(self) -> None:
+        file = index = None
+        while True:
+            try:
+                block = self._queue.get(timeout=self._next_timeout())
+            except queue.Empty:
+                # no full block arrived in time, so write the frames held longer than flush_interval
+                with self._lock:
+                    block = self._take_block(stale_only=True)
+                if block is None:
+                    continue
+            else:
+                if block is None:
+                    break
+            try:
+                if file is None:
+                    file, index = self._open_file()
+                file.write(block.tobytes())
+                file.flush()  # so the frames can be read whilst the capture continues
+                index.add(block)
+                self.frames_written += len(block)
+                if self.max_bytes is not None and file.tell() >= self.max_bytes:
+                    self._close_file(file, index)
+                    file = None
+            except Exception:  # pylint: disable=broad-except
+                log.exception("Error writing indexed capture file")
+        if file is not None:
+            self._close_file(file, index)
+
+    def stop(self) -> None:
+        """
+        Writes any collected frames, then writes the index and closes the current file.
+        """
+        if self._stopped:
+            return
+        self._stopped = True
+        self._flush()
+        self._queue.put(None)
+        self._writer_thread.join()
+
+
+class IndexedCaptureReader:
+    """
+    Random access to an indexed capture file through a memory map.
+
+    Queries return NumPy structured arrays of ``RECORD_DTYPE``. A query for a time range of a file whose timestamps
+    never decrease is a zero-copy view of the mapped file. Other queries only read the blocks the index selects, and
+    return a copy of the matching frames. A file that was not completed, e.g. because the capture was interrupted,
+    can still be read, and its index is rebuilt when it is opened.
+    """
+
+    def __init__(self, filename: str):
+        """
+        :param filename: The path of an indexed capture file
+        :raises ImportError: If NumPy is not installed
+        :raises ValueError: If the file is not an indexed capture file
+        """
+        if not HAS_NUMPY:
+            raise ImportError("NumPy is required for indexed capture files")
+        self.filename = filename
+        with open(filename, "rb") as file:
+            size = os.fstat(file.fileno()).st_size
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        header = bytes(self._mmap[: _HEADER.size]) if size >= HEADER_SIZE else b""
+        if len(header) < _HEADER.size or header[:8] != MAGIC:
+            self.close()
+            raise ValueError(f"{filename} is not an indexed capture file")
+        (
+            _,
+            version,
+            record_size,
+            flags,
+            self.block_size,
+            frames,
+            index_offset,
+            n_blocks,
+            n_ids,
+            n_block_numbers,
+            _,
+            _,
+        ) = _HEADER.unpack(header)
+
+        if index_offset:
+            if version != VERSION or record_size != RECORD_DTYPE.itemsize:
+                self.close()
+                raise ValueError(f"{filename} has an unsupported version or record size")
+            self.complete = True
+            self.monotonic = bool(flags & _MONOTONIC)
+            self.records = np.frombuffer(self._mmap, RECORD_DTYPE, frames, HEADER_SIZE)
+            offset = index_offset
+            self.blocks = np.frombuffer(self._mmap, BLOCK_DTYPE, n_blocks, offset)
+            offset += self.blocks.nbytes
+            self.ids = np.frombuffer(self._mmap, ID_DTYPE, n_ids, offset)
+            offset += self.ids.nbytes
+            self._block_numbers = np.frombuffer(self._mmap, "<u4", n_block_numbers, offset)
+        else:
+            # the capture was interrupted before the index was written
+            log.warning("%s has no index, rebuilding it", filename)
+            self.complete = False
+            frames = (size - HEADER_SIZE) // RECORD_DTYPE.itemsize
+            self.records = np.frombuffer(self._mmap, RECORD_DTYPE, frames, HEADER_SIZE)
+            self._rebuild_index(self.block_size)
+
+    def _rebuild_index(self, block_size: int) -> None:
+        self.block_size = block_size
+        index = _IndexBuilder()
+        for first in range(0, len(self.records), block_size):
+            index.add(self.records[first : first + block_size])
+        self.monotonic = index.monotonic
+        self.blocks, self.ids, self._block_numbers = index.tables()
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        """Releases the memory map. Arrays returned by queries must not be used afterwards."""
+        self.records = self.blocks = self.ids = self._block_numbers = None
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # views of the map are still referenced, it is released when they are
+                pass
+            self._mmap = None
+
+    @property
+    def time_range(self) -> tuple:
+        """The timestamps of the first and last frame in the file"""
+        if not len(self.blocks):
+            return None, None
+        return float(self.blocks["t_min"].min()), float(self.blocks["t_max"].max())
+
+    def frame_counts(self) -> dict:
+        """
+        :return: The number of frames of every identifier, by (arbitration ID, is extended) tuple
+        :rtype: dict
+        """
+        return {
+            (key & ~_EXTENDED_KEY, bool(key & _EXTENDED_KEY)): frames
+            for key, frames in zip(self.ids["key"].tolist(), self.ids["frames"].tolist())
+        }
+
+    def _candidate_blocks(self, key, start, end):
+        if key is None:
+            candidates = np.arange(len(self.blocks))
+        else:
+            row = np.searchsorted(self.ids["key"], key)
+            if row == len(self.ids) or self.ids["key"][row] != key:
+                return np.arange(0)
+            first = int(self.ids["first_block"][row])
+            candidates = self._block_numbers[first : first + int(self.ids["blocks"][row])]
+        blocks = self.blocks[candidates]
+        overlap = np.ones(len(candidates), dtype=bool)
+        if start is not None:
+            overlap &= blocks["t_max"] >= start
+        if end is not None:
+            overlap &= blocks["t_min"] < end
+        return candidates[overlap]
+
+    def select(self, arbitration_id: int = None, start: float = None, end: float = None, is_extended_id=None):
+        """
+        Returns the frames of an identifier and time range.
+
+        :param arbitration_id: The identifier of the frames, or None for frames of every identifier
+        :param start: The earliest timestamp of the frames, or None from the start of the file
+        :param end: The timestamp the frames are before, or None to the end of the file
+        :param is_extended_id:
+            Whether ``arbitration_id`` is a 29 bit identifier. By default identifiers above 0x7FF are extended.
+        :return:
+            A structured array of ``RECORD_DTYPE``. For a time range of a file whose timestamps never decrease it is a
+            read-only view of the file, otherwise it is a copy of the matching frames.
+        """
+        key = None
+        if arbitration_id is not None:
+            if is_extended_id is None:
+                is_extended_id = arbitration_id > 0x7FF
+            key = id_key(arbitration_id, is_extended_id)
+        candidates = self._candidate_blocks(key, start, end)
+        if not len(candidates):
+            return self.records[:0]
+
+        if key is None and self.monotonic:
+            first = int(self.blocks["first"][candidates[0]])
+            last = int(self.blocks["first"][candidates[-1]] + self.blocks["count"][candidates[-1]])
+            view = self.records[first:last]
+            timestamps = view["timestamp"]
+            lower = 0 if start is None else np.searchsorted(timestamps, start, "left")
+            upper = len(view) if end is None else np.searchsorted(timestamps, end, "left")
+            return view[lower:upper]
+
+        selected = []
+        for block in candidates.tolist():
+            first = int(self.blocks["first"][block])
+            frames = self.records[first : first + int(self.blocks["count"][block])]
+            mask = np.ones(len(frames), dtype=bool)
+            if key is not None:
+                mask &= _record_keys(frames) == key
+            if start is not None:
+                mask &= frames["timestamp"] >= start
+            if end is not None:
+                mask &= frames["timestamp"] < end
+            selected.append(frames[mask])
+        return np.concatenate(selected)
+
+    def messages(self, arbitration_id: int = None, start: float = None, end: float = None, is_extended_id=None):
+        """
+        Yields the frames of an identifier and time range as :class:`can.Message` objects, see :meth:`select`.
+        """
+        for frame in self.select(arbitration_id, start, end, is_extended_id).tolist():
+            timestamp, arbitration_id_, flags, dlc, _, data = frame
+            yield can.Message(
+                timestamp=timestamp,
+                arbitration_id=arbitration_id_,
+                is_extended_id=bool(flags & FLAG_EXTENDED),
+                is_remote_frame=bool(flags & FLAG_REMOTE),
+                is_error_frame=bool(flags & FLAG_ERROR),
+                is_rx=not flags & FLAG_ECHO,
+                dlc=dlc,
+                data=bytes(data[:dlc]),
+            )
+
+
+def index_log(source: str, destination: str, block_size: int = 4096) -> list:
+    """
+    Converts a recording in any format :class:`can.LogReader` supports, e.g. ASC or BLF, to an indexed capture file.
+
+    :param source: The path of the recording
+    :param destination: The base filename of the indexed capture file, see :class:`IndexedCaptureWriter`
+    :return: The indexed capture files written
+    :rtype: list
+    """
+    writer = IndexedCaptureWriter(destination, block_size=block_size, flush_interval=None)
+    try:
+        for msg in can.LogReader(source):
+            writer.add_message(msg)
+    finally:
+        writer.stop()
+    return writer.files
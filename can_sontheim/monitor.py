@@ -0,0 +1,313 @@
+"""
+Background physical layer monitoring for the SIE / IFM CANfox interface
+
+``canGetCanLevelHist`` reads the passive CAN level measurement of adapters fitted with it. The firmware samples the
+CAN HIGH and CAN LOW levels roughly every 5 ms while there is traffic on the bus, and accumulates a histogram with
+0.1 V buckets together with the mean and variance of each dominant and recessive level. A :class:`LevelMonitor`
+reads these accumulators on its own schedule in a background thread, turns the difference between two reads into one
+sample per interval, and keeps rolling histograms and trend statistics of the samples. Nothing is transmitted, so
+the traffic on the bus and the receive loop of the application are not disturbed.
+
+Copyright (C) 2022 Matt Woodhead
+"""
+
+from collections import deque, namedtuple
+import logging
+import math
+import threading
+import time
+
+try:
+    import numpy as np
+
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+
+log = logging.getLogger("can.sontheim")
+
+LEVEL_BUCKETS = 50
+LEVEL_STEP = 0.1  # the histogram bucket at index i counts measurements of i * 0.1 V
+# the (count, mean, variance) fields of CANLevelHistStruct for each level
+LEVEL_FIELDS = {
+    "low_recessive": ("ulMeasureCountLowRez", "dAvgLevelLowRez", "dVariLevelLowRez"),
+    "high_recessive": ("ulMeasureCountHighRez", "dAvgLevelHighRez", "dVariLevelHighRez"),
+    "low_dominant": ("ulMeasureCountLowDom", "dAvgLevelLowDom", "dVariLevelLowDom"),
+    "high_dominant": ("ulMeasureCountHighDom", "dAvgLevelHighDom", "dVariLevelHighDom"),
+}
+LEVELS = tuple(LEVEL_FIELDS)
+TRENDS = LEVELS + ("dominant_differential", "recessive_differential")
+
+LevelSample = namedtuple(
+    "LevelSample",
+    ["timestamp", "measurements", "levels", "deviations", "dominant_differential", "recessive_differential"],
+)
+LevelWarning = namedtuple("LevelWarning", ["timestamp", "kind", "value", "limit", "message"])
+
+
+def _moments(histogram, count_field, mean_field, variance_field):
+    """The number of measurements of one level, and the sum and sum of squares of the measurements"""
+    count = histogram[count_field]
+    mean = histogram[mean_field]
+    return count, count * mean, count * (histogram[variance_field] + mean * mean)
+
+
+def _interval_level(current, previous, *fields):
+    """
+    The number of measurements, mean and standard deviation of one level between two reads of the accumulators.
+
+    :return: A (count, mean, deviation) tuple, with NaN mean and deviation if there were no measurements
+    """
+    count, total, squares = (
+        now - before for now, before in zip(_moments(current, *fields), _moments(previous, *fields))
+    )
+    if count <= 0:
+        return 0, math.nan, math.nan
+    mean = total / count
+    return count, mean, math.sqrt(max(squares / count - mean * mean, 0.0))
+
+
+def _trend(times, values) -> float:
+    """The least squares slope of ``values`` against ``times`` in units per hour, ignoring NaN values"""
+    valid = ~np.isnan(values)
+    if np.count_nonzero(valid) < 2:
+        return math.nan
+    x = times[valid] - times[valid].mean()
+    sxx = np.dot(x, x)
+    if sxx == 0:
+        return math.nan
+    return float(np.dot(x, values[valid] - values[valid].mean()) / sxx * 3600)
+
+
+class LevelMonitor:
+    """
+    Samples the passive CAN level measurement of an adapter in a background thread.
+
+    Every ``interval`` seconds the accumulators are read and the measurements since the previous read become one
+    :class:`LevelSample`. The most recent ``window`` samples are kept in NumPy arrays, from which the rolling CAN HIGH
+    and CAN LOW histograms and the mean, range and trend of every level are calculated.
+
+    Each sample is checked against the limits below, and a :class:`LevelWarning` is raised when a check starts to
+    fail. Warnings are logged, kept in :attr:`warnings` and passed to ``callback``. A warning is raised again only
+    after its check has passed in between.
+    """
+
+    def __init__(
+        self,
+        read_histogram,
+        interval: float = 5.0,
+        window: int = 720,
+        dominant_differential=(1.5, 3.0),
+        recessive_differential=(-0.5, 0.5),
+        max_deviation: float = 0.25,
+        max_drift: float = 0.1,
+        min_trend_samples: int = 12,
+        callback=None,
+    ):
+        """
+        :param read_histogram:
+            Called with a reset flag to read the accumulators, returns the fields of
+            :class:`~can_sontheim.structures.CANLevelHistStruct` by name, e.g. :meth:`SontheimBus.get_level_histogram`
+        :param interval: The time in seconds between samples
+        :param window: The number of samples the rolling histograms and statistics are calculated over
+        :param dominant_differential:
+            The (minimum, maximum) dominant differential voltage in V, ISO 11898-2 allows 1.5 V to 3.0 V
+        :param recessive_differential: The (minimum, maximum) recessive differential voltage in V
+        :param max_deviation: The largest standard deviation of any level within a sample in V
+        :param max_drift: The largest trend of the dominant differential voltage in V per hour
+        :param min_trend_samples: The number of samples needed before the trend is checked
+        :param callback: Called from the monitor thread with each :class:`LevelWarning`
+        :raises ImportError: If NumPy is not installed
+        """
+        if not HAS_NUMPY:
+            raise ImportError("NumPy is required for CAN level monitoring")
+        self._read_histogram = read_histogram
+        self.interval = interval
+        self.window = window
+        self.dominant_differential = dominant_differential
+        self.recessive_differential = recessive_differential
+        self.max_deviation = max_deviation
+        self.max_drift = max_drift
+        self.min_trend_samples = min_trend_samples
+        self.callback = callback
+
+        self._lock = threading.Lock()
+        self._times = np.full(window, np.nan)
+        self._histograms = np.zeros((window, 2, LEVEL_BUCKETS), dtype=np.int64)
+        self._values = np.full((window, len(TRENDS)), np.nan)
+        self._deviations = np.full((window, len(LEVELS)), np.nan)
+        self._samples = 0
+        self._previous = None
+        self._active_warnings = set()
+        self.latest = None
+        self.warnings = deque(maxlen=100)
+        self.failures = 0
+
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        """Resets the accumulators of the adapter, which starts the measurement, and starts the monitor thread"""
+        if self._thread is not None:
+            return
+        # the read returns the accumulators from before the reset, so the first poll starts from zero instead
+        self._read_histogram(True)
+        self._previous = None
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, args=(self._stop_event,), name="sontheim-level-monitor", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stops the monitor thread, keeping the samples collected so far"""
+        thread, self._thread = self._thread, None
+        self._stop_event.set()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _run(self, stop_event) -> None:
+        while not stop_event.wait(self.interval):
+            try:
+                self.poll()
+            except Exception as e:  # pylint: disable=broad-except
+                self.failures += 1
+                log.debug("CAN level measurement failed: %s", e)
+
+    @staticmethod
+    def _as_dict(histogram) -> dict:
+        return histogram._asdict() if hasattr(histogram, "_asdict") else dict(histogram)
+
+    def poll(self):
+        """
+        Reads the accumulators and adds the measurements since the previous read as a sample. This is called by the
+        monitor thread, and can be called directly instead of starting it.
+
+        :return: The new sample, or None if there were no measurements since the previous read
+        :rtype: LevelSample
+        """
+        current = self._as_dict(self._read_histogram(False))
+        previous = self._previous
+        self._previous = current
+        if previous is None or current["ulMeasureCountAll"] < previous["ulMeasureCountAll"]:
+            # the first read since the reset, or the accumulators were reset again, e.g. after the adapter was
+            # reopened, so the sample holds every measurement read
+            previous = dict.fromkeys(current, 0)
+            previous["arr_LevelLow"] = previous["arr_LevelHigh"] = (0,) * LEVEL_BUCKETS
+        measurements = current["ulMeasureCountAll"] - previous["ulMeasureCountAll"]
+        if measurements <= 0:
+            return None
+
+        histogram = np.array([current["arr_LevelLow"], current["arr_LevelHigh"]], dtype=np.int64) - np.array(
+            [previous["arr_LevelLow"], previous["arr_LevelHigh"]], dtype=np.int64
+        )
+        levels = {}
+        deviations = {}
+        for name, fields in LEVEL_FIELDS.items():
+            _, levels[name], deviations[name] = _interval_level(current, previous, *fields)
+        sample = LevelSample(
+            timestamp=time.time(),
+            measurements=measurements,
+            levels=levels,
+            deviations=deviations,
+            dominant_differential=levels["high_dominant"] - levels["low_dominant"],
+            recessive_differential=levels["high_recessive"] - levels["low_recessive"],
+        )
+
+        with self._lock:
+            index = self._samples % self.window
+            self._times[index] = sample.timestamp
+            self._histograms[index] = histogram
+            self._values[index] = [levels[name] for name in LEVELS] + [
+                sample.dominant_differential,
+                sample.recessive_differential,
+            ]
+            self._deviations[index] = [deviations[name] for name in LEVELS]
+            self._samples += 1
+            self.latest = sample
+        self._check(sample)
+        return sample
+
+    def _check(self, sample) -> None:
+        failing = {}
+        low, high = self.dominant_differential
+        if not math.isnan(sample.dominant_differential) and not low <= sample.dominant_differential <= high:
+            failing["dominant_differential"] = (sample.dominant_differential, self.dominant_differential)
+        low, high = self.recessive_differential
+        if not math.isnan(sample.recessive_differential) and not low <= sample.recessive_differential <= high:
+            failing["recessive_differential"] = (sample.recessive_differential, self.recessive_differential)
+        deviation = max((value for value in sample.deviations.values() if not math.isnan(value)), default=0.0)
+        if deviation > self.max_deviation:
+            failing["deviation"] = (deviation, self.max_deviation)
+        with self._lock:
+            valid = ~np.isnan(self._values[:, TRENDS.index("dominant_differential")])
+            drift = math.nan
+            if np.count_nonzero(valid) >= self.min_trend_samples:
+                drift = _trend(self._times, self._values[:, TRENDS.index("dominant_differential")])
+        if not math.isnan(drift) and abs(drift) > self.max_drift:
+            failing["drift"] = (drift, self.max_drift)
+
+        for kind, (value, limit) in failing.items():
+            if kind not in self._active_warnings:
+                self._warn(sample.timestamp, kind, value, limit)
+        self._active_warnings = set(failing)
+
+    def _warn(self, timestamp: float, kind: str, value: float, limit) -> None:
+        descriptions = {
+            "dominant_differential": "dominant differential voltage %.2f V is outside %s V",
+            "recessive_differential": "recessive differential voltage %.2f V is outside %s V",
+            "deviation": "level standard deviation %.3f V is above %s V",
+            "drift": "dominant differential voltage is drifting by %.3f V per hour, above %s V per hour",
+        }
+        warning = LevelWarning(timestamp, kind, value, limit, descriptions[kind] % (value, limit))
+        log.warning("CAN level warning: %s", warning.message)
+        self.warnings.append(warning)
+        if self.callback is not None:
+            try:
+                self.callback(warning)
+            except Exception as e:  # pylint: disable=broad-except
+                log.error("CAN level warning callback raised an exception: %s", e)
+
+    def histogram(self) -> dict:
+        """
+        :return:
+            The bucket voltages and the number of CAN LOW and CAN HIGH measurements in each bucket over the samples in
+            the window, as NumPy arrays
+        :rtype: dict
+        """
+        with self._lock:
+            totals = self._histograms.sum(axis=0)
+        return {"volts": np.arange(LEVEL_BUCKETS) * LEVEL_STEP, "can_low": totals[0], "can_high": totals[1]}
+
+    def statistics(self) -> dict:
+        """
+        :return:
+            The number of samples in the window and failed reads, and for every level and differential voltage the
+            latest, mean, minimum and maximum value in V, the largest standard deviation within a sample in V and the
+            trend in V per hour. Values are NaN when there were no measurements of the level, e.g. no dominant levels
+            are measured without traffic on the bus.
+        :rtype: dict
+        """
+        with self._lock:
+            times = self._times.copy()
+            values = self._values.copy()
+            deviations = self._deviations.copy()
+            samples = min(self._samples, self.window)
+            latest = (self._samples - 1) % self.window
+        result = {"samples": samples, "failures": self.failures}
+        for column, name in enumerate(TRENDS):
+            series = values[:, column]
+            valid = series[~np.isnan(series)]
+            result[name] = {
+                "latest": float(series[latest]) if samples else math.nan,
+                "mean": float(valid.mean()) if valid.size else math.nan,
+                "min": float(valid.min()) if valid.size else math.nan,
+                "max": float(valid.max()) if valid.size else math.nan,
+                "trend": _trend(times, series),
+            }
+            if column < len(LEVELS):
+                deviation = deviations[:, column]
+                deviation = deviation[~np.isnan(deviation)]
+                result[name]["max_deviation"] = float(deviation.max()) if deviation.size else math.nan
+        return result
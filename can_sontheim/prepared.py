@@ -0,0 +1,67 @@
+"""
+Prepared frames for allocation free repeated transmission on the SIE / IFM CANfox interface
+
+Copyright (C) 2022 Matt Woodhead
+"""
+
+from ctypes import c_long, byref
+
+from can.exceptions import CanOperationError, CanTimeoutError
+
+from .constants import NTCAN_SUCCESS, NTCAN_TX_TIMEOUT
+
+
+class PreparedFrame:
+    """
+    A frame encoded once into a persistent CMSG record, for sending the same ID repeatedly with a changing payload.
+
+    The ID, flags and data length are converted when the frame is prepared. The payload is updated in place through
+    :attr:`data`, a writable :class:`memoryview` onto the data bytes of the record, and :meth:`send` passes the
+    record to ``canSend`` through references created up front, so sending allocates nothing per call.
+
+    Prepared frames are created with :meth:`SontheimBus.prepare_frame`, and are only valid whilst the bus is open.
+    """
+
+    __slots__ = ("msg_struct", "data", "_send", "_handle", "_msg_ref", "_count", "_count_ref")
+
+    def __init__(self, send_function, handle, msg_struct):
+        """
+        :param send_function:
+            The ``canSend`` function of the MT_API library, or a function with the same arguments and return codes
+        :param handle: The HANDLE the frame is sent on
+        :param msg_struct: The encoded :class:`CANMsgStruct`, which is kept and reused for every send
+        """
+        self.msg_struct = msg_struct
+        self.data = memoryview(msg_struct.aby_data).cast("B")
+        self._send = send_function
+        self._handle = handle
+        self._msg_ref = byref(msg_struct)
+        self._count = c_long(1)
+        self._count_ref = byref(self._count)
+
+    @property
+    def dlc(self) -> int:
+        """The data length code of the frame"""
+        return self.msg_struct.by_len
+
+    @dlc.setter
+    def dlc(self, dlc: int) -> None:
+        if not 0 <= dlc <= 8:
+            raise ValueError("The data length code must be between 0 and 8")
+        self.msg_struct.by_len = dlc
+
+    def send(self) -> None:
+        """
+        Queues the frame, with the current contents of :attr:`data`, for transmission.
+
+        :raises CanTimeoutError: If the transmit buffer stays full until the transmit timeout expires
+        :raises CanOperationError: If the MT_API returns any other error
+        """
+        self._count.value = 1  # the driver overwrites the count with the number of frames queued
+        error_code = self._send(self._handle, self._msg_ref, self._count_ref)
+        if error_code != NTCAN_SUCCESS:
+            if error_code == NTCAN_TX_TIMEOUT:
+                raise CanTimeoutError("Timeout whilst attempting to send message")
+            raise CanOperationError(
+                f"Error encountered whilst trying to write to bus, [Error Code: {error_code}]",
+            )
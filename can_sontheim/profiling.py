@@ -0,0 +1,184 @@
+"""
+Opt-in profiling of MT_API calls and receive/transmit stages for the SIE / IFM CANfox interface
+
+Profiling is enabled per bus with the ``profile=True`` argument, or for every bus by setting the
+``CAN_SONTHEIM_PROFILE`` environment variable to ``1``. When it is disabled the bus calls the DLL directly and no
+timing code runs.
+
+Copyright (C) 2022 Matt Woodhead
+"""
+
+from collections import Counter
+import os
+import threading
+import time
+
+from .constants import _DLL_FUNCTIONS, NTCAN_SUCCESS
+
+
+PROFILE_ENV_VAR = "CAN_SONTHEIM_PROFILE"
+
+# canReadNoWait and canRead are called without being mapped, as their buffer argument varies in size
+_UNMAPPED_FUNCTIONS = ["canReadNoWait", "canRead"]
+
+_NUM_BUCKETS = 64
+
+
+def profiling_enabled(requested=None) -> bool:
+    """
+    :param requested: The value of the ``profile`` bus argument, which takes precedence over the environment
+    :return: Whether profiling should be enabled
+    """
+    if requested is not None:
+        return bool(requested)
+    return os.environ.get(PROFILE_ENV_VAR, "0") not in ("", "0")
+
+
+class LatencyHistogram:
+    """
+    A histogram of durations with logarithmic (power of two nanosecond) buckets. Bucket ``i`` counts durations from
+    ``2 ** (i - 1)`` up to ``2 ** i`` nanoseconds.
+    """
+
+    def __init__(self):
+        self.buckets = [0] * _NUM_BUCKETS
+        self.count = 0
+        self.total_ns = 0
+        self.min_ns = None
+        self.max_ns = 0
+
+    def record(self, duration_ns: int) -> None:
+        self.buckets[min(duration_ns.bit_length(), _NUM_BUCKETS - 1)] += 1
+        self.count += 1
+        self.total_ns += duration_ns
+        if self.min_ns is None or duration_ns < self.min_ns:
+            self.min_ns = duration_ns
+        if duration_ns > self.max_ns:
+            self.max_ns = duration_ns
+
+    def percentile(self, fraction: float):
+        """
+        :param fraction: The fraction of durations below the result, e.g. 0.99
+        :return: The upper bound in nanoseconds of the bucket holding the percentile, or None if nothing is recorded
+        """
+        if not self.count:
+            return None
+        target = fraction * self.count
+        cumulative = 0
+        for i, bucket in enumerate(self.buckets):
+            cumulative += bucket
+            if cumulative >= target:
+                return min(2**i, self.max_ns)
+        return self.max_ns
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "mean_ns": self.total_ns / self.count if self.count else None,
+            "min_ns": self.min_ns,
+            "max_ns": self.max_ns,
+            "p50_ns": self.percentile(0.5),
+            "p99_ns": self.percentile(0.99),
+            "buckets": {2**i: n for i, n in enumerate(self.buckets) if n},
+        }
+
+
+class CallStatistics:
+    """The call count, return codes and latency of one DLL function"""
+
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.error_codes = Counter()
+
+    def snapshot(self) -> dict:
+        result = self.latency.snapshot()
+        result["calls"] = result.pop("count")
+        result["error_codes"] = dict(self.error_codes)
+        return result
+
+
+class Profiler:
+    """
+    Collects DLL call statistics and stage timings for one bus.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def wrap_library(self, library):
+        """
+        :param library: The loaded MT_API library
+        :return: A :class:`ProfiledLibrary` that records every call into this profiler
+        """
+        return ProfiledLibrary(library, self)
+
+    def record_call(self, name: str, duration_ns: int, result) -> None:
+        with self._lock:
+            statistics = self.calls.get(name)
+            if statistics is None:
+                statistics = self.calls[name] = CallStatistics()
+            statistics.latency.record(duration_ns)
+            if result != NTCAN_SUCCESS:
+                statistics.error_codes[result] += 1
+
+    def record_stage(self, name: str, duration_ns: int) -> None:
+        with self._lock:
+            histogram = self.stages.get(name)
+            if histogram is None:
+                histogram = self.stages[name] = LatencyHistogram()
+            histogram.record(duration_ns)
+
+    def snapshot(self) -> dict:
+        """
+        :return:
+            A dictionary with a ``"dll"`` entry holding the statistics of every DLL function called, and a
+            ``"stages"`` entry holding the latency of every stage timed
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                "dll": {name: statistics.snapshot() for name, statistics in self.calls.items()},
+                "stages": {name: histogram.snapshot() for name, histogram in self.stages.items()},
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self.calls.clear()
+            self.stages.clear()
+
+
+class ProfiledLibrary:
+    """
+    Wraps the MT_API library so that every mapped function records its latency and return code in a
+    :class:`Profiler`. Attributes that are not DLL functions are passed through unchanged.
+    """
+
+    def __init__(self, library, profiler: Profiler):
+        self._library = library
+        self._profiler = profiler
+        for function, _, _ in _DLL_FUNCTIONS:
+            self._wrap(function)
+        for function in _UNMAPPED_FUNCTIONS:
+            self._wrap(function)
+
+    def _wrap(self, name: str) -> None:
+        try:
+            function = getattr(self._library, name)
+        except AttributeError:
+            return  # not exported by this version of the DLL
+        record_call = self._profiler.record_call
+        perf_counter_ns = time.perf_counter_ns
+
+        def profiled(*args):
+            start = perf_counter_ns()
+            result = function(*args)
+            record_call(name, perf_counter_ns() - start, result)
+            return result
+
+        profiled.__name__ = name
+        setattr(self, name, profiled)
+
+    def __getattr__(self, item: str):
+        return getattr(self._library, item)
@@ -0,0 +1,229 @@
+"""
+Automatic bus-off and reconnect recovery for the SIE / IFM CANfox interface
+
+Copyright (C) 2022 Matt Woodhead
+"""
+
+from collections import Counter, deque
+import logging
+import threading
+import time
+
+from can.exceptions import CanError, CanOperationError
+
+from .constants import (
+    NTCAN_CONTR_BUSOFF,
+    NTCAN_INVALID_HANDLE,
+    NTCAN_CHANNEL_NOT_INITIALIZED,
+    NTCAN_HARDWARE_NOT_FOUND,
+    NTCAN_NET_NOT_AVAILABLE,
+    NTCAN_HARDWARENOTACTIVE,
+    NTCAN_CHANNEL_CURR_NOT_AVAILABLE,
+)
+
+
+log = logging.getLogger("can.sontheim")
+
+# The controller is still open after a bus-off, so restarting it is enough
+BUS_OFF_ERRORS = frozenset([NTCAN_CONTR_BUSOFF])
+# The handle or the adapter has gone, e.g. the adapter was unplugged, so the channel has to be opened again
+DEVICE_LOST_ERRORS = frozenset(
+    [
+        NTCAN_INVALID_HANDLE,
+        NTCAN_CHANNEL_NOT_INITIALIZED,
+        NTCAN_HARDWARE_NOT_FOUND,
+        NTCAN_NET_NOT_AVAILABLE,
+        NTCAN_HARDWARENOTACTIVE,
+        NTCAN_CHANNEL_CURR_NOT_AVAILABLE,
+    ]
+)
+RECOVERABLE_ERRORS = BUS_OFF_ERRORS | DEVICE_LOST_ERRORS
+
+
+class BusRecovery:
+    """
+    Recovers a bus in a background thread when the driver reports a bus-off or a lost adapter.
+
+    A bus-off is first handled by restarting the controller. If that fails, or the adapter was lost, the channel is
+    opened again with the configuration cached by the bus, retrying until ``timeout`` expires. Frames sent whilst the
+    bus is recovering are held in a backlog of up to ``backlog_size`` frames and sent once it has recovered.
+
+    A recovery that gives up is final: no further recovery is started, and :meth:`check` raises from then on, so the
+    bus reports the failure rather than buffering and dropping frames indefinitely.
+    """
+
+    def __init__(
+        self,
+        restart_controller,
+        reopen,
+        send_record,
+        on_recovered=None,
+        timeout: float = 30.0,
+        retry_interval: float = 0.5,
+        backlog_size: int = 1000,
+    ):
+        """
+        :param restart_controller: Called to restart the controller after a bus-off, raises a CanError on failure
+        :param reopen: Called to close and open the channel again, raises a CanError on failure
+        :param send_record: Called with each CMSG record in the backlog once the bus has recovered
+        :param on_recovered: Called after each successful recovery, before the backlog is sent
+        :param timeout: The time in seconds to keep retrying before giving up
+        :param retry_interval: The time in seconds between attempts to open the channel
+        :param backlog_size: The number of frames held whilst recovering, the oldest are dropped beyond this
+        """
+        self._restart_controller = restart_controller
+        self._reopen = reopen
+        self._send_record = send_record
+        self._on_recovered = on_recovered
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+
+        self._lock = threading.Lock()
+        self._recovered = threading.Event()
+        self._recovered.set()
+        self._thread = None
+        self._backlog = deque(maxlen=backlog_size)
+        self.failed = False
+        self._failed_cause = None
+
+        self.recoveries = Counter()
+        self.attempts = 0
+        self.failures = 0
+        self.frames_buffered = 0
+        self.frames_dropped = 0
+        self.frames_replayed = 0
+        self.last_duration = None
+        self.max_duration = 0.0
+        self._total_duration = 0.0
+
+    @property
+    def recovering(self) -> bool:
+        """Whether a recovery is in progress"""
+        return not self._recovered.is_set()
+
+    def trigger(self, error_code: int) -> None:
+        """
+        Starts a recovery for an error reported by the driver, unless one is already in progress or a previous
+        recovery failed.
+
+        :param error_code: One of :data:`RECOVERABLE_ERRORS`
+        """
+        with self._lock:
+            if self.recovering or self.failed:
+                return
+            self._recovered.clear()
+            self._thread = threading.Thread(
+                target=self._run, args=(error_code,), name="sontheim-bus-recovery", daemon=True
+            )
+            self._thread.start()
+
+    def wait(self, timeout=None) -> bool:
+        """
+        Waits for a recovery in progress to finish.
+
+        :return: Whether the bus is usable, i.e. it is not recovering and the last recovery did not fail
+        """
+        self._recovered.wait(timeout)
+        return not self.recovering and not self.failed
+
+    def check(self) -> None:
+        """
+        :raises CanOperationError: If a recovery failed, after which the bus has to be shut down and opened again
+        """
+        if self.failed:
+            raise CanOperationError(
+                f"The bus could not be recovered from {self._failed_cause} within {self.timeout} s",
+            )
+
+    def buffer(self, msg_struct) -> bool:
+        """
+        Adds a frame to the backlog if a recovery is in progress.
+
+        :return: Whether the frame was buffered. If it was not, the bus has recovered and the frame should be sent.
+        """
+        with self._lock:
+            if not self.recovering:
+                return False
+            if len(self._backlog) == self._backlog.maxlen:
+                self.frames_dropped += 1
+            self._backlog.append(msg_struct)
+            self.frames_buffered += 1
+            return True
+
+    def _run(self, error_code: int) -> None:
+        cause = "bus_off" if error_code in BUS_OFF_ERRORS else "device_lost"
+        log.warning("Sontheim bus error %s, recovering (%s)", error_code, cause)
+        start = time.perf_counter()
+        recovered = False
+        if cause == "bus_off":
+            recovered = self._attempt(self._restart_controller)
+        deadline = start + self.timeout
+        while not recovered and time.perf_counter() < deadline:
+            recovered = self._attempt(self._reopen)
+            if not recovered:
+                time.sleep(self.retry_interval)
+
+        duration = time.perf_counter() - start
+        if recovered:
+            self.recoveries[cause] += 1
+            self.last_duration = duration
+            self.max_duration = max(self.max_duration, duration)
+            self._total_duration += duration
+            log.info("Sontheim bus recovered from %s in %.3f s", cause, duration)
+            if self._on_recovered is not None:
+                self._on_recovered()
+            self._replay_backlog()
+        else:
+            self.failures += 1
+            with self._lock:
+                self._failed_cause = cause
+                self.failed = True
+                self.frames_dropped += len(self._backlog)
+                self._backlog.clear()
+                self._recovered.set()
+            log.error("Sontheim bus could not be recovered from %s within %s s", cause, self.timeout)
+
+    def _attempt(self, action) -> bool:
+        self.attempts += 1
+        try:
+            action()
+        except CanError as CE:
+            log.debug("Recovery attempt failed: %s", CE)
+            return False
+        return True
+
+    def _replay_backlog(self) -> None:
+        # frames sent whilst the backlog is replayed are added to its end, so the order of frames is kept
+        while True:
+            with self._lock:
+                if not self._backlog:
+                    self._recovered.set()
+                    return
+                msg_struct = self._backlog.popleft()
+            try:
+                self._send_record(msg_struct)
+                self.frames_replayed += 1
+            except CanError as CE:
+                self.frames_dropped += 1
+                log.warning("Failed to send a buffered frame after recovery: %s", CE)
+
+    def metrics(self) -> dict:
+        """
+        :return:
+            The number of recoveries by cause, attempts and failed recoveries, the last, mean and longest recovery
+            time in seconds, and the number of frames buffered, replayed and dropped
+        :rtype: dict
+        """
+        count = sum(self.recoveries.values())
+        return {
+            "recovering": self.recovering,
+            "recoveries": dict(self.recoveries),
+            "attempts": self.attempts,
+            "failures": self.failures,
+            "last_duration": self.last_duration,
+            "mean_duration": self._total_duration / count if count else None,
+            "max_duration": self.max_duration,
+            "frames_buffered": self.frames_buffered,
+            "frames_replayed": self.frames_replayed,
+            "frames_dropped": self.frames_dropped,
+        }
@@ -0,0 +1,199 @@
+"""
+Latest frame snapshot table for the SIE / IFM CANfox interface
+
+Copyright (C) 2022 Matt Woodhead
+"""
+
+from array import array
+from collections import namedtuple
+import time
+
+from .batch import BatchListener
+
+
+STANDARD_ID_SLOTS = 2048  # one slot per 11 bit identifier, as in the aby_ID[2048] array of CANIDStatusStruct
+_MIN_EXTENDED_GROWTH = 64  # extended identifier slots added when a table without any grows
+
+LatestFrame = namedtuple(
+    "LatestFrame",
+    ["arbitration_id", "is_extended_id", "is_remote_frame", "dlc", "data", "timestamp", "count"],
+)
+
+
+class LatestFrameTable(BatchListener):
+    """
+    A fixed size table holding the most recently received frame for every identifier.
+
+    Standard identifiers live in a dense block of 2048 slots indexed directly by the identifier. Extended identifiers
+    are given a slot after the dense block the first time they are seen, through a hash index. The table is written in
+    bulk from each receive batch by a single writer, and readers use a sequence counter to detect and retry reads that
+    overlap a batch update, so no locks are taken on either side.
+    """
+
+    def __init__(self, extended_capacity: int = 256):
+        """
+        :param extended_capacity:
+            The number of extended identifier slots to preallocate. The table grows if more are seen.
+        """
+        self._extended_index = {}
+        self._sequence = 0
+        self._allocate(STANDARD_ID_SLOTS + extended_capacity)
+
+    def _allocate(self, slots: int) -> None:
+        self._slots = slots
+        self._timestamp = array("d", bytes(8 * slots))
+        self._count = array("Q", bytes(8 * slots))
+        self._dlc = bytearray(slots)
+        self._remote = bytearray(slots)
+        self._data = bytearray(8 * slots)
+
+    def _grow(self) -> None:
+        slots = self._slots
+        extra = max(slots - STANDARD_ID_SLOTS, _MIN_EXTENDED_GROWTH)
+        timestamp, count, dlc, remote, data = self._timestamp, self._count, self._dlc, self._remote, self._data
+        self._allocate(slots + extra)
+        self._timestamp[:slots] = timestamp
+        self._count[:slots] = count
+        self._dlc[:slots] = dlc
+        self._remote[:slots] = remote
+        self._data[: 8 * slots] = data
+
+    def _slot(self, arbitration_id: int, is_extended_id: bool):
+        if not is_extended_id:
+            return arbitration_id if arbitration_id < STANDARD_ID_SLOTS else None
+        return self._extended_index.get(arbitration_id)
+
+    def on_batch(self, msgs, count: int, time_offset: float) -> None:
+        extended_index = self._extended_index
+        self._sequence += 1  # odd while the table is being written
+        try:
+            for i in range(count):
+                msg_struct = msgs[i]
+                frame_info = msg_struct.by_extended
+                if frame_info & 64:  # error frames do not carry an identifier
+                    continue
+                if frame_info & 2:
+                    slot = extended_index.get(msg_struct.l_id)
+                    if slot is None:
+                        slot = STANDARD_ID_SLOTS + len(extended_index)
+                        if slot >= self._slots:
+                            self._grow()
+                        # only indexed once the arrays hold the slot, so a failed write never leaves a stale entry
+                        extended_index[msg_struct.l_id] = slot
+                else:
+                    slot = msg_struct.l_id & 0x7FF
+                self._timestamp[slot] = time_offset + msg_struct.ul_tstamp / 10000
+                self._count[slot] += 1
+                self._dlc[slot] = msg_struct.by_len & 0x0F
+                self._remote[slot] = msg_struct.by_remote & 1
+                self._data[8 * slot : 8 * slot + 8] = msg_struct.aby_data
+        finally:
+            self._sequence += 1
+
+    def _read(self, read_function):
+        while True:
+            sequence = self._sequence
+            if sequence & 1:
+                time.sleep(0)  # a batch is being written, let the writer finish
+                continue
+            result = read_function()
+            if self._sequence == sequence:
+                return result
+
+    def _frame(self, arbitration_id: int, is_extended_id: bool, slot: int) -> LatestFrame:
+        dlc = self._dlc[slot]
+        return LatestFrame(
+            arbitration_id=arbitration_id,
+            is_extended_id=is_extended_id,
+            is_remote_frame=bool(self._remote[slot]),
+            dlc=dlc,
+            data=bytes(self._data[8 * slot : 8 * slot + dlc]),
+            timestamp=self._timestamp[slot],
+            count=self._count[slot],
+        )
+
+    def get(self, arbitration_id: int, is_extended_id: bool = None):
+        """
+        Returns the most recent frame received with the given identifier.
+
+        :param arbitration_id: The identifier to look up
+        :param is_extended_id:
+            Whether to look up an extended identifier. By default identifiers above 0x7FF are treated as extended.
+        :return: The latest frame, or None if the identifier has not been received
+        :rtype: LatestFrame
+        """
+        if is_extended_id is None:
+            is_extended_id = arbitration_id >= STANDARD_ID_SLOTS
+
+        def read():
+            slot = self._slot(arbitration_id, is_extended_id)
+            if slot is None or not self._count[slot]:
+                return None
+            return self._frame(arbitration_id, is_extended_id, slot)
+
+        return self._read(read)
+
+    def count(self, arbitration_id: int, is_extended_id: bool = None) -> int:
+        """
+        Returns the number of frames received with the given identifier.
+        """
+        if is_extended_id is None:
+            is_extended_id = arbitration_id >= STANDARD_ID_SLOTS
+
+        def read():
+            slot = self._slot(arbitration_id, is_extended_id)
+            return 0 if slot is None else self._count[slot]
+
+        return self._read(read)
+
+    def age(self, arbitration_id: int, is_extended_id: bool = None, now: float = None):
+        """
+        Returns the time in seconds since the given identifier was last received.
+
+        :param now: The time to measure the age against, defaults to :func:`time.time`
+        :return: The age in seconds, or None if the identifier has not been received
+        """
+        if is_extended_id is None:
+            is_extended_id = arbitration_id >= STANDARD_ID_SLOTS
+
+        def read():
+            slot = self._slot(arbitration_id, is_extended_id)
+            if slot is None or not self._count[slot]:
+                return None
+            return self._timestamp[slot]
+
+        timestamp = self._read(read)
+        if timestamp is None:
+            return None
+        return (time.time() if now is None else now) - timestamp
+
+    def snapshot(self) -> dict:
+        """
+        Exports a consistent copy of the table, taken between two receive batches.
+
+        :return: A dictionary of ``(arbitration_id, is_extended_id)`` to :class:`LatestFrame`
+        :rtype: dict
+        """
+
+        def read():
+            count = self._count
+            frames = {}
+            for slot in range(STANDARD_ID_SLOTS):
+                if count[slot]:
+                    frames[(slot, False)] = self._frame(slot, False, slot)
+            for arbitration_id, slot in list(self._extended_index.items()):
+                frames[(arbitration_id, True)] = self._frame(arbitration_id, True, slot)
+            return frames
+
+        return self._read(read)
+
+    def clear(self) -> None:
+        """
+        Removes all frames from the table.
+        """
+        self._sequence += 1
+        try:
+            self._extended_index.clear()
+            self._allocate(self._slots)
+        finally:
+            self._sequence += 1
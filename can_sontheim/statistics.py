@@ -0,0 +1,277 @@
+"""
+Per identifier rate and period statistics for the SIE / IFM CANfox interface
+
+Copyright (C) 2022 Matt Woodhead
+"""
+
+from array import array
+from collections import namedtuple
+import logging
+import math
+import threading
+import time
+
+from .batch import BatchListener
+
+
+log = logging.getLogger("can.sontheim")
+
+TIMESTAMP_WRAP = 2**32  # ul_tstamp is a 32 bit counter of tenths of a millisecond
+_MIN_CAPACITY = 64  # identifier slots allocated when a store without any grows
+
+IdStatistics = namedtuple(
+    "IdStatistics",
+    [
+        "count",
+        "mean_period",
+        "jitter",
+        "min_period",
+        "max_period",
+        "missed",
+        "last_timestamp",
+        "timed_out",
+    ],
+)
+
+EVENT_MISSED = "missed"
+EVENT_JITTER = "jitter"
+EVENT_TIMEOUT = "timeout"
+
+
+class PeriodStatistics(BatchListener):
+    """
+    Incrementally tracks the inter-arrival time of every identifier from the raw receive batches, using the hardware
+    ``ul_tstamp`` of each frame.
+
+    For each identifier the count, mean and variance (Welford's algorithm) of the period, the minimum and maximum
+    period and the number of missed cycles are kept in flat arrays indexed by a slot number, so a frame costs a handful
+    of float operations and no allocation. Missed cycles and jitter are measured against the expected period set with
+    :meth:`set_expected_period`, or the running mean period once ``min_samples`` periods have been seen.
+    """
+
+    def __init__(
+        self,
+        callback=None,
+        jitter_threshold: float = None,
+        timeout_factor: float = 3.0,
+        min_samples: int = 10,
+        capacity: int = 256,
+    ):
+        """
+        :param callback:
+            Called as ``callback(event, arbitration_id, is_extended_id, value)`` when a threshold is crossed. ``event``
+            is one of ``"missed"`` (value is the number of missed cycles), ``"jitter"`` (value is the deviation from
+            the reference period in seconds) or ``"timeout"`` (value is the time since the last frame in seconds).
+        :param jitter_threshold: The deviation from the reference period in seconds that raises a jitter event
+        :param timeout_factor: An identifier times out when no frame is seen for this many reference periods
+        :param min_samples: The number of periods needed before the mean is used as the reference period
+        :param capacity: The number of identifier slots to preallocate. The store grows if more are seen.
+        """
+        self.callback = callback
+        self.jitter_threshold = jitter_threshold
+        self.timeout_factor = timeout_factor
+        self.min_samples = min_samples
+        self._index = {}
+        self._keys = []
+        self._lock = threading.Lock()
+        self._snapshot_thread = None
+        self._stop_event = threading.Event()
+        self._allocate(capacity, clear=True)
+
+    def _allocate(self, capacity: int, clear: bool = False) -> None:
+        # the arrays are only replaced when cleared, growing extends them in place for on_batch
+        if clear:
+            self._capacity = 0
+            self._last_tick = array("d")
+            self._last_timestamp = array("d")
+            self._count = array("Q")
+            self._mean = array("d")
+            self._m2 = array("d")
+            self._min = array("d")
+            self._max = array("d")
+            self._missed = array("Q")
+            self._expected = array("d")
+            self._timed_out = bytearray()
+        extra = capacity - self._capacity
+        self._last_tick.extend([0.0] * extra)
+        self._last_timestamp.extend([0.0] * extra)
+        self._count.extend([0] * extra)
+        self._mean.extend([0.0] * extra)
+        self._m2.extend([0.0] * extra)
+        self._min.extend([math.inf] * extra)
+        self._max.extend([0.0] * extra)
+        self._missed.extend([0] * extra)
+        self._expected.extend([0.0] * extra)
+        self._timed_out.extend(bytes(extra))
+        self._capacity = capacity
+
+    def _slot(self, key) -> int:
+        slot = self._index.get(key)
+        if slot is None:
+            slot = len(self._keys)
+            if slot >= self._capacity:
+                self._allocate(max(2 * self._capacity, _MIN_CAPACITY))
+            self._index[key] = slot
+            self._keys.append(key)
+        return slot
+
+    def set_expected_period(self, arbitration_id: int, period: float, is_extended_id: bool = None) -> None:
+        """
+        Sets the nominal cycle time of an identifier, used as the reference for missed cycle, jitter and timeout
+        detection instead of the measured mean.
+
+        :param period: The expected period in seconds
+        """
+        if is_extended_id is None:
+            is_extended_id = arbitration_id > 0x7FF
+        with self._lock:
+            self._expected[self._slot((arbitration_id, is_extended_id))] = period
+
+    def _reference_period(self, slot: int) -> float:
+        expected = self._expected[slot]
+        if expected:
+            return expected
+        if self._count[slot] > self.min_samples:
+            return self._mean[slot]
+        return 0.0
+
+    def on_batch(self, msgs, count: int, time_offset: float) -> None:
+        events = []
+        with self._lock:
+            index = self._index
+            last_tick = self._last_tick
+            frame_count = self._count
+            mean = self._mean
+            m2 = self._m2
+            for i in range(count):
+                msg_struct = msgs[i]
+                frame_info = msg_struct.by_extended
+                if frame_info & 64:  # error frames do not carry an identifier
+                    continue
+                key = (msg_struct.l_id, bool(frame_info & 2))
+                slot = index.get(key)
+                if slot is None:
+                    slot = self._slot(key)  # the arrays are extended in place, so the local names stay valid
+                tick = msg_struct.ul_tstamp
+                n = frame_count[slot]
+                frame_count[slot] = n + 1
+                self._last_timestamp[slot] = time_offset + tick / 10000
+                self._timed_out[slot] = 0
+                if n:
+                    period = ((tick - last_tick[slot]) % TIMESTAMP_WRAP) / 10000
+                    reference = self._reference_period(slot)
+                    # Welford's online update of the mean and sum of squared differences of the period
+                    delta = period - mean[slot]
+                    mean[slot] += delta / n
+                    m2[slot] += delta * (period - mean[slot])
+                    if period < self._min[slot]:
+                        self._min[slot] = period
+                    if period > self._max[slot]:
+                        self._max[slot] = period
+                    if reference:
+                        if period > 1.5 * reference:
+                            missed = int(period / reference + 0.5) - 1
+                            self._missed[slot] += missed
+                            events.append((EVENT_MISSED, key, missed))
+                        if self.jitter_threshold is not None and abs(period - reference) > self.jitter_threshold:
+                            events.append((EVENT_JITTER, key, period - reference))
+                last_tick[slot] = tick
+        self._dispatch(events)
+
+    def _dispatch(self, events) -> None:
+        if self.callback is None:
+            return
+        for event, (arbitration_id, is_extended_id), value in events:
+            try:
+                self.callback(event, arbitration_id, is_extended_id, value)
+            except Exception:  # pylint: disable=broad-except
+                log.exception("Error in period statistics callback")
+
+    def check_timeouts(self, now: float = None) -> list:
+        """
+        Flags every identifier that has not been received for ``timeout_factor`` reference periods, raising a
+        timeout event the first time each one is flagged.
+
+        :param now: The time to check against, on the bus time base. Defaults to :func:`time.time`
+        :return: A list of ``(arbitration_id, is_extended_id)`` tuples that are currently timed out
+        """
+        if now is None:
+            now = time.time()
+        events = []
+        timed_out = []
+        with self._lock:
+            for slot, key in enumerate(self._keys):
+                reference = self._reference_period(slot)
+                if not reference or not self._count[slot]:
+                    continue
+                age = now - self._last_timestamp[slot]
+                if age > self.timeout_factor * reference:
+                    timed_out.append(key)
+                    if not self._timed_out[slot]:
+                        self._timed_out[slot] = 1
+                        events.append((EVENT_TIMEOUT, key, age))
+        self._dispatch(events)
+        return timed_out
+
+    def snapshot(self) -> dict:
+        """
+        Returns the current statistics of every identifier seen.
+
+        :return: A dictionary of ``(arbitration_id, is_extended_id)`` to :class:`IdStatistics`
+        :rtype: dict
+        """
+        with self._lock:
+            result = {}
+            for slot, key in enumerate(self._keys):
+                n = self._count[slot]
+                periods = n - 1
+                result[key] = IdStatistics(
+                    count=n,
+                    mean_period=self._mean[slot] if periods > 0 else None,
+                    jitter=math.sqrt(self._m2[slot] / (periods - 1)) if periods > 1 else None,
+                    min_period=self._min[slot] if periods > 0 else None,
+                    max_period=self._max[slot] if periods > 0 else None,
+                    missed=self._missed[slot],
+                    last_timestamp=self._last_timestamp[slot] if n else None,
+                    timed_out=bool(self._timed_out[slot]),
+                )
+            return result
+
+    def reset(self) -> None:
+        """
+        Clears the statistics of all identifiers, keeping any expected periods.
+        """
+        with self._lock:
+            capacity = self._capacity
+            expected = {key: self._expected[slot] for key, slot in self._index.items() if self._expected[slot]}
+            self._index = {}
+            self._keys = []
+            self._allocate(capacity, clear=True)
+            for key, period in expected.items():
+                self._expected[self._slot(key)] = period
+
+    def start_periodic_snapshots(self, interval: float, snapshot_callback) -> None:
+        """
+        Starts a background thread that checks for timeouts and passes a snapshot to ``snapshot_callback`` every
+        ``interval`` seconds, until :meth:`stop` is called.
+        """
+        if self._snapshot_thread is not None:
+            raise RuntimeError("Periodic snapshots are already running")
+
+        def run():
+            while not self._stop_event.wait(interval):
+                self.check_timeouts()
+                try:
+                    snapshot_callback(self.snapshot())
+                except Exception:  # pylint: disable=broad-except
+                    log.exception("Error in period statistics snapshot callback")
+
+        self._stop_event.clear()
+        self._snapshot_thread = threading.Thread(target=run, name="sontheim-period-statistics", daemon=True)
+        self._snapshot_thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        if self._snapshot_thread is not None:
+            self._snapshot_thread.join()
+            self._snapshot_thread = None
@@ -21,11 +21,17 @@ from ctypes import (
     c_bool,
     byref,
 )
-from ctypes import Structure
+from ctypes import Structure, Array, sizeof
+from collections import namedtuple
+import struct
+import weakref
 
 
 MAX_NUM_APIHANDLE = 4
 
+_DECODERS = weakref.WeakKeyDictionary()
+_INTEGER_FORMATS = {1: "b", 2: "h", 4: "i", 8: "q"}
+
 
 def read_struct_as_dict(struct):
     result = {}
@@ -59,6 +65,91 @@ def read_struct_as_dict(struct):
     return result
 
 
+def _field_format(ctype) -> str:
+    """The struct module format of one ctypes simple type, in the native byte order with the native size"""
+    code = ctype._type_
+    if code in "bBhHiIlLqQ":
+        integer_format = _INTEGER_FORMATS[sizeof(ctype)]
+        return integer_format.upper() if code.isupper() else integer_format
+    if code in "PzZ":
+        return _INTEGER_FORMATS[sizeof(ctype)].upper()  # pointers are decoded as addresses
+    if code in "fd?c":
+        return code
+    raise TypeError(f"Cannot decode fields of type {ctype.__name__}")
+
+
+def struct_decoder(cls):
+    """
+    Returns a decoder for a ctypes Structure class, which converts an instance (or any buffer holding one) into a
+    named tuple with one entry per field. Arrays become tuples, ``c_char`` arrays become bytes up to the first null
+    and nested structures become nested named tuples.
+
+    The field offsets and formats are worked out once per class, and compiled into a function that reads the
+    simple fields with a single ``struct.unpack_from`` call, so the decoder is cheap enough for frequent status
+    polling. Decoders are cached, so calling this again for the same class returns the same decoder.
+
+    :param cls: The Structure class to decode
+    :return: A function ``decode(buffer, offset=0)``, with the named tuple type as its ``result_type`` attribute
+    :raises TypeError: If the structure contains a field type that cannot be decoded, e.g. a bit field
+    """
+    decoder = _DECODERS.get(cls)
+    if decoder is not None:
+        return decoder
+
+    names = []
+    formats = ["="]
+    expressions = []
+    namespace = {}
+    position = 0
+    index = 0
+    for field in cls._fields_:
+        if len(field) != 2:
+            raise TypeError(f"Cannot decode the bit field {field[0]} of {cls.__name__}")
+        name, ctype = field
+        offset = getattr(cls, name).offset
+        names.append(name)
+        length = ctype._length_ if issubclass(ctype, Array) else None
+        element = ctype._type_ if length is not None else ctype
+        if issubclass(element, Structure):
+            namespace[f"decode_{name}"] = struct_decoder(element)
+            if length is None:
+                expressions.append(f"decode_{name}(buffer, offset + {offset})")
+            else:
+                element_size = sizeof(element)
+                expressions.append(
+                    f"tuple(decode_{name}(buffer, offset + {offset} + i * {element_size}) for i in range({length}))"
+                )
+            continue
+        formats.append(f"{offset - position}x")
+        position = offset + sizeof(ctype)
+        if length is None:
+            formats.append(_field_format(element))
+            expressions.append(f"values[{index}]")
+            index += 1
+        elif element._type_ == "c":
+            formats.append(f"{length}s")
+            expressions.append(f"values[{index}].split(b'\\0', 1)[0]")
+            index += 1
+        else:
+            formats.append(f"{length}{_field_format(element)}")
+            expressions.append(f"values[{index}:{index + length}]")
+            index += length
+
+    result_type = namedtuple(cls.__name__, names)
+    namespace["result_type"] = result_type
+    namespace["unpack_from"] = struct.Struct("".join(formats)).unpack_from
+    source = (
+        "def decode(buffer, offset=0):\n"
+        "    values = unpack_from(buffer, offset)\n"
+        f"    return result_type({', '.join(expressions)})\n"
+    )
+    exec(source, namespace)  # pylint: disable=exec-used
+    decoder = namespace["decode"]
+    decoder.result_type = result_type
+    _DECODERS[cls] = decoder
+    return decoder
+
+
 class CANMsgStruct(Structure):
     _fields_ = [
         ("l_id", c_long),
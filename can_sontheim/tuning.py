@@ -0,0 +1,133 @@
+"""
+Adaptive receive batch sizing for the SIE / IFM CANfox interface
+
+Copyright (C) 2022 Matt Woodhead
+"""
+
+import time
+
+
+# A standard frame with 8 data bytes is 111 bits before bit stuffing, used to turn a bus load into a frame rate
+_TYPICAL_FRAME_BITS = 111
+
+
+class AdaptiveBatchTuner:
+    """
+    Chooses the receive batch size and poll interval from the observed traffic.
+
+    After every read the tuner is given the number of frames returned and whether the driver reported lost frames.
+    The batch size doubles whenever a read fills the buffer or frames are lost, and halves when reads stay well below
+    the batch size. The frame rate is estimated from the reads (and the bus load, when available), and the poll
+    interval is set to the time it takes roughly half a batch to arrive, bounded by ``max_latency``.
+    """
+
+    def __init__(
+        self,
+        initial_size: int = 20,
+        min_size: int = 2,
+        max_size: int = 4096,
+        min_poll_interval: float = 0.0002,
+        max_latency: float = 0.01,
+        smoothing: float = 0.2,
+    ):
+        """
+        :param initial_size: The batch size to start with
+        :param min_size: The smallest batch size used
+        :param max_size: The largest batch size used, which bounds the memory of the receive buffer
+        :param min_poll_interval: The shortest poll interval in seconds
+        :param max_latency: The longest poll interval in seconds, i.e. the most a frame is delayed by batching
+        :param smoothing: The weight of the newest sample in the moving averages
+        """
+        self.min_size = min_size
+        self.max_size = max_size
+        self.min_poll_interval = min_poll_interval
+        self.max_latency = max_latency
+        self.smoothing = smoothing
+
+        self.batch_size = max(min_size, min(initial_size, max_size))
+        self.poll_interval = max_latency
+        self.frame_rate = 0.0
+        self.mean_count = 0.0
+        self.busload = None
+        self.reads = 0
+        self.frames = 0
+        self.lost_events = 0
+        self.resizes = 0
+        self._last_read = None
+
+    def update(self, count: int, lost: bool = False, now: float = None) -> None:
+        """
+        Updates the tuning from the result of one read of the driver.
+
+        :param count: The number of frames returned by the read
+        :param lost: Whether any of the frames had ``by_msg_lost`` set
+        :param now: The time of the read from :func:`time.perf_counter`
+        """
+        if now is None:
+            now = time.perf_counter()
+        self.reads += 1
+        self.frames += count
+        alpha = self.smoothing
+        self.mean_count += alpha * (count - self.mean_count)
+        if self._last_read is not None and now > self._last_read:
+            self.frame_rate += alpha * (count / (now - self._last_read) - self.frame_rate)
+        self._last_read = now
+
+        if lost:
+            self.lost_events += 1
+            self._resize(2 * self.batch_size)
+            self.poll_interval = max(self.min_poll_interval, self.poll_interval / 2)
+            return
+        if count >= self.batch_size:
+            self._resize(2 * self.batch_size)
+        elif self.mean_count < self.batch_size / 4:
+            self._resize(self.batch_size // 2)
+        self._update_poll_interval()
+
+    def update_busload(self, load_percent: float, bitrate: int) -> None:
+        """
+        Updates the frame rate estimate from a bus load reading from ``canGetBusloadExtended``.
+
+        :param load_percent: The bus load in percent
+        :param bitrate: The bitrate of the bus in bit/s
+        """
+        self.busload = load_percent
+        busload_rate = load_percent / 100 * bitrate / _TYPICAL_FRAME_BITS
+        # a frame rate measured from the reads lags behind a sudden increase in traffic, the bus load does not
+        self.frame_rate = max(self.frame_rate, busload_rate)
+        self._update_poll_interval()
+
+    def _resize(self, size: int) -> None:
+        size = max(self.min_size, min(size, self.max_size))
+        if size != self.batch_size:
+            self.batch_size = size
+            self.resizes += 1
+
+    def _update_poll_interval(self) -> None:
+        if self.frame_rate > 0:
+            interval = (self.batch_size / 2) / self.frame_rate
+        else:
+            interval = self.max_latency
+        self.poll_interval = max(self.min_poll_interval, min(interval, self.max_latency))
+
+    @property
+    def coalescing(self) -> bool:
+        """Whether enough traffic is expected within the poll interval for waiting to build a larger batch"""
+        return self.frame_rate * self.poll_interval >= 2
+
+    def metrics(self) -> dict:
+        """
+        :return: The current tuning parameters and the statistics they were chosen from
+        :rtype: dict
+        """
+        return {
+            "batch_size": self.batch_size,
+            "poll_interval": self.poll_interval,
+            "frame_rate": self.frame_rate,
+            "mean_batch": self.mean_count,
+            "busload": self.busload,
+            "reads": self.reads,
+            "frames": self.frames,
+            "lost_events": self.lost_events,
+            "resizes": self.resizes,
+        }
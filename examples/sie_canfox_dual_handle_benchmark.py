@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 10:12:05 2026
+
+sie_canfox_dual_handle_benchmark.py
+
+python-can-sontheim
+"""
+
+import threading
+import time
+
+import can
+from can import Message
+from can_sontheim import devices
+
+
+TEST_DURATION_S = 10
+
+
+def run_benchmark(dual_handle: bool) -> None:
+
+    with can.Bus(
+        interface="sontheim",
+        channel=devices.CANfox.CAN1,
+        bitrate=1000000,
+        echo=False,
+        dual_handle=dual_handle,
+    ) as bus:
+        msg = Message(arbitration_id=0x123, is_extended_id=False, data=[0x00, 0x11, 0x22, 0x33, 0x44, 0x55, 0x66, 0x77])
+        end_time = time.perf_counter() + TEST_DURATION_S
+        counts = {"tx": 0, "rx": 0}
+
+        def transmit():
+            while time.perf_counter() < end_time:
+                bus.send(msg)
+                counts["tx"] += 1
+
+        def receive():
+            while time.perf_counter() < end_time:
+                if bus.recv(0.1) is not None:
+                    counts["rx"] += 1
+
+        threads = [threading.Thread(target=transmit), threading.Thread(target=receive)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        print(
+            f"dual_handle={dual_handle}: "
+            f"TX {counts['tx'] / TEST_DURATION_S:.0f} frames/s, RX {counts['rx'] / TEST_DURATION_S:.0f} frames/s"
+        )
+
+
+def main() -> None:
+    # Another node must be generating traffic on the bus for the receive figures to be meaningful
+    run_benchmark(dual_handle=False)
+    run_benchmark(dual_handle=True)
+
+
+if __name__ == "__main__":
+    main()
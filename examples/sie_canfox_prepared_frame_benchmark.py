@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 09:41:27 2026
+
+sie_canfox_prepared_frame_benchmark.py
+
+python-can-sontheim
+"""
+
+import statistics
+import time
+
+import can
+from can import Message
+from can_sontheim import devices
+
+
+SAMPLES = 10000
+
+
+def time_calls(function) -> list:
+    durations = []
+    for i in range(SAMPLES):
+        start = time.perf_counter_ns()
+        function(i)
+        durations.append(time.perf_counter_ns() - start)
+    return durations
+
+
+def report(name: str, durations: list) -> float:
+    median = statistics.median(durations)
+    print(f"{name:>16}: median {median / 1000:6.2f} us, mean {statistics.mean(durations) / 1000:6.2f} us per call")
+    return median
+
+
+def main() -> None:
+    with can.Bus(interface="sontheim", channel=devices.CANfox.CAN1, bitrate=1000000, echo=False) as bus:
+        msg = Message(arbitration_id=0x123, is_extended_id=False, data=bytes(8))
+        frame = bus.prepare_frame(msg)
+
+        def send_message(i):
+            msg.data[0] = i & 0xFF
+            bus.send(msg)
+
+        def send_prepared(i):
+            frame.data[0] = i & 0xFF
+            frame.send()
+
+        send_time = report("send()", time_calls(send_message))
+        prepared_time = report("PreparedFrame", time_calls(send_prepared))
+        print(f"Saving: {(send_time - prepared_time) / 1000:.2f} us per call")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+Helpers shared by the tests, for building raw receive batches of CMSG records and running a bus on a stub library
+"""
+
+from collections import deque
+from ctypes import addressof, memmove, sizeof
+import time
+
+from can_sontheim.constants import NTCAN_SUCCESS, NTCAN_RX_TIMEOUT, NTCAN_NO_OWNER_RIGHTS
+from can_sontheim.echo import ECHO_FLAG
+from can_sontheim.structures import CANMsgBuffer, CANMsgStruct, CANStatusStruct
+
+
+def make_record(
+    arbitration_id: int,
+    data: bytes = b"",
+    extended: bool = False,
+    remote: bool = False,
+    echo: bool = False,
+    tstamp: int = 0,
+) -> CANMsgStruct:
+    """Builds a CMSG record as the driver returns it, tstamp in tenths of a millisecond"""
+    msg_struct = CANMsgStruct(l_id=arbitration_id, by_len=len(data), by_remote=1 if remote else 0)
+    msg_struct.by_extended = (2 if extended else 1) | (ECHO_FLAG if echo else 0)
+    msg_struct.aby_data[: len(data)] = list(data)
+    msg_struct.ul_tstamp = tstamp
+    return msg_struct
+
+
+def make_batch(records):
+    """
+    Builds a raw receive batch, as passed to BatchListener.on_batch
+
+    :param records: The CMSG records of the batch, e.g. from make_record
+    :return: The msgs array and the number of frames in it
+    """
+    records = list(records)
+    msg_buffer = CANMsgBuffer(max(len(records), 2))
+    for i, record in enumerate(records):
+        msg_buffer.msgs[i] = record
+    return msg_buffer.msgs, len(records)
+
+
+class StubLibrary:
+    """
+    Stands in for the SIECA132 DLL in bus tests, like an adapter on a net with no other applications.
+
+    Every call is recorded in ``calls`` and returns NTCAN_SUCCESS, unless an error has been queued for the function
+    with :meth:`fail`. Frames queued in ``rx`` are returned by canReadNoWait, frames passed to canSend are recorded in
+    ``sent``, and are echoed back into ``rx`` when the handle was opened with echo enabled.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.errors = {}
+        self.rx = deque()
+        self.sent = []
+        self.handles = {}
+        self.closed = []
+        self.status = CANStatusStruct(w_hw_rev=0x0100, w_fw_rev=0x0203, w_drv_rev=0x0304, w_dll_rev=0x0405)
+        self.net_owner = True
+        self.serial_number = 0x0000000112345678
+        self.timestamp_base_ns = 100000
+        self.tick = 0
+
+    def fail(self, function: str, error_code: int, times: int = 1) -> None:
+        """Makes the next ``times`` calls of ``function`` return ``error_code``"""
+        self.errors.setdefault(function, deque()).extend([error_code] * times)
+
+    def called(self, function: str) -> list:
+        """:return: The arguments of every call of ``function``"""
+        return [args for name, args in self.calls if name == function]
+
+    def _call(self, function: str, args) -> int:
+        self.calls.append((function, args))
+        errors = self.errors.get(function)
+        return errors.popleft() if errors else NTCAN_SUCCESS
+
+    def __getattr__(self, function: str):
+        if not function.startswith("can"):
+            raise AttributeError(function)
+        return lambda *args: self._call(function, args)
+
+    def canOpen(self, net, errors, echo, tx_timeout, rx_timeout, name, receive_event, error_event, handle):
+        error_code = self._call("canOpen", (net.value, echo.value, receive_event, error_event))
+        if error_code == NTCAN_SUCCESS:
+            handle._obj.value = len(self.handles) + 1
+            self.handles[handle._obj.value] = bool(echo.value)
+        return error_code
+
+    def canClose(self, handle):
+        self.closed.append(handle.value)
+        return self._call("canClose", (handle.value,))
+
+    def canSetBaudrate(self, handle, baudrate):
+        error_code = self._call("canSetBaudrate", (handle.value, baudrate.value))
+        if error_code == NTCAN_SUCCESS:
+            self.status.w_baud = baudrate.value
+        return error_code
+
+    def canIsNetOwner(self, handle):
+        error_code = self._call("canIsNetOwner", (handle.value,))
+        return error_code if error_code != NTCAN_SUCCESS or self.net_owner else NTCAN_NO_OWNER_RIGHTS
+
+    def canStatus(self, handle, status):
+        error_code = self._call("canStatus", (handle.value,))
+        if error_code == NTCAN_SUCCESS:
+            memmove(addressof(status._obj), addressof(self.status), sizeof(CANStatusStruct))
+        return error_code
+
+    def canGetHWSerialNumber(self, handle, high, low):
+        error_code = self._call("canGetHWSerialNumber", (handle.value,))
+        if error_code == NTCAN_SUCCESS:
+            high._obj.value = self.serial_number >> 32
+            low._obj.value = self.serial_number & 0xFFFFFFFF
+        return error_code
+
+    def canGetSystemTime(self, current, start):
+        current._obj.value = self.tick
+        return self._call("canGetSystemTime", ())
+
+    def canGetDeviceTimestampBase(self, net, base_ns):
+        base_ns._obj.value = self.timestamp_base_ns
+        return self._call("canGetDeviceTimestampBase", (net.value,))
+
+    def canGetSyncTimer(self, handle, timer, counter):
+        timer._obj.value = self.tick
+        counter._obj.value = time.perf_counter_ns()
+        return self._call("canGetSyncTimer", (handle.value,))
+
+    def canReadNoWait(self, handle, msg, count):
+        error_code = self._call("canReadNoWait", (handle.value, count._obj.value))
+        if error_code != NTCAN_SUCCESS:
+            return error_code
+        records = (CANMsgStruct * count._obj.value).from_address(addressof(msg._obj))
+        read = 0
+        while self.rx and read < count._obj.value:
+            records[read] = self.rx.popleft()
+            read += 1
+        count._obj.value = read
+        return NTCAN_SUCCESS if read else NTCAN_RX_TIMEOUT
+
+    def canSend(self, handle, msg, count):
+        error_code = self._call("canSend", (handle.value, count._obj.value))
+        if error_code != NTCAN_SUCCESS:
+            return error_code
+        records = (CANMsgStruct * count._obj.value).from_address(addressof(msg._obj))
+        for record in records:
+            self.sent.append((handle.value, CANMsgStruct.from_buffer_copy(record)))
+            if self.handles.get(handle.value):
+                echo = CANMsgStruct.from_buffer_copy(record)
+                echo.by_extended |= ECHO_FLAG
+                echo.ul_tstamp = self.tick
+                self.rx.append(echo)
+        return NTCAN_SUCCESS
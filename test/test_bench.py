@@ -0,0 +1,63 @@
+"""
+Test for the latency and throughput measurement tool
+"""
+
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from can_sontheim import SontheimBus, bench
+
+from helpers import StubLibrary
+
+
+class TestBench(unittest.TestCase):
+    """unit tests for the measurement tool, run against the python-can virtual bus"""
+
+    def test_summarize(self) -> None:
+        summary = bench.summarize([float(i) for i in range(1, 101)])
+        self.assertEqual(summary["count"], 100)
+        self.assertEqual(summary["p50"], 50.0)
+        self.assertEqual(summary["p99"], 99.0)
+        self.assertEqual(summary["max"], 100.0)
+        self.assertEqual(bench.summarize([]), {"count": 0})
+
+    def test_virtual_backend_report(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            report_file = os.path.join(directory, "report.json")
+            argv = ["latency", "sweep", "-i", "virtual", "-n", "20", "-d", "0.1", "--batch-sizes", "2,20"]
+            self.assertEqual(bench.main(argv + ["--json", report_file]), 0)
+            with open(report_file, encoding="utf-8") as file:
+                report = json.load(file)
+        self.assertEqual(report["latency"]["round_trip"]["count"], 20)
+        self.assertEqual(report["latency"]["lost"], 0)
+        # the virtual bus has no hardware clock to measure the echo timestamps against
+        self.assertEqual(report["latency"]["send_to_bus"], {"count": 0})
+        self.assertEqual(set(report["sweep"]), {"2", "20"})
+
+    def test_send_to_bus_on_hardware_clock(self) -> None:
+        lib = StubLibrary()
+        lib.tick = 1000
+        send = lib.canSend
+
+        def delayed_send(*args):
+            lib.tick += 3  # the frame reaches the bus 0.3 ms after the CAN timer was read
+            return send(*args)
+
+        lib.canSend = delayed_send
+        with mock.patch("can_sontheim._canlib._CANLIB", lib):
+            bus = SontheimBus(device_cache=False)
+            try:
+                result = bench.measure_latency(bus, count=5)
+            finally:
+                bus.shutdown()
+        self.assertEqual(result["lost"], 0)
+        self.assertEqual(result["send_to_bus"]["count"], 5)
+        self.assertAlmostEqual(result["send_to_bus"]["min"], 0.0003, places=6)
+        self.assertAlmostEqual(result["send_to_bus"]["max"], 0.0003, places=6)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+"""
+Test for the shared memory fan-out broker
+"""
+
+import os
+import unittest
+
+from helpers import make_batch, make_record
+
+try:
+    from can_sontheim.broker import SharedMemoryBroker, SontheimSharedMemoryBus
+
+    HAS_SHARED_MEMORY = True
+except ImportError:
+    HAS_SHARED_MEMORY = False
+
+
+def id_batch(first_id, count):
+    return make_batch(make_record(first_id + i, bytes([i & 0xFF]), tstamp=10 * i) for i in range(count))
+
+
+@unittest.skipUnless(HAS_SHARED_MEMORY, reason="Requires multiprocessing.shared_memory")
+class TestSharedMemoryBroker(unittest.TestCase):
+    """unit tests for the shared memory broker and client bus"""
+
+    def setUp(self) -> None:
+        self.broker = SharedMemoryBroker(f"sie_test_{os.getpid()}", capacity=8, time_offset=5.0)
+        self.bus = SontheimSharedMemoryBus(self.broker.name)
+
+    def tearDown(self) -> None:
+        self.bus.shutdown()
+        self.broker.stop()
+
+    def test_fan_out(self) -> None:
+        other_bus = SontheimSharedMemoryBus(self.broker.name)
+        try:
+            self.broker.on_batch(*id_batch(0x100, 3), 5.0)
+            for bus in (self.bus, other_bus):
+                ids = [bus.recv(0).arbitration_id for _ in range(3)]
+                self.assertEqual(ids, [0x100, 0x101, 0x102])
+                self.assertIsNone(bus.recv(0))
+        finally:
+            other_bus.shutdown()
+
+    def test_wrap_around(self) -> None:
+        for first_id in (0, 6, 12):
+            self.broker.on_batch(*id_batch(first_id, 6), 5.0)
+            msgs = [self.bus.recv(0) for _ in range(6)]
+            self.assertEqual([msg.arbitration_id for msg in msgs], list(range(first_id, first_id + 6)))
+        self.assertAlmostEqual(msgs[1].timestamp, 5.001)
+        self.assertEqual(self.bus.overruns, 0)
+
+    def test_overrun(self) -> None:
+        self.broker.on_batch(*id_batch(0, 6), 5.0)
+        self.broker.on_batch(*id_batch(6, 6), 5.0)
+        ids = [self.bus.recv(0).arbitration_id for _ in range(8)]
+        self.assertEqual(ids, list(range(4, 12)))
+        self.assertEqual(self.bus.frames_lost, 4)
+        self.assertIsNone(self.bus.recv(0))
+
+
+if __name__ == "__main__":
+    unittest.main()
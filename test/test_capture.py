@@ -0,0 +1,122 @@
+"""
+Test for the pre-trigger ring capture
+"""
+
+import os
+import tempfile
+import threading
+import unittest
+
+import can
+
+from can_sontheim.capture import ErrorFrameTrigger, IdTrigger, LostFrameTrigger, TriggeredCapture
+
+from helpers import make_batch, make_record
+
+
+def counter_frames(first: int, last: int, interval: int = 100):
+    """frames 0x100 carrying their index, every ``interval`` ticks"""
+    return [make_record(0x100, i.to_bytes(2, "little"), tstamp=i * interval) for i in range(first, last)]
+
+
+class TestTriggers(unittest.TestCase):
+    """unit tests for the capture triggers"""
+
+    def test_id_and_data_match(self) -> None:
+        msgs, count = make_batch(
+            [
+                make_record(0x100, b"\x01\x02", tstamp=0),
+                make_record(0x200, b"\x01\x02", tstamp=1),
+                make_record(0x200, b"\x81\xff", tstamp=2),
+            ]
+        )
+        self.assertEqual(IdTrigger(0x200).find(msgs, 0, count), 1)
+        self.assertEqual(IdTrigger(0x200, data=b"\x80", mask=b"\x80").find(msgs, 0, count), 2)
+        self.assertEqual(IdTrigger(0x200, data=b"\x01\x02").find(msgs, 2, count), -1)
+        self.assertFalse(IdTrigger(0x100, data=b"\x02").match(msgs[0]))
+
+    def test_error_and_lost_frames(self) -> None:
+        msgs, count = make_batch(
+            [make_record(0x100, tstamp=0), make_record(0x0, tstamp=1), make_record(0x100, tstamp=2)]
+        )
+        msgs[1].by_extended = 64
+        msgs[2].by_msg_lost = 3
+        self.assertEqual(ErrorFrameTrigger().find(msgs, 0, count), 1)
+        self.assertEqual(LostFrameTrigger().find(msgs, 0, count), 2)
+        self.assertTrue(LostFrameTrigger().match(msgs[2]))
+
+
+class TestTriggeredCapture(unittest.TestCase):
+    """unit tests for the triggered capture"""
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.base_filename = os.path.join(self.directory.name, "fault.csv")
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def read_indices(self, filename):
+        return [int.from_bytes(msg.data, "little") for msg in can.LogReader(filename)]
+
+    def test_pre_and_post_trigger_windows(self) -> None:
+        capture = TriggeredCapture(
+            self.base_filename, [IdTrigger(0x7FF)], capacity=64, pre_trigger=0.05, post_trigger=0.03
+        )
+        capture.on_batch(*make_batch(counter_frames(0, 100)), 0.0)
+        capture.on_batch(*make_batch([make_record(0x7FF, tstamp=100 * 100)] + counter_frames(101, 110)), 0.0)
+        capture.on_batch(*make_batch(counter_frames(110, 140)), 0.0)
+        capture.stop()
+
+        self.assertEqual(len(capture.events), 1)
+        event = capture.events[0]
+        self.assertAlmostEqual(event.timestamp, 1.0)
+        # 50 ms before the trigger to 30 ms after it, at one frame every 10 ms
+        self.assertEqual(self.read_indices(event.filename), [95, 96, 97, 98, 99, 0, 101, 102, 103])
+        self.assertEqual(event.frames, 9)
+
+    def test_ring_bounds_pre_trigger_window(self) -> None:
+        capture = TriggeredCapture(
+            self.base_filename, [IdTrigger(0x100, data=b"\x5a")], capacity=16, post_trigger=None, post_trigger_frames=4
+        )
+        for first in range(0, 200, 30):
+            capture.on_batch(*make_batch(counter_frames(first, first + 30)), 0.0)
+        capture.stop()
+        # frame 90 (0x5a) fires the trigger at the start of a batch, so the pre-trigger window comes from the ring
+        self.assertEqual(len(capture.events), 1)
+        self.assertEqual(self.read_indices(capture.events[0].filename), list(range(75, 95)))
+        self.assertEqual(capture.frames_captured, 210)
+
+    def test_pre_trigger_window_spans_ring_and_batch(self) -> None:
+        trigger = IdTrigger(0x100, data=b"\x64")
+        capture = TriggeredCapture(self.base_filename, [trigger], capacity=8, post_trigger_frames=0)
+        capture.on_batch(*make_batch(counter_frames(0, 95)), 0.0)
+        capture.on_batch(*make_batch(counter_frames(95, 120)), 0.0)
+        capture.stop()
+        self.assertEqual(self.read_indices(capture.events[0].filename), list(range(93, 101)))
+
+    def test_dump_completed_on_stop(self) -> None:
+        events = []
+        capture = TriggeredCapture(self.base_filename, [IdTrigger(0x100)], post_trigger=10.0, callback=events.append)
+        capture.on_batch(*make_batch(counter_frames(0, 5)), 0.0)
+        capture.stop()
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].frames, 5)
+        self.assertTrue(events[0].filename.endswith("fault_0000.csv"))
+
+    def test_dump_completed_on_quiet_bus(self) -> None:
+        written = threading.Event()
+        capture = TriggeredCapture(
+            self.base_filename, [IdTrigger(0x100)], post_trigger=0.05, callback=lambda event: written.set()
+        )
+        # no frame after the post-trigger window arrives, as the bus goes quiet after the fault
+        capture.on_batch(*make_batch(counter_frames(0, 5)), 0.0)
+        self.assertTrue(written.wait(5.0))
+        self.assertEqual(capture.events[0].frames, 5)
+        self.assertEqual(self.read_indices(capture.events[0].filename), list(range(5)))
+        capture.stop()
+        self.assertEqual(len(capture.events), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+"""
+Test for the clock sync service
+"""
+
+import unittest
+
+from can_sontheim.clocksync import ClockSync
+
+
+class SimulatedAdapter:
+    """a CAN timer ticking every 100 us from ``start_tick``, running ``skew`` fast against a 1 GHz host counter"""
+
+    def __init__(self, start_tick: int, skew: float):
+        self.start_tick = start_tick
+        self.skew = skew
+        self.counter = 0
+
+    def tick_at(self, counter: int) -> int:
+        return int(self.start_tick + counter / 1e9 * (1 + self.skew) * 10000) % 2**32
+
+    def read_sync_timer(self):
+        return self.tick_at(self.counter), self.counter
+
+
+class TestClockSync(unittest.TestCase):
+    """unit tests for the clock sync service"""
+
+    def setUp(self) -> None:
+        self.clock_sync = ClockSync(interval=3600)
+
+    def tearDown(self) -> None:
+        for clock in list(self.clock_sync._clocks):
+            self.clock_sync.unregister(clock)
+
+    def sample(self, clock, adapter, seconds: int) -> None:
+        for _ in range(seconds):
+            adapter.counter += 1000000000
+            clock.refresh()
+
+    def test_offset_and_skew(self) -> None:
+        adapter = SimulatedAdapter(123456, 100e-6)
+        clock = self.clock_sync.register("net 0", adapter.read_sync_timer, 0.0001)
+        self.assertEqual(clock.statistics()["skew_ppm"], 0.0)  # not fitted until the samples span a second
+        self.sample(clock, adapter, 20)
+        statistics = clock.statistics()
+        self.assertAlmostEqual(statistics["skew_ppm"], 100.0, delta=1.0)
+        self.assertLess(statistics["residual_max"], 0.0002)
+        counter = adapter.counter + 500000000
+        expected = self.clock_sync.host_time(counter)
+        self.assertAlmostEqual(clock.to_time(adapter.tick_at(counter)), expected, delta=0.0002)
+
+    def test_common_timeline(self) -> None:
+        adapters = [SimulatedAdapter(0, 40e-6), SimulatedAdapter(2**32 - 30000, -60e-6)]
+        clocks = [self.clock_sync.register(f"net {i}", adapter.read_sync_timer) for i, adapter in enumerate(adapters)]
+        for _ in range(10):
+            for clock, adapter in zip(clocks, adapters):
+                self.sample(clock, adapter, 1)
+        # the second timer wraps part way through, both must still agree on the time of an event
+        counter = adapters[0].counter + 250000000
+        times = [clock.to_time(adapter.tick_at(counter)) for clock, adapter in zip(clocks, adapters)]
+        self.assertAlmostEqual(times[0], times[1], delta=0.0003)
+        offset = clocks[1].time_offset(adapters[1].tick_at(counter))
+        self.assertAlmostEqual(offset + adapters[1].tick_at(counter) / 10000, times[1])
+        self.assertEqual(set(self.clock_sync.statistics()), {"net 0", "net 1"})
+
+    def test_background_thread_stops_with_last_clock(self) -> None:
+        adapter = SimulatedAdapter(0, 0.0)
+        first = self.clock_sync.register("net 0", adapter.read_sync_timer)
+        second = self.clock_sync.register("net 1", adapter.read_sync_timer)
+        thread = self.clock_sync._thread
+        self.assertTrue(thread.is_alive())
+        self.clock_sync.unregister(first)
+        self.assertTrue(thread.is_alive())
+        self.clock_sync.unregister(second)
+        self.assertFalse(thread.is_alive())
+
+
+if __name__ == "__main__":
+    unittest.main()
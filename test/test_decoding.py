@@ -0,0 +1,121 @@
+"""
+Test for the vectorized DBC signal decoding
+"""
+
+import random
+import unittest
+
+from can_sontheim.structures import CANMsgBuffer
+
+try:
+    import cantools
+    import numpy as np
+    from can_sontheim.batch import as_array
+    from can_sontheim.decoding import compile_database, decode_frames
+
+    HAS_DEPENDENCIES = True
+except ImportError:
+    HAS_DEPENDENCIES = False
+
+
+DBC = """VERSION ""
+
+BO_ 256 Intel: 8 ECU
+ SG_ Speed : 0|16@1+ (0.01,0) [0|655.35] "km/h" Vector__XXX
+ SG_ Temperature : 16|8@1- (1,-40) [-40|215] "degC" Vector__XXX
+ SG_ Flag : 63|1@1+ (1,0) [0|1] "" Vector__XXX
+
+BO_ 2566844926 Motorola: 8 ECU
+ SG_ Torque : 7|12@0- (0.5,0) [-1024|1023.5] "Nm" Vector__XXX
+ SG_ Counter : 27|4@0+ (1,0) [0|15] "" Vector__XXX
+ SG_ Level : 39|32@0+ (1,0) [0|4294967295] "" Vector__XXX
+
+BO_ 512 Muxed: 8 ECU
+ SG_ Mux M : 0|8@1+ (1,0) [0|255] "" Vector__XXX
+ SG_ A m0 : 8|16@1+ (1,0) [0|65535] "" Vector__XXX
+ SG_ B m1 : 8|16@1- (1,0) [-32768|32767] "" Vector__XXX
+
+BO_ 768 Wide: 8 ECU
+ SG_ Position : 0|64@1- (1,0) [0|0] "" Vector__XXX
+"""
+
+
+@unittest.skipUnless(HAS_DEPENDENCIES, reason="Requires cantools and NumPy")
+class TestBatchSignalDecoding(unittest.TestCase):
+    """unit tests for the vectorized DBC signal decoding"""
+
+    def setUp(self) -> None:
+        self.database = cantools.database.load_string(DBC, "dbc")
+
+    def make_frames(self, count=200):
+        msg_buffer = CANMsgBuffer(count)
+        messages = self.database.messages
+        rng = random.Random(1)
+        expected = []
+        for i in range(count):
+            message = messages[i % len(messages)]
+            data = bytes(rng.getrandbits(8) for _ in range(8))
+            if message.name == "Muxed":
+                data = bytes([i % 2]) + data[1:]
+            msg_struct = msg_buffer.msgs[i]
+            msg_struct.l_id = message.frame_id
+            msg_struct.by_len = 8
+            msg_struct.by_extended = 2 if message.is_extended_frame else 1
+            msg_struct.ul_tstamp = i * 10
+            for j, byte in enumerate(data):
+                msg_struct.aby_data[j] = byte
+            expected.append((message.name, message.decode(data, decode_choices=False, scaling=True)))
+        return msg_buffer.msgs, expected
+
+    def test_matches_cantools(self) -> None:
+        msgs, expected = self.make_frames()
+        result = decode_frames(as_array(msgs, len(expected)), compile_database(self.database), 1.0)
+        rows = {name: 0 for name in result}
+        for name, signals in expected:
+            row = rows[name]
+            for signal, value in signals.items():
+                self.assertAlmostEqual(result[name][signal][row], value, msg=f"{name}.{signal}")
+            rows[name] += 1
+        self.assertEqual(result["Intel"]["timestamp"][1], 1.0 + 10 * len(self.database.messages) / 10000)
+
+    def test_multiplexed_signals_are_nan_when_not_selected(self) -> None:
+        msgs, _ = self.make_frames()
+        columns = decode_frames(as_array(msgs, 200), compile_database(self.database))["Muxed"]
+        self.assertTrue(np.all(np.isnan(columns["A"][columns["Mux"] == 1])))
+        self.assertTrue(np.all(np.isnan(columns["B"][columns["Mux"] == 0])))
+
+    def test_signals_beyond_dlc_and_remote_frames_are_nan(self) -> None:
+        msgs, _ = self.make_frames(8)
+        msgs[0].by_len = 2  # Intel: Speed is present, Temperature and Flag are not
+        msgs[1].by_len = 2  # Motorola: Torque is present, Counter and Level are not
+        msgs[4].by_remote = 1  # Intel, a remote frame carries no data
+        result = decode_frames(as_array(msgs, 8), compile_database(self.database))
+        intel = result["Intel"]
+        self.assertFalse(np.isnan(intel["Speed"][0]))
+        self.assertTrue(np.isnan(intel["Temperature"][0]))
+        self.assertTrue(np.isnan(intel["Flag"][0]))
+        self.assertTrue(all(np.isnan(intel[name][1]) for name in ("Speed", "Temperature", "Flag")))
+        motorola = result["Motorola"]
+        self.assertFalse(np.isnan(motorola["Torque"][0]))
+        self.assertTrue(np.isnan(motorola["Counter"][0]))
+        self.assertTrue(np.isnan(motorola["Level"][0]))
+        self.assertFalse(np.isnan(motorola["Level"][1]))
+
+    def test_signed_64_bit_signal(self) -> None:
+        msg_buffer = CANMsgBuffer(3)
+        values = [-1, -(2**63), 2**63 - 1]
+        for msg_struct, value in zip(msg_buffer.msgs, values):
+            msg_struct.l_id = 768
+            msg_struct.by_len = 8
+            msg_struct.by_extended = 1
+            for j, byte in enumerate(value.to_bytes(8, "little", signed=True)):
+                msg_struct.aby_data[j] = byte
+        result = decode_frames(as_array(msg_buffer.msgs, 3), compile_database(self.database))
+        self.assertEqual(result["Wide"]["Position"].tolist(), values)
+
+    def test_plans_are_cached(self) -> None:
+        self.assertIs(compile_database(self.database), compile_database(self.database))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+"""
+Test for the persistent device information cache
+"""
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from can_sontheim.devicecache import DeviceCache, DeviceInfo, revisions_from_status
+from can_sontheim.structures import CANStatusStruct, struct_decoder
+
+
+class TestDeviceCache(unittest.TestCase):
+    """unit tests for the device cache"""
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "cache", "devices.json")
+        status = CANStatusStruct(w_hw_rev=0x0100, w_fw_rev=0x0203, w_drv_rev=0x0304, w_dll_rev=0x0405)
+        self.revisions = revisions_from_status(struct_decoder(CANStatusStruct)(status))
+        self.info = DeviceInfo(105, 0x1234, **self.revisions)
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def test_persisted_between_instances(self) -> None:
+        self.assertIsNone(DeviceCache(self.path).lookup(105, 0x1234))
+        self.assertIsNone(DeviceCache(self.path).store(self.info))
+        cache = DeviceCache(self.path)
+        self.assertEqual(cache.lookup(105, 0x1234), self.info)
+        self.assertIsNone(cache.lookup(106, 0x1234))
+
+    def test_checked_against_serial_number(self) -> None:
+        cache = DeviceCache(self.path)
+        cache.store(self.info)
+        # another adapter plugged into the net replaces the entry
+        other = self.info._replace(serial_number=0x5678)
+        self.assertIsNone(cache.lookup(105, 0x5678))
+        self.assertEqual(cache.store(other), self.info)
+        self.assertIsNone(DeviceCache(self.path).lookup(105, 0x1234))
+        self.assertEqual(DeviceCache(self.path).lookup(105, 0x5678), other)
+
+    def test_written_only_when_changed(self) -> None:
+        cache = DeviceCache(self.path)
+        cache.store(self.info)
+        with mock.patch.object(cache, "_save") as save:
+            self.assertEqual(cache.store(self.info), self.info)
+            save.assert_not_called()
+            updated = self.info._replace(fw_rev=0x0204)
+            self.assertEqual(cache.store(updated), self.info)
+            save.assert_called_once()
+        self.assertEqual(cache.lookup(105, 0x1234), updated)
+
+    def test_unreadable_cache_ignored(self) -> None:
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, "w", encoding="utf-8") as file:
+            file.write("not json")
+        cache = DeviceCache(self.path)
+        self.assertIsNone(cache.lookup(105, 0x1234))
+        cache.store(self.info)
+        self.assertEqual(DeviceCache(self.path).lookup(105, 0x1234), self.info)
+        cache.clear()
+        self.assertFalse(os.path.exists(self.path))
+
+
+if __name__ == "__main__":
+    unittest.main()
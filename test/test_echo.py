@@ -0,0 +1,72 @@
+"""
+Test for the transmit confirmation from echo frames
+"""
+
+import time
+import unittest
+
+from can_sontheim.batch import record_to_message
+from can_sontheim.echo import TxTracker
+
+from helpers import make_batch, make_record
+
+
+class TestTxTracker(unittest.TestCase):
+    """unit tests for the transmit tracker"""
+
+    def setUp(self) -> None:
+        self.confirmations = []
+        self.tracker = TxTracker(callback=self.confirmations.append)
+
+    def test_echoes_confirm_sent_frames(self) -> None:
+        for i in range(3):
+            self.tracker.sent(make_record(0x100 + i, bytes([i])))
+        time_offset = time.time() + 1.0
+        msgs, count = make_batch(
+            [
+                make_record(0x100, b"\x00", echo=True, tstamp=10),
+                make_record(0x555, b"\x01"),
+                make_record(0x101, b"\x01", echo=True, tstamp=20),
+            ]
+        )
+        self.tracker.on_batch(msgs, count, time_offset)
+
+        self.assertEqual([c.arbitration_id for c in self.confirmations], [0x100, 0x101])
+        self.assertAlmostEqual(self.confirmations[1].tx_timestamp, time_offset + 0.002)
+        self.assertGreater(self.confirmations[0].latency, 0.5)
+        statistics = self.tracker.statistics()
+        self.assertEqual(statistics["confirmed"], 2)
+        self.assertEqual(statistics["pending"], 1)
+        self.assertEqual(statistics["lost"], 0)
+        self.assertLessEqual(statistics["latency"]["min"], statistics["latency"]["max"])
+
+    def test_lost_and_untracked(self) -> None:
+        msgs, count = make_batch(make_record(0x200 + i) for i in range(3))
+        self.tracker.sent_batch(msgs, 0, count)
+        # the echo of the third frame skips over the first two, and the prepared frame was never recorded
+        msgs, count = make_batch([make_record(0x202, echo=True), make_record(0x7FF, echo=True)])
+        self.tracker.on_batch(msgs, count, 0.0)
+        statistics = self.tracker.statistics()
+        self.assertEqual(statistics["confirmed"], 1)
+        self.assertEqual(statistics["lost"], 2)
+        self.assertEqual(statistics["untracked"], 1)
+
+    def test_discard_and_timeout(self) -> None:
+        entries = self.tracker.sent(make_record(0x300, b"\xaa"))
+        self.tracker.discard(entries)
+        self.assertEqual(self.tracker.statistics()["pending"], 0)
+
+        self.tracker.timeout = 0.0
+        self.tracker.sent(make_record(0x301))
+        time.sleep(0.001)
+        self.tracker.on_batch(*make_batch([]), 0.0)
+        self.assertEqual(self.tracker.statistics()["lost"], 1)
+        self.assertIsNone(self.tracker.statistics()["latency"])
+
+    def test_echo_tagged_as_transmitted(self) -> None:
+        self.assertFalse(record_to_message(make_record(0x1, echo=True), 0.0).is_rx)
+        self.assertTrue(record_to_message(make_record(0x1), 0.0).is_rx)
+
+
+if __name__ == "__main__":
+    unittest.main()
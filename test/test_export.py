@@ -0,0 +1,108 @@
+"""
+Test for the streaming Parquet capture export
+"""
+
+import os
+import tempfile
+import time
+import unittest
+
+from helpers import make_batch, make_record
+
+try:
+    import pyarrow.parquet as pq
+    from can_sontheim.export import ParquetCaptureSink, FLAG_EXTENDED, FLAG_REMOTE
+
+    HAS_DEPENDENCIES = True
+except ImportError:
+    HAS_DEPENDENCIES = False
+
+
+def mixed_batch(count, first_id=0):
+    """alternating standard and extended frames, every third a remote frame"""
+    return make_batch(
+        make_record(first_id + i, bytes([i & 0xFF, 0, 0]), extended=i % 2, remote=i % 3 == 0, tstamp=i)
+        for i in range(count)
+    )
+
+
+@unittest.skipUnless(HAS_DEPENDENCIES, reason="Requires pyarrow and NumPy")
+class TestParquetCaptureSink(unittest.TestCase):
+    """unit tests for the Parquet capture sink"""
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def sink(self, name: str, **kwargs) -> ParquetCaptureSink:
+        return ParquetCaptureSink(os.path.join(self.directory.name, name), rows_per_batch=100, **kwargs)
+
+    def wait_for(self, condition, timeout: float = 5.0) -> None:
+        deadline = time.monotonic() + timeout
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, "timed out waiting for the writer thread")
+            time.sleep(0.01)
+
+    def test_round_trip(self) -> None:
+        sink = self.sink("capture.parquet", flush_interval=60)
+        sink.on_batch(*mixed_batch(150), 10.0)
+        sink.on_batch(*mixed_batch(120, first_id=150), 10.0)
+        sink.stop()
+
+        self.assertEqual(len(sink.files), 1)
+        self.assertEqual(pq.ParquetFile(sink.files[0]).metadata.num_row_groups, 3)
+        table = pq.read_table(sink.files).to_pydict()
+        self.assertEqual(table["arbitration_id"], list(range(270)))
+        self.assertEqual(sink.rows_written, 270)
+        self.assertEqual(table["flags"][3], FLAG_EXTENDED | FLAG_REMOTE | 0)
+        self.assertEqual(table["dlc"][0], 3)
+        self.assertEqual(table["data"][5], bytes([5, 0, 0, 0, 0, 0, 0, 0]))
+        self.assertAlmostEqual(table["timestamp"][200], 10.0 + 50 / 10000)
+
+    def test_size_rotation(self) -> None:
+        # a limit just above the size of a file of one row group, so each file holds at least two
+        sink = self.sink("single.parquet", flush_interval=60)
+        sink.on_batch(*mixed_batch(100), 10.0)
+        sink.stop()
+        max_bytes = os.path.getsize(sink.files[0]) + 1
+
+        sink = self.sink("capture.parquet", flush_interval=60, max_bytes=max_bytes)
+        for first_id in range(0, 1000, 100):
+            sink.on_batch(*mixed_batch(100, first_id=first_id), 10.0)
+        sink.stop()
+
+        self.assertGreater(len(sink.files), 2)
+        for filename in sink.files[:-1]:
+            self.assertGreaterEqual(os.path.getsize(filename), max_bytes)
+            self.assertGreaterEqual(pq.ParquetFile(filename).metadata.num_row_groups, 2)
+        self.assertEqual(pq.read_table(sink.files).to_pydict()["arbitration_id"], list(range(1000)))
+
+    def test_time_flush_and_rotation_on_idle_bus(self) -> None:
+        sink = self.sink("capture.parquet", flush_interval=0.05, max_seconds=0.2)
+        try:
+            sink.on_batch(*mixed_batch(10), 10.0)
+            # no more batches arrive, so the writer thread flushes the frames and then closes the file
+            self.wait_for(lambda: sink.rows_written == 10)
+            self.wait_for(lambda: self.readable(sink.files[0]))
+            self.assertEqual(pq.read_table(sink.files[0]).num_rows, 10)
+
+            sink.on_batch(*mixed_batch(5, first_id=10), 10.0)
+            self.wait_for(lambda: sink.rows_written == 15)
+            self.assertEqual(len(sink.files), 2)
+        finally:
+            sink.stop()
+        self.assertEqual(pq.read_table(sink.files[1]).to_pydict()["arbitration_id"], list(range(10, 15)))
+
+    @staticmethod
+    def readable(filename: str) -> bool:
+        try:
+            pq.ParquetFile(filename)
+        except Exception:  # pylint: disable=broad-except
+            return False
+        return True
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+"""
+Test for the bus load traffic generator
+"""
+
+import unittest
+
+from can_sontheim.generator import TrafficGenerator, frame_bits
+
+
+class RecordingBus:
+    """a stand in for the bus, recording the frames queued by send_batch"""
+
+    bitrate = 500000
+
+    def __init__(self):
+        self.ids = []
+        self.batches = 0
+
+    def send_batch(self, msgs, count, start=0):
+        self.batches += 1
+        self.ids.extend(msgs[i].l_id for i in range(start, start + count))
+        return count
+
+    def get_busload(self):
+        return 42.0
+
+
+class TestFrameBits(unittest.TestCase):
+    """unit tests for the frame length calculation"""
+
+    def test_unstuffed_lengths(self) -> None:
+        # 0x0 with no data is 34 dominant bits up to the end of the CRC, so it has a stuff bit after every fifth bit
+        self.assertEqual(frame_bits(0x000, b""), 47 + 6)
+        for data in (b"\x55" * 8, b"\xff" * 8, b"\x00" * 8):
+            bits = frame_bits(0x2AA, data)
+            self.assertGreaterEqual(bits, 111)
+            self.assertLessEqual(bits, 111 + 24)
+        self.assertGreater(frame_bits(0x2AA, b"\x00" * 8), frame_bits(0x2AA, b"\x55" * 8))
+
+    def test_extended_and_remote(self) -> None:
+        self.assertGreaterEqual(frame_bits(0x15555555, b"\x55" * 8, is_extended_id=True), 131)
+        self.assertEqual(
+            frame_bits(0x123, b"\xff" * 8, is_remote_frame=True), frame_bits(0x123, dlc=8, is_remote_frame=True)
+        )
+
+
+class TestTrafficGenerator(unittest.TestCase):
+    """unit tests for the traffic generator"""
+
+    def test_precomputed_sequence(self) -> None:
+        generator = TrafficGenerator(ids={0x100: 3, 0x18FF0000: 1}, dlcs=(0, 8), payload="counter", length=64, seed=1)
+        self.assertEqual(len(generator.frame_bits), 64)
+        self.assertEqual(generator.total_bits, sum(generator.frame_bits))
+        for i in range(64):
+            msg_struct = generator.msgs[i]
+            self.assertEqual(msg_struct.by_extended, 2 if msg_struct.l_id == 0x18FF0000 else 1)
+            self.assertIn(msg_struct.by_len, (0, 8))
+        with self.assertRaises(ValueError):
+            TrafficGenerator(payload="unknown")
+
+    def test_paced_to_target_load(self) -> None:
+        generator = TrafficGenerator(ids=range(0x100, 0x110), length=100, seed=2)
+        bus = RecordingBus()
+        result = generator.run(bus, 50.0, 0.3, busload_interval=0.1)
+        self.assertAlmostEqual(result.achieved_load, 50.0, delta=5.0)
+        self.assertEqual(result.frames_sent, len(bus.ids))
+        self.assertEqual(bus.ids[:100], [generator.msgs[i].l_id for i in range(100)])
+        self.assertEqual(result.measured_load, 42.0)
+        self.assertLess(bus.batches, result.frames_sent)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+"""
+Test for the indexed capture files
+"""
+
+import os
+import tempfile
+import time
+import unittest
+
+import can
+
+from can_sontheim.batch import HAS_NUMPY
+
+from helpers import make_batch, make_record
+
+if HAS_NUMPY:
+    from can_sontheim.indexed import HEADER_SIZE, IndexedCaptureReader, IndexedCaptureWriter, index_log
+
+
+def cycle_batch(first: int, count: int):
+    """frames 1 ms apart, cycling through four IDs, the last of them extended"""
+    return make_batch(
+        make_record(
+            [0x100, 0x200, 0x300, 0x18FEF100][n % 4], n.to_bytes(4, "little"), extended=n % 4 == 3, tstamp=n * 10
+        )
+        for n in range(first, first + count)
+    )
+
+
+@unittest.skipUnless(HAS_NUMPY, "NumPy is not installed")
+class TestIndexedCapture(unittest.TestCase):
+    """unit tests for the indexed capture writer and reader"""
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.base_filename = os.path.join(self.directory.name, "capture.sidx")
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def write(self, frames: int = 1000, **kwargs) -> list:
+        writer = IndexedCaptureWriter(self.base_filename, block_size=64, flush_interval=60, **kwargs)
+        for first in range(0, frames, 150):
+            writer.on_batch(*cycle_batch(first, min(150, frames - first)), 100.0)
+        writer.stop()
+        self.assertEqual(writer.frames_written, frames)
+        return writer.files
+
+    def test_time_range_is_a_view(self) -> None:
+        (filename,) = self.write()
+        with IndexedCaptureReader(filename) as reader:
+            self.assertEqual(len(reader), 1000)
+            self.assertTrue(reader.complete)
+            self.assertEqual(reader.time_range, (100.0, 100.999))
+            frames = reader.select(start=100.1, end=100.2)
+            self.assertFalse(frames.flags.owndata)
+            self.assertEqual(len(frames), 100)
+            self.assertAlmostEqual(frames["timestamp"][0], 100.1)
+            self.assertEqual(bytes(frames["data"][0][:4]), (100).to_bytes(4, "little"))
+            del frames
+
+    def test_id_and_time_range(self) -> None:
+        (filename,) = self.write()
+        with IndexedCaptureReader(filename) as reader:
+            frames = reader.select(0x18FEF100, start=100.5)
+            self.assertEqual(len(frames), 125)
+            self.assertTrue(all(int.from_bytes(bytes(d[:4]), "little") % 4 == 3 for d in frames["data"]))
+            self.assertEqual(len(reader.select(0x200)), 250)
+            self.assertEqual(len(reader.select(0x200, is_extended_id=True)), 0)
+            self.assertEqual(len(reader.select(0x123)), 0)
+            self.assertEqual(reader.frame_counts()[(0x18FEF100, True)], 250)
+
+            messages = list(reader.messages(0x300, start=100.0, end=100.01))
+            self.assertEqual([m.timestamp for m in messages], [100.002, 100.006])
+            self.assertFalse(messages[0].is_extended_id)
+            self.assertEqual(messages[1].data, bytearray((6).to_bytes(4, "little")))
+            del frames
+
+    def test_rotation_and_interrupted_capture(self) -> None:
+        files = self.write(max_bytes=HEADER_SIZE + 200 * 24)
+        self.assertEqual(len(files), 4)
+
+        # drop the index of the last file, as if the capture was interrupted
+        with open(files[-1], "r+b") as file:
+            file.truncate(HEADER_SIZE + 100 * 24)
+            file.seek(32)
+            file.write(bytes(8))
+        with IndexedCaptureReader(files[-1]) as reader:
+            self.assertFalse(reader.complete)
+            self.assertEqual(len(reader), 100)
+            self.assertEqual(len(reader.select(0x100)), 25)
+
+    def test_partial_block_written_on_idle_bus(self) -> None:
+        writer = IndexedCaptureWriter(self.base_filename, block_size=64, flush_interval=0.05)
+        try:
+            writer.on_batch(*cycle_batch(0, 10), 100.0)
+            # no more batches arrive, so the writer thread writes the partial block itself
+            deadline = time.monotonic() + 5.0
+            while writer.frames_written < 10:
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.01)
+            with IndexedCaptureReader(writer.files[0]) as reader:
+                self.assertFalse(reader.complete)
+                self.assertEqual(len(reader), 10)
+        finally:
+            writer.stop()
+
+    def test_index_log(self) -> None:
+        source = os.path.join(self.directory.name, "recording.asc")
+        with can.ASCWriter(source) as writer:
+            for i in range(20):
+                writer.on_message_received(
+                    can.Message(timestamp=10.0 + i, arbitration_id=0x10 + i % 2, data=[i], is_extended_id=False)
+                )
+        (filename,) = index_log(source, self.base_filename, block_size=8)
+        with IndexedCaptureReader(filename) as reader:
+            self.assertEqual(len(reader), 20)
+            messages = list(reader.messages(0x11))
+            self.assertEqual(len(messages), 10)
+            self.assertEqual(messages[0].data, bytearray([1]))
+
+    def test_not_a_capture(self) -> None:
+        filename = os.path.join(self.directory.name, "other.bin")
+        with open(filename, "wb") as file:
+            file.write(bytes(256))
+        with self.assertRaises(ValueError):
+            IndexedCaptureReader(filename)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,6 +3,10 @@ Test for Sontheim API Interface
 """
 
 import ctypes
+import gc
+import os
+import tempfile
+import time
 import unittest
 from unittest import mock
 from unittest.mock import Mock
@@ -11,7 +15,10 @@ import can
 from can.bus import BusState
 from can.exceptions import CanOperationError, CanInitializationError, CanTimeoutError
 import can_sontheim.constants as const
-from can_sontheim import SontheimBus, devices, IS_PYTHON_64BIT
+from can_sontheim import BatchListener, ClockSync, DeviceCache, SontheimBus, devices, IS_PYTHON_64BIT
+from can_sontheim.batch import HAS_NUMPY
+
+from helpers import StubLibrary, make_batch, make_record
 
 
 skip_all_tests = IS_PYTHON_64BIT
@@ -49,5 +56,449 @@ class TestSontheimBus(unittest.TestCase):
         self.bus.status()
 
 
+class RecordingListener(BatchListener):
+    """keeps a copy of the arguments of every batch"""
+
+    def __init__(self):
+        self.batches = []
+
+    def on_batch(self, msgs, count, time_offset) -> None:
+        self.batches.append(([msgs[i].l_id for i in range(count)], count, time_offset))
+
+
+class StubLibraryTestCase(unittest.TestCase):
+    """runs the bus on a stub of the MT_API library"""
+
+    def setUp(self) -> None:
+        self.lib = StubLibrary()
+        patcher = mock.patch("can_sontheim._canlib._CANLIB", self.lib)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.bus = None
+
+    def tearDown(self) -> None:
+        if self.bus is not None:
+            self.bus.shutdown()
+
+    def open_bus(self, **kwargs) -> SontheimBus:
+        self.bus = SontheimBus(channel=devices.CANfox.CAN1, **kwargs)
+        return self.bus
+
+
+class TestReceive(StubLibraryTestCase):
+    """unit tests for the batched receive path"""
+
+    def test_pending_frames_in_order(self) -> None:
+        bus = self.open_bus(rx_buffer_length=4)
+        self.lib.rx.extend(make_record(0x100 + i, bytes([i]), tstamp=10 * i) for i in range(6))
+        received = [bus.recv(timeout=0) for _ in range(6)]
+        self.assertEqual([msg.arbitration_id for msg in received], [0x100 + i for i in range(6)])
+        self.assertEqual((received[5].dlc, received[5].data[0]), (1, 5))
+        self.assertAlmostEqual(received[5].timestamp - received[0].timestamp, 0.005, places=5)
+        # two reads of up to four frames, the rest come from the pending frames
+        self.assertEqual([count for _, count in self.lib.called("canReadNoWait")], [4, 4])
+        self.assertIsNone(bus.recv(timeout=0))
+
+    def test_timeout_zero_does_not_wait(self) -> None:
+        bus = self.open_bus()
+        start = time.perf_counter()
+        self.assertIsNone(bus.recv(timeout=0))
+        self.assertLess(time.perf_counter() - start, 0.05)
+        self.assertEqual(len(self.lib.called("canReadNoWait")), 1)
+
+    def test_consumed_echoes_return_nothing(self) -> None:
+        bus = self.open_bus(consume_echo=True)
+        self.lib.rx.extend([make_record(0x100, echo=True), make_record(0x101, echo=True)])
+        self.assertIsNone(bus.recv(timeout=0))
+        self.lib.rx.extend([make_record(0x102, echo=True), make_record(0x103)])
+        self.assertEqual(bus.recv(timeout=0).arbitration_id, 0x103)
+
+    def test_batch_listeners(self) -> None:
+        bus = self.open_bus()
+        listener = RecordingListener()
+        bus.add_batch_listener(listener)
+        self.lib.rx.extend(make_record(0x200 + i) for i in range(3))
+        bus.recv(timeout=0)
+        bus.recv(timeout=0)
+        self.assertEqual(listener.batches, [([0x200, 0x201, 0x202], 3, bus._time_offset)])
+        bus.remove_batch_listener(listener)
+        self.lib.rx.append(make_record(0x300))
+        bus.recv(timeout=0)
+        self.assertEqual(len(listener.batches), 1)
+
+    def test_recv_multiple(self) -> None:
+        bus = self.open_bus()
+        self.lib.rx.extend(make_record(0x100 + i) for i in range(5))
+        self.assertEqual(bus.recv(timeout=0).arbitration_id, 0x100)
+        self.lib.rx.append(make_record(0x200))
+        messages, _ = bus._recv_multiple()
+        self.assertEqual([msg.arbitration_id for msg in messages], [0x101, 0x102, 0x103, 0x104, 0x200])
+
+
+class TestDualHandle(StubLibraryTestCase):
+    """unit tests for the separate receive and transmit handles"""
+
+    def test_frames_sent_from_transmit_handle(self) -> None:
+        bus = self.open_bus(dual_handle=True)
+        rx_open, tx_open = self.lib.called("canOpen")
+        # echo is disabled on both handles, and the transmit handle uses the events created for the bus
+        self.assertEqual(rx_open[1:], (0, "R1", "E1"))
+        self.assertEqual(tx_open[1:], (0, "R1", "E1"))
+        bus.send(can.Message(arbitration_id=0x123, data=[1, 2], is_extended_id=False))
+        self.assertEqual([handle for handle, _ in self.lib.sent], [bus._tx_handle.value])
+        self.assertNotEqual(bus._tx_handle.value, bus._Handle.value)
+        self.assertIsNone(bus.recv(timeout=0))
+
+        bus.shutdown()
+        self.bus = None
+        self.assertEqual(sorted(self.lib.closed), [1, 2])
+
+    def test_receive_handle_closed_when_transmit_handle_fails(self) -> None:
+        self.lib.fail("canOpen", const.NTCAN_SUCCESS)
+        self.lib.fail("canOpen", const.NTCAN_TOO_MANY_HANDLES)
+        with self.assertRaises(CanInitializationError):
+            self.open_bus(dual_handle=True)
+        self.assertEqual(self.lib.closed, [1])
+        self.assertIsNone(self.bus)
+
+    def test_handles_closed_once(self) -> None:
+        self.lib.fail("canSetBaudrate", const.NTCAN_SETBAUDRATE_TIMEOUT)
+        with self.assertRaises(CanInitializationError):
+            self.open_bus()
+        bus = self.open_bus(dual_handle=True)
+        bus.shutdown()
+        bus.shutdown()
+        self.bus = None
+        # a bus that failed to open may be shut down again when it is garbage collected
+        gc.collect()
+        self.assertEqual(sorted(self.lib.closed), [1, 2, 3])
+
+    def test_handles_closed_when_transmit_filter_fails(self) -> None:
+        self.lib.fail("canSetFilterMode", const.NTCAN_SUCCESS)
+        self.lib.fail("canSetFilterMode", const.NTCAN_INVALID_PARAMETER)
+        with self.assertRaises(CanInitializationError):
+            self.open_bus(dual_handle=True)
+        self.assertEqual(sorted(self.lib.closed), [1, 2])
+
+
+class TestStartupFailures(StubLibraryTestCase):
+    """unit tests for the clean up when the bus fails part way through starting"""
+
+    def test_broker_failure_closes_handles(self) -> None:
+        clock_sync = ClockSync(interval=60.0)
+        with mock.patch("can_sontheim._canlib.SharedMemoryBroker", side_effect=FileExistsError("in use")):
+            with self.assertRaises(FileExistsError):
+                self.open_bus(shared_memory_name="sie_test", clock_sync=clock_sync, dual_handle=True)
+        self.assertEqual(sorted(self.lib.closed), [1, 2])
+        self.assertEqual(clock_sync.statistics(), {})
+        self.assertIsNone(clock_sync._thread)
+
+    def test_level_monitor_not_supported(self) -> None:
+        self.lib.fail("canGetCanLevelHist", const.NTCAN_HARDWARE_NOT_SUPPORTED)
+        with self.assertLogs("can.sontheim", "WARNING"):
+            bus = self.open_bus(level_monitor=True)
+        self.assertIsNone(bus.level_monitor)
+        self.assertIsNone(bus.recv(timeout=0))
+
+    @unittest.skipUnless(HAS_NUMPY, "NumPy is not installed")
+    def test_level_monitor_started(self) -> None:
+        bus = self.open_bus(level_monitor=True, level_monitor_interval=60.0)
+        self.assertIsNotNone(bus.level_monitor._thread)
+        bus.shutdown()
+        self.bus = None
+        self.assertIsNone(bus.level_monitor._thread)
+        self.assertEqual(self.lib.closed, [1])
+
+
+class TestClockSync(StubLibraryTestCase):
+    """unit tests for registering the bus with the clock sync service"""
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.clock_sync = ClockSync(interval=60.0)
+        self.lib.tick = 50000
+
+    def test_frames_on_common_timeline(self) -> None:
+        bus = self.open_bus(clock_sync=self.clock_sync)
+        self.assertEqual(list(self.clock_sync.statistics()), ["net 105"])
+        self.lib.rx.extend([make_record(0x100, tstamp=40000), make_record(0x101, tstamp=50000)])
+        first, second = bus.recv(timeout=0), bus.recv(timeout=0)
+        self.assertAlmostEqual(second.timestamp, bus.clock.to_time(50000), places=5)
+        self.assertAlmostEqual(second.timestamp - first.timestamp, 1.0, places=5)
+        self.assertLess(abs(second.timestamp - time.time()), 1.0)
+        bus.shutdown()
+        self.bus = None
+        self.assertEqual(self.clock_sync.statistics(), {})
+
+    def test_other_timer_base_not_synchronised(self) -> None:
+        self.lib.timestamp_base_ns = 1000
+        with self.assertLogs("can.sontheim", "WARNING"):
+            bus = self.open_bus(clock_sync=self.clock_sync)
+        self.assertIsNone(bus.clock)
+        self.assertEqual(self.clock_sync.statistics(), {})
+        self.assertEqual(self.lib.called("canGetSyncTimer"), [])
+
+
+class TestFastAttach(StubLibraryTestCase):
+    """unit tests for attaching to a net that another application has already initialised"""
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.cache_path = os.path.join(self.directory.name, "devices.json")
+
+    def test_owner_sets_bitrate(self) -> None:
+        bus = self.open_bus(fast_attach=True)
+        self.assertTrue(bus.net_owner)
+        self.assertEqual(self.lib.called("canSetBaudrate"), [(1, const.CANFOX_BITRATES[500000])])
+        self.assertIn("baudrate", bus.startup_timing)
+        # only the ownership check is added to the startup of a bus that owns the net
+        self.assertEqual(self.lib.called("canStatus"), [])
+        self.assertEqual(self.lib.called("canGetHWSerialNumber"), [])
+
+    def test_foreign_owner_at_same_bitrate(self) -> None:
+        self.lib.net_owner = False
+        self.lib.status.w_baud = const.CANFOX_BITRATES[500000]
+        bus = self.open_bus(fast_attach=True)
+        self.assertFalse(bus.net_owner)
+        self.assertEqual(self.lib.called("canSetBaudrate"), [])
+        self.assertNotIn("baudrate", bus.startup_timing)
+        self.assertEqual(bus.device_info.serial_number, self.lib.serial_number)
+        self.assertEqual(bus.device_info.fw_rev, 0x0203)
+        # the revisions come from the status read by fast attach
+        self.assertEqual(len(self.lib.called("canStatus")), 1)
+
+    def test_foreign_owner_at_other_bitrate(self) -> None:
+        self.lib.net_owner = False
+        self.lib.status.w_baud = const.CANFOX_BITRATES[250000]
+        with self.assertRaises(CanInitializationError):
+            self.open_bus(fast_attach=True)
+        self.assertEqual(self.lib.called("canSetBaudrate"), [])
+        gc.collect()
+        self.assertEqual(self.lib.closed, [1])
+
+    def test_cached_device_info(self) -> None:
+        bus = self.open_bus(fast_attach=True, device_cache=self.cache_path)
+        self.assertEqual(bus.device_info.fw_rev, 0x0203)
+        bus.shutdown()
+        self.assertEqual(len(self.lib.called("canStatus")), 1)
+
+        # the same adapter is found in the cache, so its status is not read again
+        bus = self.open_bus(fast_attach=True, device_cache=self.cache_path)
+        self.assertEqual(bus.device_info.fw_rev, 0x0203)
+        self.assertEqual(len(self.lib.called("canStatus")), 1)
+        self.assertEqual(len(self.lib.called("canGetHWSerialNumber")), 2)
+
+    def test_replaced_adapter_reports_its_own_serial_number(self) -> None:
+        bus = self.open_bus(fast_attach=True, device_cache=self.cache_path)
+        self.assertEqual(bus.device_info.serial_number, 0x0000000112345678)
+        bus.shutdown()
+
+        # another adapter is plugged into the net, with a newer firmware
+        self.lib.serial_number = 0x0000000187654321
+        self.lib.status.w_fw_rev = 0x0204
+        bus = self.open_bus(fast_attach=True, device_cache=self.cache_path)
+        self.assertEqual(bus.device_info.serial_number, 0x0000000187654321)
+        self.assertEqual(bus.device_info.fw_rev, 0x0204)
+        self.assertEqual(DeviceCache(self.cache_path).lookup(105, 0x0000000187654321).fw_rev, 0x0204)
+
+    def test_cache_not_used_by_default(self) -> None:
+        with mock.patch("can_sontheim._canlib.get_device_cache") as get_device_cache:
+            self.bus = SontheimBus(channel=devices.CANfox.CAN1, fast_attach=True)
+            self.assertEqual(self.bus.device_info.serial_number, self.lib.serial_number)
+        get_device_cache.assert_not_called()
+
+
+class TestEcho(StubLibraryTestCase):
+    """unit tests for the echoes of transmitted frames"""
+
+    message = can.Message(arbitration_id=0x123, data=[1, 2, 3], is_extended_id=False)
+
+    def test_echo_options(self) -> None:
+        self.open_bus(echo=False).shutdown()
+        self.open_bus(receive_own_messages=False).shutdown()
+        self.open_bus()
+        self.assertEqual([args[1] for args in self.lib.called("canOpen")], [0, 0, 1])
+
+    def test_echo_received_as_transmitted(self) -> None:
+        bus = self.open_bus(track_tx=True)
+        bus.send(self.message)
+        echo = bus.recv(timeout=0)
+        self.assertEqual(echo.arbitration_id, 0x123)
+        self.assertFalse(echo.is_rx)
+        statistics = bus.tx_tracker.statistics()
+        self.assertEqual((statistics["confirmed"], statistics["pending"]), (1, 0))
+
+    def test_consumed_echoes_still_confirm(self) -> None:
+        bus = self.open_bus(track_tx=True, consume_echo=True)
+        bus.send(self.message)
+        self.lib.rx.append(make_record(0x321))
+        self.assertEqual(bus.recv(timeout=0).arbitration_id, 0x321)
+        self.assertIsNone(bus.recv(timeout=0))
+        self.assertEqual(bus.tx_tracker.statistics()["confirmed"], 1)
+
+    def test_failed_send_not_tracked(self) -> None:
+        bus = self.open_bus(track_tx=True)
+        self.lib.fail("canSend", const.NTCAN_TX_ERROR)
+        with self.assertRaises(CanOperationError):
+            bus.send(self.message)
+        self.assertEqual(bus.tx_tracker.statistics()["pending"], 0)
+
+
+class TestAdaptiveBatching(StubLibraryTestCase):
+    """unit tests for the adaptive receive batch size on the bus"""
+
+    def receive_all(self, bus) -> list:
+        messages = []
+        while True:
+            msg = bus.recv(timeout=0)
+            if msg is None:
+                return messages
+            messages.append(msg)
+
+    def test_batch_grows_under_load(self) -> None:
+        bus = self.open_bus(adaptive_batching=True, rx_buffer_length=4, max_rx_batch_size=64)
+        self.lib.rx.extend(make_record(i & 0x7FF, tstamp=i) for i in range(300))
+        messages = self.receive_all(bus)
+        self.assertEqual([msg.arbitration_id for msg in messages], [i & 0x7FF for i in range(300)])
+        read_sizes = [count for _, count in self.lib.called("canReadNoWait")]
+        self.assertEqual(read_sizes[:6], [4, 8, 16, 32, 64, 64])
+        self.assertEqual(bus.receive_metrics["batch_size"], 64)
+        self.assertEqual(len(bus._rx_buffer.msgs), 64)
+        self.assertEqual(bus.receive_metrics["busload"], 0.0)
+
+    def test_lost_frames_grow_batch(self) -> None:
+        for has_numpy in sorted({HAS_NUMPY, False}):
+            with self.subTest(has_numpy=has_numpy), mock.patch("can_sontheim._canlib.HAS_NUMPY", has_numpy):
+                bus = self.open_bus(adaptive_batching=True, rx_buffer_length=8)
+                record = make_record(0x100)
+                record.by_msg_lost = 1
+                self.lib.rx.extend([make_record(0x0FF), record])
+                self.assertEqual(bus.recv(timeout=0).arbitration_id, 0x0FF)
+                self.assertEqual(bus.receive_metrics["lost_events"], 1)
+                self.assertEqual(bus.receive_metrics["batch_size"], 16)
+                bus.shutdown()
+
+    def test_busload_not_available(self) -> None:
+        self.lib.fail("canGetBusloadExtended", const.NTCAN_HARDWARE_NOT_SUPPORTED)
+        bus = self.open_bus(adaptive_batching=True, busload_interval=0.001)
+        for _ in range(3):
+            bus.recv(timeout=0)
+            time.sleep(0.002)
+        self.assertEqual(len(self.lib.called("canGetBusloadExtended")), 1)
+        self.assertIsNone(bus.receive_metrics["busload"])
+
+
+class TestRecovery(StubLibraryTestCase):
+    """unit tests for the bus-off and reconnect recovery on the bus"""
+
+    message = can.Message(arbitration_id=0x123, data=[1], is_extended_id=False)
+
+    def wait_recovered(self, bus) -> dict:
+        self.assertTrue(bus.recovery.wait(5.0))
+        return bus.recovery_metrics
+
+    def test_bus_off_on_send(self) -> None:
+        bus = self.open_bus(auto_recover=True)
+        self.lib.fail("canSend", const.NTCAN_CONTR_BUSOFF)
+        bus.send(self.message)
+        metrics = self.wait_recovered(bus)
+        self.assertEqual(metrics["recoveries"], {"bus_off": 1})
+        # the controller was restarted by setting the bitrate again, on the same handle
+        self.assertEqual(len(self.lib.called("canSetBaudrate")), 2)
+        self.assertEqual(self.lib.closed, [])
+        self.assertEqual([record.l_id for _, record in self.lib.sent], [0x123])
+
+    def test_reopen_after_adapter_lost(self) -> None:
+        bus = self.open_bus(auto_recover=True, recovery_retry_interval=0.01)
+        self.lib.fail("canReadNoWait", const.NTCAN_HARDWARE_NOT_FOUND)
+        self.lib.fail("canOpen", const.NTCAN_HARDWARE_NOT_FOUND, times=2)
+        self.assertIsNone(bus.recv(timeout=5.0))
+        metrics = self.wait_recovered(bus)
+        self.assertEqual(metrics["recoveries"], {"device_lost": 1})
+        self.assertEqual(metrics["attempts"], 3)
+        self.assertEqual(self.lib.closed, [1])
+        self.assertEqual(bus._Handle.value, 2)
+
+        self.lib.rx.append(make_record(0x200))
+        self.assertEqual(bus.recv(timeout=0).arbitration_id, 0x200)
+        bus.send(self.message)
+        self.assertEqual(self.lib.sent[-1][0], 2)
+
+    def test_pending_frames_kept(self) -> None:
+        bus = self.open_bus(auto_recover=True, recovery_retry_interval=0.01)
+        self.lib.rx.extend(make_record(0x200 + i) for i in range(3))
+        self.assertEqual(bus.recv(timeout=0).arbitration_id, 0x200)
+        bus.recovery.trigger(const.NTCAN_HARDWARE_NOT_FOUND)
+        self.wait_recovered(bus)
+        self.assertEqual(self.lib.closed, [1])
+        self.assertEqual([bus.recv(timeout=0).arbitration_id for _ in range(2)], [0x201, 0x202])
+
+    def test_failed_recovery_raises(self) -> None:
+        bus = self.open_bus(auto_recover=True, recovery_timeout=0.05, recovery_retry_interval=0.01)
+        self.lib.fail("canOpen", const.NTCAN_HARDWARE_NOT_FOUND, times=1000)
+        self.lib.fail("canSend", const.NTCAN_HARDWARE_NOT_FOUND, times=1000)
+        self.lib.fail("canReadNoWait", const.NTCAN_INVALID_HANDLE, times=1000)
+        bus.send(self.message)
+        self.assertFalse(bus.recovery.wait(5.0))
+        attempts = bus.recovery_metrics["attempts"]
+
+        with self.assertRaises(can.CanOperationError):
+            bus.send(self.message)
+        with self.assertRaises(can.CanOperationError):
+            bus.recv(timeout=0)
+        msgs, count = make_batch([make_record(0x300)])
+        with self.assertRaises(can.CanOperationError):
+            bus.send_batch(msgs, count)
+        metrics = bus.recovery_metrics
+        self.assertFalse(metrics["recovering"])
+        self.assertEqual(metrics["failures"], 1)
+        self.assertEqual(metrics["attempts"], attempts)
+        self.assertEqual(metrics["frames_dropped"], 1)
+
+    def test_send_batch_whilst_recovering(self) -> None:
+        bus = self.open_bus(auto_recover=True, recovery_retry_interval=0.01)
+        self.lib.fail("canOpen", const.NTCAN_HARDWARE_NOT_FOUND, times=5)
+        bus.recovery.trigger(const.NTCAN_HARDWARE_NOT_FOUND)
+        msgs, count = make_batch([make_record(0x300), make_record(0x301)])
+        self.assertEqual(bus.send_batch(msgs, count), 0)
+        self.wait_recovered(bus)
+        self.assertEqual(bus.send_batch(msgs, count), 2)
+
+
+class TestPreparedFrames(StubLibraryTestCase):
+    """unit tests for prepared frames sent on the bus"""
+
+    message = can.Message(arbitration_id=0x123, data=[1, 2], is_extended_id=False)
+
+    def test_sent_without_conversion(self) -> None:
+        bus = self.open_bus()
+        frame = bus.prepare_frame(self.message)
+        frame.data[0] = 0xAA
+        frame.send()
+        self.assertEqual(
+            [(handle, record.l_id, record.aby_data[0]) for handle, record in self.lib.sent], [(1, 0x123, 0xAA)]
+        )
+
+    def test_recovered_after_bus_off(self) -> None:
+        bus = self.open_bus(auto_recover=True)
+        frame = bus.prepare_frame(self.message)
+        self.lib.fail("canSend", const.NTCAN_CONTR_BUSOFF)
+        frame.send()
+        # the payload may change once send returns, which must not change the frame held in the backlog
+        frame.data[0] = 0xBB
+        self.assertTrue(bus.recovery.wait(5.0))
+        self.assertEqual(bus.recovery_metrics["recoveries"], {"bus_off": 1})
+        self.assertEqual(len(self.lib.sent), 1)
+        self.assertEqual(self.lib.sent[0][1].aby_data[0], 1)
+
+    def test_confirmed_from_echo(self) -> None:
+        bus = self.open_bus(track_tx=True, consume_echo=True)
+        bus.prepare_frame(self.message).send()
+        self.assertIsNone(bus.recv(timeout=0))
+        self.assertEqual(bus.tx_tracker.statistics()["confirmed"], 1)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,145 @@
+"""
+Test for the CAN level monitor
+"""
+
+import math
+import unittest
+
+from can_sontheim.monitor import HAS_NUMPY, LevelMonitor
+from can_sontheim.structures import CANLevelHistStruct, struct_decoder
+
+
+class SimulatedLevels:
+    """the passive CAN level accumulators of an adapter, fed with constant levels"""
+
+    def __init__(self):
+        self.histogram = CANLevelHistStruct()
+        self.resets = 0
+
+    def measure(self, count: int, dominant_low: float, dominant_high: float, recessive: float = 2.5) -> None:
+        """adds ``count`` measurements of each level, as the firmware would"""
+        h = self.histogram
+        for level_count, mean, level in [
+            ("ulMeasureCountLowRez", "dAvgLevelLowRez", recessive),
+            ("ulMeasureCountHighRez", "dAvgLevelHighRez", recessive),
+            ("ulMeasureCountLowDom", "dAvgLevelLowDom", dominant_low),
+            ("ulMeasureCountHighDom", "dAvgLevelHighDom", dominant_high),
+        ]:
+            total = getattr(h, level_count)
+            setattr(h, mean, (getattr(h, mean) * total + level * count) / (total + count))
+            setattr(h, level_count, total + count)
+        h.ulMeasureCountAll += 2 * count
+        h.arr_LevelLow[round(dominant_low * 10)] += count
+        h.arr_LevelLow[round(recessive * 10)] += count
+        h.arr_LevelHigh[round(dominant_high * 10)] += count
+        h.arr_LevelHigh[round(recessive * 10)] += count
+
+    def read(self, reset: bool):
+        # like the firmware, a reset read returns the accumulators from before they were cleared
+        histogram = struct_decoder(CANLevelHistStruct)(self.histogram)
+        if reset:
+            self.resets += 1
+            self.histogram = CANLevelHistStruct()
+        return histogram
+
+
+@unittest.skipUnless(HAS_NUMPY, "NumPy is not installed")
+class TestLevelMonitor(unittest.TestCase):
+    """unit tests for the level monitor"""
+
+    def setUp(self) -> None:
+        self.levels = SimulatedLevels()
+        self.warnings = []
+        self.monitor = LevelMonitor(self.levels.read, window=10, min_trend_samples=4, callback=self.warnings.append)
+
+    def test_interval_samples(self) -> None:
+        self.assertIsNone(self.monitor.poll())
+        self.assertTrue(math.isnan(self.monitor.statistics()["dominant_differential"]["mean"]))
+        self.levels.measure(100, 1.5, 3.5)
+        sample = self.monitor.poll()
+        self.assertEqual(sample.measurements, 200)
+        self.assertAlmostEqual(sample.dominant_differential, 2.0)
+        self.assertAlmostEqual(sample.recessive_differential, 0.0)
+
+        # the sample only holds the measurements since the previous read
+        self.levels.measure(300, 1.7, 3.3)
+        sample = self.monitor.poll()
+        self.assertAlmostEqual(sample.levels["low_dominant"], 1.7)
+        self.assertAlmostEqual(sample.dominant_differential, 1.6)
+        self.assertAlmostEqual(sample.deviations["high_dominant"], 0.0, places=6)
+        self.assertIsNone(self.monitor.poll())
+
+        histogram = self.monitor.histogram()
+        self.assertEqual(histogram["can_low"][15], 100)
+        self.assertEqual(histogram["can_low"][17], 300)
+        self.assertEqual(histogram["can_high"][25], 400)
+        self.assertAlmostEqual(histogram["volts"][33], 3.3)
+
+        statistics = self.monitor.statistics()
+        self.assertEqual(statistics["samples"], 2)
+        self.assertAlmostEqual(statistics["dominant_differential"]["min"], 1.6)
+        self.assertAlmostEqual(statistics["dominant_differential"]["latest"], 1.6)
+        self.assertEqual(self.warnings, [])
+
+    def test_reset_accumulators(self) -> None:
+        self.levels.measure(100, 1.5, 3.5)
+        self.monitor.poll()
+        self.levels.read(True)
+        self.levels.measure(50, 1.6, 3.4)
+        sample = self.monitor.poll()
+        self.assertEqual(sample.measurements, 100)
+        self.assertAlmostEqual(sample.dominant_differential, 1.8)
+
+    def test_threshold_warnings(self) -> None:
+        self.monitor.min_trend_samples = 100
+        self.levels.measure(100, 2.0, 3.2)
+        self.monitor.poll()
+        self.assertEqual([w.kind for w in self.warnings], ["dominant_differential"])
+        # raised once while the check keeps failing, and again after it has passed
+        self.levels.measure(100, 2.0, 3.2)
+        self.monitor.poll()
+        self.levels.measure(100, 1.5, 3.5)
+        self.monitor.poll()
+        self.levels.measure(100, 2.0, 3.2)
+        self.monitor.poll()
+        self.assertEqual(len(self.warnings), 2)
+        self.assertAlmostEqual(self.warnings[0].value, 1.2)
+
+    def test_drift_warning(self) -> None:
+        self.monitor.min_trend_samples = 100
+        for i in range(6):
+            self.levels.measure(100, 1.0 + 0.1 * i, 3.6 - 0.1 * i)
+            self.monitor.poll()
+            # spread the samples an hour apart
+            self.monitor._times[i] = i * 3600.0
+        self.assertEqual(self.warnings, [])
+        self.monitor.min_trend_samples = 4
+        self.monitor._check(self.monitor.latest)
+        self.assertEqual([w.kind for w in self.warnings], ["drift"])
+
+        statistics = self.monitor.statistics()
+        self.assertAlmostEqual(statistics["dominant_differential"]["trend"], -0.2)
+        self.assertAlmostEqual(statistics["dominant_differential"]["mean"], 2.1)
+        self.assertAlmostEqual(statistics["low_dominant"]["trend"], 0.1)
+        self.assertAlmostEqual(statistics["high_dominant"]["max_deviation"], 0.0, places=6)
+
+    def test_first_sample_after_start(self) -> None:
+        self.levels.measure(50, 1.0, 4.0)
+        self.monitor.start()
+        self.monitor.stop()
+        self.levels.measure(100, 1.5, 3.5)
+        sample = self.monitor.poll()
+        # only the measurements since the reset by start
+        self.assertEqual(sample.measurements, 200)
+        self.assertAlmostEqual(sample.dominant_differential, 2.0)
+
+    def test_background_thread(self) -> None:
+        self.monitor.interval = 0.01
+        self.monitor.start()
+        self.assertEqual(self.levels.resets, 1)
+        self.monitor.stop()
+        self.assertIsNone(self.monitor._thread)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+"""
+Test for prepared frames
+"""
+
+import unittest
+
+from can import CanOperationError, CanTimeoutError, Message
+
+from can_sontheim._canlib import SontheimBus
+from can_sontheim.constants import NTCAN_SUCCESS, NTCAN_TX_TIMEOUT
+from can_sontheim.prepared import PreparedFrame
+
+
+class RecordingSend:
+    """a stand in for canSend, recording the records it is given"""
+
+    def __init__(self):
+        self.sent = []
+        self.result = NTCAN_SUCCESS
+
+    def __call__(self, handle, msg_ref, count_ref):
+        self.sent.append((handle, count_ref._obj.value, bytes(msg_ref._obj.aby_data), msg_ref._obj.by_len))
+        return self.result
+
+
+class TestPreparedFrame(unittest.TestCase):
+    """unit tests for prepared frames"""
+
+    def setUp(self) -> None:
+        msg = Message(arbitration_id=0x18FF0001, is_extended_id=True, data=[1, 2, 3, 4])
+        self.send_function = RecordingSend()
+        self.frame = PreparedFrame(self.send_function, "handle", SontheimBus._encode_message(msg))
+
+    def test_payload_updated_in_place(self) -> None:
+        self.assertEqual(self.frame.msg_struct.l_id, 0x18FF0001)
+        self.assertEqual(self.frame.msg_struct.by_extended, 2)
+        self.frame.send()
+        self.frame.data[:4] = b"\xaa\xbb\xcc\xdd"
+        self.frame.data[7] = 0xEE
+        self.frame.dlc = 8
+        self.frame.send()
+        self.assertEqual(
+            self.send_function.sent,
+            [
+                ("handle", 1, b"\x01\x02\x03\x04\x00\x00\x00\x00", 4),
+                ("handle", 1, b"\xaa\xbb\xcc\xdd\x00\x00\x00\xee", 8),
+            ],
+        )
+        with self.assertRaises(ValueError):
+            self.frame.dlc = 9
+
+    def test_errors(self) -> None:
+        self.send_function.result = NTCAN_TX_TIMEOUT
+        with self.assertRaises(CanTimeoutError):
+            self.frame.send()
+        self.send_function.result = -5
+        with self.assertRaises(CanOperationError):
+            self.frame.send()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+"""
+Test for the DLL call profiling hooks
+"""
+
+import os
+import unittest
+from unittest import mock
+
+from can_sontheim.profiling import LatencyHistogram, Profiler, profiling_enabled, PROFILE_ENV_VAR
+
+
+class FakeLibrary:
+    """Stands in for the loaded MT_API library"""
+
+    version = "3.0.8"
+
+    @staticmethod
+    def canClearBuffer(handle):
+        return 0 if handle else -8
+
+
+class TestProfiling(unittest.TestCase):
+    """unit tests for the profiling hooks"""
+
+    def test_enabled_by_argument_or_environment(self) -> None:
+        with mock.patch.dict(os.environ, {PROFILE_ENV_VAR: "1"}):
+            self.assertTrue(profiling_enabled())
+            self.assertFalse(profiling_enabled(False))
+        with mock.patch.dict(os.environ, {PROFILE_ENV_VAR: "0"}):
+            self.assertFalse(profiling_enabled())
+            self.assertTrue(profiling_enabled(True))
+
+    def test_histogram(self) -> None:
+        histogram = LatencyHistogram()
+        for duration_ns in (100, 120, 1000, 5000):
+            histogram.record(duration_ns)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot["count"], 4)
+        self.assertEqual(snapshot["min_ns"], 100)
+        self.assertEqual(snapshot["max_ns"], 5000)
+        self.assertEqual(snapshot["p50_ns"], 128)
+        self.assertEqual(snapshot["buckets"], {128: 2, 1024: 1, 8192: 1})
+
+    def test_profiled_library(self) -> None:
+        profiler = Profiler()
+        library = profiler.wrap_library(FakeLibrary())
+        self.assertEqual(library.canClearBuffer(1), 0)
+        self.assertEqual(library.canClearBuffer(0), -8)
+        self.assertEqual(library.version, "3.0.8")
+        profiler.record_stage("decode", 250)
+
+        snapshot = profiler.snapshot()
+        self.assertEqual(snapshot["dll"]["canClearBuffer"]["calls"], 2)
+        self.assertEqual(snapshot["dll"]["canClearBuffer"]["error_codes"], {-8: 1})
+        self.assertEqual(snapshot["stages"]["decode"]["count"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
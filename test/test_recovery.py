@@ -0,0 +1,93 @@
+"""
+Test for the bus-off and reconnect recovery
+"""
+
+import threading
+import unittest
+
+from can import CanInitializationError, CanOperationError
+
+from can_sontheim.constants import NTCAN_CONTR_BUSOFF, NTCAN_HARDWARE_NOT_FOUND
+from can_sontheim.recovery import BusRecovery
+
+
+class StubBus:
+    """records the recovery actions, failing each a given number of times"""
+
+    def __init__(self, restart_failures=0, reopen_failures=0):
+        self.restart_failures = restart_failures
+        self.reopen_failures = reopen_failures
+        self.actions = []
+        self.sent = []
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def restart_controller(self):
+        self.actions.append("restart")
+        if self.restart_failures:
+            self.restart_failures -= 1
+            raise CanOperationError("restart failed")
+
+    def reopen(self):
+        self.gate.wait()
+        self.actions.append("reopen")
+        if self.reopen_failures:
+            self.reopen_failures -= 1
+            raise CanInitializationError("adapter not found")
+
+    def recovery(self, **kwargs):
+        return BusRecovery(
+            self.restart_controller, self.reopen, self.sent.append, retry_interval=0.001, backlog_size=3, **kwargs
+        )
+
+
+class TestBusRecovery(unittest.TestCase):
+    """unit tests for the bus recovery"""
+
+    def test_bus_off_restarts_controller(self) -> None:
+        bus = StubBus()
+        recovered = []
+        recovery = bus.recovery(on_recovered=lambda: recovered.append(True))
+        recovery.trigger(NTCAN_CONTR_BUSOFF)
+        self.assertTrue(recovery.wait(1.0))
+        self.assertEqual(bus.actions, ["restart"])
+        self.assertEqual(recovered, [True])
+        self.assertEqual(recovery.metrics()["recoveries"], {"bus_off": 1})
+
+    def test_reopen_retried_with_backlog(self) -> None:
+        bus = StubBus(reopen_failures=2)
+        bus.gate.clear()
+        recovery = bus.recovery()
+        recovery.trigger(NTCAN_HARDWARE_NOT_FOUND)
+        self.assertTrue(all(recovery.buffer(i) for i in range(4)))
+        bus.gate.set()
+        self.assertTrue(recovery.wait(1.0))
+        self.assertEqual(bus.actions, ["reopen", "reopen", "reopen"])
+        # the oldest frame is dropped from the full backlog
+        self.assertEqual(bus.sent, [1, 2, 3])
+        self.assertEqual(recovery.frames_dropped, 1)
+        self.assertFalse(recovery.buffer(4))
+        metrics = recovery.metrics()
+        self.assertEqual(metrics["recoveries"], {"device_lost": 1})
+        self.assertEqual(metrics["attempts"], 3)
+        self.assertIsNotNone(metrics["last_duration"])
+
+    def test_gives_up_after_timeout(self) -> None:
+        bus = StubBus(restart_failures=1, reopen_failures=1000)
+        recovery = bus.recovery(timeout=0.05)
+        recovery.trigger(NTCAN_CONTR_BUSOFF)
+        self.assertFalse(recovery.wait(1.0))
+        self.assertTrue(recovery.failed)
+        self.assertEqual(bus.actions[:2], ["restart", "reopen"])
+        self.assertEqual(recovery.metrics()["failures"], 1)
+        with self.assertRaises(CanOperationError):
+            recovery.check()
+        # a failed recovery is final, the next driver error does not start another
+        recovery.trigger(NTCAN_HARDWARE_NOT_FOUND)
+        self.assertFalse(recovery.recovering)
+        self.assertFalse(recovery.buffer(0))
+        self.assertEqual(recovery.metrics()["failures"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
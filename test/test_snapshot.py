@@ -0,0 +1,83 @@
+"""
+Test for the latest frame snapshot table
+"""
+
+import threading
+import unittest
+
+from can_sontheim import LatestFrameTable
+
+from helpers import make_batch, make_record
+
+
+def frame_batch(frames):
+    """Builds a raw receive batch from (id, extended, data, tstamp) tuples"""
+    return make_batch(
+        make_record(arbitration_id, data, extended=extended, tstamp=tstamp)
+        for arbitration_id, extended, data, tstamp in frames
+    )
+
+
+class TestLatestFrameTable(unittest.TestCase):
+    """unit tests for the latest frame snapshot table"""
+
+    def test_latest_value(self) -> None:
+        table = LatestFrameTable()
+        table.on_batch(*frame_batch([(0x100, False, b"\x01", 10000), (0x100, False, b"\x02\x03", 20000)]), 100.0)
+        frame = table.get(0x100)
+        self.assertEqual(frame.data, b"\x02\x03")
+        self.assertEqual(frame.dlc, 2)
+        self.assertEqual(frame.count, 2)
+        self.assertAlmostEqual(frame.timestamp, 102.0)
+        self.assertAlmostEqual(table.age(0x100, now=103.5), 1.5)
+        self.assertIsNone(table.get(0x101))
+
+    def test_extended_ids_are_separate_from_standard_ids(self) -> None:
+        table = LatestFrameTable()
+        table.on_batch(*frame_batch([(0x100, False, b"\x01", 0), (0x100, True, b"\x02", 0)]), 0.0)
+        self.assertEqual(table.get(0x100, is_extended_id=False).data, b"\x01")
+        self.assertEqual(table.get(0x100, is_extended_id=True).data, b"\x02")
+
+    def test_extended_table_grows(self) -> None:
+        table = LatestFrameTable(extended_capacity=2)
+        frames = [(0x18FEF100 + i, True, bytes([i]), i) for i in range(10)]
+        table.on_batch(*frame_batch(frames), 0.0)
+        for i in range(10):
+            self.assertEqual(table.get(0x18FEF100 + i).data, bytes([i]))
+
+    def test_table_without_extended_slots_grows(self) -> None:
+        table = LatestFrameTable(extended_capacity=0)
+        table.on_batch(*frame_batch([(0x18FEF100, True, b"\x01", 0), (0x18FEF101, True, b"\x02", 0)]), 0.0)
+        self.assertEqual(table.get(0x18FEF100).data, b"\x01")
+        self.assertEqual(table.get(0x18FEF101).data, b"\x02")
+
+    def test_reads_wait_for_batch_update(self) -> None:
+        table = LatestFrameTable()
+        table.on_batch(*frame_batch([(0x100, False, b"\x01", 10000)]), 0.0)
+
+        # a batch update is in progress whilst the count and age are read
+        table._sequence += 1
+        table._count[0x100] = 5
+        table._timestamp[0x100] = 7.0
+
+        def finish_update():
+            table._count[0x100] = 2
+            table._timestamp[0x100] = 2.0
+            table._sequence += 1
+
+        timer = threading.Timer(0.05, finish_update)
+        timer.start()
+        self.assertEqual(table.count(0x100), 2)
+        self.assertAlmostEqual(table.age(0x100, now=3.0), 1.0)
+        timer.join()
+
+    def test_snapshot(self) -> None:
+        table = LatestFrameTable()
+        table.on_batch(*frame_batch([(0x7FF, False, b"", 0), (0x1FFFFFFF, True, b"\xff" * 8, 0)]), 0.0)
+        self.assertEqual(set(table.snapshot()), {(0x7FF, False), (0x1FFFFFFF, True)})
+        table.clear()
+        self.assertEqual(table.snapshot(), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+"""
+Test for the per identifier period statistics
+"""
+
+import unittest
+
+from can_sontheim.statistics import PeriodStatistics
+
+from helpers import make_batch, make_record
+
+
+def timed_batch(arbitration_id, tstamps):
+    """Builds a raw receive batch of standard frames with the given hardware timestamps"""
+    return make_batch(make_record(arbitration_id, tstamp=tstamp) for tstamp in tstamps)
+
+
+class TestPeriodStatistics(unittest.TestCase):
+    """unit tests for the period statistics engine"""
+
+    def test_period_statistics(self) -> None:
+        stats = PeriodStatistics()
+        stats.on_batch(*timed_batch(0x100, [0, 100, 200]), 0.0)
+        stats.on_batch(*timed_batch(0x100, [320]), 0.0)
+        result = stats.snapshot()[(0x100, False)]
+        self.assertEqual(result.count, 4)
+        self.assertAlmostEqual(result.mean_period, 0.032 / 3)
+        self.assertAlmostEqual(result.min_period, 0.01)
+        self.assertAlmostEqual(result.max_period, 0.012)
+        self.assertAlmostEqual(result.last_timestamp, 0.032)
+
+    def test_timestamp_wrap(self) -> None:
+        stats = PeriodStatistics()
+        stats.on_batch(*timed_batch(0x100, [2**32 - 50, 50]), 0.0)
+        self.assertAlmostEqual(stats.snapshot()[(0x100, False)].mean_period, 0.01)
+
+    def test_store_without_slots_grows(self) -> None:
+        stats = PeriodStatistics(capacity=0)
+        for arbitration_id in range(0x100, 0x180):
+            stats.on_batch(*timed_batch(arbitration_id, [0, 100]), 0.0)
+        result = stats.snapshot()
+        self.assertEqual(len(result), 0x80)
+        self.assertAlmostEqual(result[(0x17F, False)].mean_period, 0.01)
+
+    def test_missed_cycles_and_timeout(self) -> None:
+        events = []
+        stats = PeriodStatistics(callback=lambda *event: events.append(event), jitter_threshold=0.002)
+        stats.set_expected_period(0x100, 0.01)
+        stats.on_batch(*timed_batch(0x100, [0, 100, 400, 530]), 0.0)
+        self.assertEqual(stats.snapshot()[(0x100, False)].missed, 2)
+        self.assertEqual([event[0] for event in events], ["missed", "jitter", "jitter"])
+        self.assertEqual(stats.check_timeouts(now=0.1), [(0x100, False)])
+        self.assertEqual(events[-1][0], "timeout")
+        self.assertTrue(stats.snapshot()[(0x100, False)].timed_out)
+
+
+if __name__ == "__main__":
+    unittest.main()
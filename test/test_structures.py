@@ -0,0 +1,85 @@
+"""
+Test for the compiled structure decoders
+"""
+
+import unittest
+from ctypes import Structure, c_ubyte, c_ulong
+
+from can_sontheim.structures import (
+    CANInstalledDevicesStruct,
+    CANLevelHistStruct,
+    CANMsgStruct,
+    CANStatusStruct,
+    read_struct_as_dict,
+    struct_decoder,
+)
+
+
+class TestStructDecoder(unittest.TestCase):
+    """unit tests for struct_decoder"""
+
+    def test_matches_read_struct_as_dict(self) -> None:
+        status = CANStatusStruct(
+            w_hw_rev=0x0102,
+            w_fw_rev=0x0304,
+            w_drv_rev=0x0506,
+            w_dll_rev=0x0708,
+            ul_board_status=0xDEADBEEF,
+            by_board_id=b"A",
+            w_busoffctr=1,
+            w_errorflag=2,
+            w_errorframectr=3,
+            w_netctr=4,
+            w_baud=5,
+            ui_epld_rev=6,
+        )
+        self.assertEqual(struct_decoder(CANStatusStruct)(status)._asdict(), read_struct_as_dict(status))
+
+    def test_arrays(self) -> None:
+        histogram = CANLevelHistStruct()
+        histogram.ulMeasureCountAll = 1000
+        for i in range(50):
+            histogram.arr_LevelLow[i] = i
+            histogram.arr_LevelHigh[i] = 2 * i
+        histogram.dVariLevelHighDom = 0.25
+        decoded = struct_decoder(CANLevelHistStruct)(histogram)
+        self.assertEqual(decoded.ulMeasureCountAll, 1000)
+        self.assertEqual(decoded.arr_LevelLow, tuple(range(50)))
+        self.assertEqual(decoded.arr_LevelHigh, tuple(range(0, 100, 2)))
+        self.assertEqual(decoded.dVariLevelHighDom, 0.25)
+
+        msg = CANMsgStruct(l_id=0x123, by_len=3)
+        msg.aby_data[:3] = [1, 2, 3]
+        self.assertEqual(struct_decoder(CANMsgStruct)(msg).aby_data, (1, 2, 3, 0, 0, 0, 0, 0))
+
+    def test_char_array(self) -> None:
+        devices = CANInstalledDevicesStruct(Net=105, Name=b"CANfox")
+        decoded = struct_decoder(CANInstalledDevicesStruct)(devices)
+        self.assertEqual(decoded.Net, 105)
+        self.assertEqual(decoded.Name, b"CANfox")
+        self.assertEqual(len(decoded.Reserved), 18)
+
+    def test_nested_structure_and_offset(self) -> None:
+        class Inner(Structure):
+            _fields_ = [("a", c_ubyte), ("b", c_ulong)]
+
+        class Outer(Structure):
+            _fields_ = [("flag", c_ubyte), ("inner", Inner), ("pair", Inner * 2)]
+
+        outer = Outer(flag=1, inner=Inner(2, 3), pair=(Inner(4, 5), Inner(6, 7)))
+        decoded = struct_decoder(Outer)(outer)
+        self.assertEqual(decoded.flag, 1)
+        self.assertEqual(decoded.inner, (2, 3))
+        self.assertEqual(decoded.pair, ((4, 5), (6, 7)))
+
+        buffer = bytes(3) + bytes(outer)
+        self.assertEqual(struct_decoder(Outer)(buffer, 3), decoded)
+
+    def test_cached_per_class(self) -> None:
+        decoder = struct_decoder(CANStatusStruct)
+        self.assertIs(struct_decoder(CANStatusStruct), decoder)
+        self.assertEqual(decoder.result_type._fields[0], "w_hw_rev")
+
+
+if __name__ == "__main__":
+    unittest.main()
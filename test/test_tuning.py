@@ -0,0 +1,45 @@
+"""
+Test for the adaptive receive batch sizing
+"""
+
+import unittest
+
+from can_sontheim.tuning import AdaptiveBatchTuner
+
+
+class TestAdaptiveBatchTuner(unittest.TestCase):
+    """unit tests for the adaptive batch tuner"""
+
+    def test_grows_when_buffer_fills(self) -> None:
+        tuner = AdaptiveBatchTuner(initial_size=20, max_size=64)
+        for i in range(5):
+            tuner.update(tuner.batch_size, now=i * 0.001)
+        self.assertEqual(tuner.batch_size, 64)
+
+    def test_grows_on_lost_frames(self) -> None:
+        tuner = AdaptiveBatchTuner(initial_size=20)
+        tuner.update(3, lost=True, now=0.0)
+        self.assertEqual(tuner.batch_size, 40)
+        self.assertEqual(tuner.metrics()["lost_events"], 1)
+
+    def test_shrinks_when_idle(self) -> None:
+        tuner = AdaptiveBatchTuner(initial_size=256, min_size=4, max_latency=0.02)
+        for i in range(50):
+            tuner.update(0, now=i * 0.02)
+        self.assertEqual(tuner.batch_size, 4)
+        self.assertEqual(tuner.poll_interval, 0.02)
+        self.assertFalse(tuner.coalescing)
+
+    def test_poll_interval_bounded_by_latency(self) -> None:
+        tuner = AdaptiveBatchTuner(initial_size=100, max_latency=0.005)
+        tuner.update_busload(10, 125000)  # roughly 110 frames/s
+        self.assertEqual(tuner.poll_interval, 0.005)
+        self.assertFalse(tuner.coalescing)
+        tuner = AdaptiveBatchTuner(initial_size=40, max_latency=0.005)
+        tuner.update_busload(100, 1000000)  # roughly 9000 frames/s
+        self.assertAlmostEqual(tuner.poll_interval, 20 / (1000000 / 111))
+        self.assertTrue(tuner.coalescing)
+
+
+if __name__ == "__main__":
+    unittest.main()